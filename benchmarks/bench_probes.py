@@ -0,0 +1,235 @@
+"""Benchmarks for the probe and metric-collection hot paths.
+
+Runs each case in a fresh Python process against local stand-in servers
+(see servers.py) and records wall time, CPU time and peak RSS, e.g.
+
+    python benchmarks/bench_probes.py --targets 10,100,1000 --output baseline.json
+    python benchmarks/bench_probes.py --targets 10,100,1000 --compare baseline.json
+
+With --compare the run exits non-zero when a case is more than
+--threshold (default 20%) and --min-delta (default 0.05s) slower than
+the baseline.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+from time import perf_counter, process_time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..', 'src'))
+sys.path.insert(0, BENCH_DIR)
+
+SUITES = ['http', 'http-head', 'dns-connect', 'dns-parallel', 'dns-query', 'collect-reachability', 'collect-speedtest']
+
+# Addresses reserved for documentation (RFC 5737) are never routed, so
+# they stand in for dead resolvers
+DEAD_NETWORKS = ['192.0.2', '198.51.100', '203.0.113']
+
+
+def loopback_address(i):
+    return f"127.{1 + i // 65536}.{(i // 256) % 256}.{i % 256}"
+
+# Every n-th target is dead so failures are spread evenly through the list
+def resolver_addresses(count, failure_rate):
+    dead_every = int(1 / failure_rate) if failure_rate else 0
+    addresses = []
+    dead = 0
+    for i in range(count):
+        if dead_every and i % dead_every == dead_every - 1 and dead < 256 * len(DEAD_NETWORKS):
+            addresses.append(f"{DEAD_NETWORKS[dead // 256]}.{dead % 256}")
+            dead += 1
+        else:
+            addresses.append(loopback_address(i))
+    return addresses
+
+def speedtest_result(i):
+    return {
+        'server': {'name': f"Server {i}", 'location': 'London'},
+        'download': {'download_speed': 100.0, 'latency': {'iqm': 15.0, 'jitter': 2.0}},
+        'upload': {'upload_speed': 50.0, 'latency': {'iqm': 20.0, 'jitter': 3.0}},
+        'ping': {'jitter': 1.5, 'latency': 10.0},
+        'packet_loss': 0.0,
+        'isp': 'ISP',
+        'external_ip': '192.0.2.1'
+    }
+
+
+# Runs in the child process: performs one case and returns its measurements
+def run_case(case):
+    resource.setrlimit(resource.RLIMIT_NOFILE, (resource.getrlimit(resource.RLIMIT_NOFILE)[1],) * 2)
+    import monitor
+    from http_probe import HttpProbe
+    from prometheus import collect_reachability_metrics, collect_speedtest_metrics
+
+    suite, count, concurrency, port = case['suite'], case['targets'], case['concurrency'], case.get('port')
+    timeout = case['timeout']
+
+    if suite in ('http', 'http-head'):
+        import requests
+
+        # The stand-in server speaks plain HTTP
+        monitor.http_get = lambda url, **kwargs: requests.get(url.replace('https://', 'http://', 1), **kwargs)
+
+        class LocalProbe(HttpProbe):
+            def probe(self, url):
+                return super().probe(url.replace('https://', 'http://', 1))
+
+        monitor.http_probe_method = 'head' if suite == 'http-head' else 'get'
+        monitor.http_probe = LocalProbe(method='HEAD', timeout=timeout)
+        targets = [f"127.0.0.1:{port}/target/{i}" for i in range(count)]
+        call = lambda: monitor.run_http_reachability_checks(targets, concurrency=concurrency, deadline=3_600)
+    elif suite == 'dns-connect':
+        from socket import create_connection
+        monitor.create_connection = lambda address, timeout: create_connection((address[0], port), timeout=timeout)
+        targets = resolver_addresses(count, case['failure_rate'])
+        call = lambda: monitor.run_dns_reachability_checks(','.join(targets))
+    elif suite == 'dns-parallel':
+        targets = resolver_addresses(count, case['failure_rate'])
+        call = lambda: monitor.run_dns_reachability_checks_parallel(targets, port=port, timeout=timeout)
+    elif suite == 'dns-query':
+        targets = [loopback_address(i) for i in range(count)]
+        call = lambda: monitor.run_dns_query_checks(targets, names='example.com', query_types='A,AAAA', port=port, timeout=timeout)
+    elif suite == 'collect-reachability':
+        checks = {f"target-{i}.example": {'reachable': i % 10 != 0, 'response_time_ms': float(i % 500)} for i in range(count)}
+        call = lambda: [collect_reachability_metrics('HTTP', checks) for _ in range(case['repeat'])]
+    elif suite == 'collect-speedtest':
+        results = [speedtest_result(i % 3) for i in range(count)]
+        call = lambda: [collect_speedtest_metrics(result) for result in results]
+    else:
+        raise ValueError(f"Unknown suite {suite}")
+
+    wall_start = perf_counter()
+    cpu_start = process_time()
+    output = call()
+    cpu = process_time() - cpu_start
+    wall = perf_counter() - wall_start
+
+    measurement = {
+        'wall_seconds': wall,
+        'cpu_seconds': cpu,
+        'peak_rss_kib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    }
+    if isinstance(output, dict):
+        measurement['reachable'] = sum(1 for check in output.values() if isinstance(check, dict) and check.get('reachable'))
+    return measurement
+
+def case_key(case):
+    return f"{case['suite']}/targets={case['targets']}/concurrency={case['concurrency']}"
+
+def build_cases(args):
+    cases = []
+    for suite in args.suites:
+        for count in args.targets:
+            if suite == 'dns-connect' and count > args.max_sequential_targets:
+                continue
+            concurrencies = args.concurrency if suite in ('http', 'http-head') else [1]
+            for concurrency in concurrencies:
+                if suite in ('http', 'http-head') and concurrency == 1 and count > args.max_sequential_targets:
+                    continue
+                cases.append({
+                    'suite': suite,
+                    'targets': count,
+                    'concurrency': concurrency,
+                    'failure_rate': args.failure_rate,
+                    'timeout': args.timeout,
+                    'repeat': args.repeat
+                })
+    return cases
+
+def run_in_child(case, log_path):
+    env = dict(os.environ, LOGS_FILE_PATH=log_path)
+    completed = subprocess.run(
+        [sys.executable, __file__, '--run-case', json.dumps(case)],
+        capture_output=True, text=True, env=env, check=True
+    )
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+# Cases only count as regressed when slower by more than `threshold`
+# (relative) and `min_delta` seconds, so tiny cases do not flap on noise
+def compare(results, baseline_path, threshold, min_delta):
+    with open(baseline_path) as baseline_file:
+        baseline = {result['case']: result for result in json.load(baseline_file)['results']}
+    regressions = []
+    for result in results:
+        before = baseline.get(result['case'])
+        if before is None:
+            continue
+        change = (result['wall_seconds'] - before['wall_seconds']) / before['wall_seconds']
+        slower = result['wall_seconds'] - before['wall_seconds']
+        flag = 'REGRESSION' if change > threshold and slower > min_delta else ''
+        print(f"{result['case']:<60} {before['wall_seconds']:>9.3f}s -> {result['wall_seconds']:>9.3f}s {change:>+7.1%} {flag}")
+        if flag:
+            regressions.append(result['case'])
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--suites', type=lambda value: value.split(','), default=SUITES)
+    parser.add_argument('--targets', type=lambda value: [int(v) for v in value.split(',')], default=[10, 100, 1_000, 10_000])
+    parser.add_argument('--concurrency', type=lambda value: [int(v) for v in value.split(',')], default=[1, 10, 50, 200])
+    parser.add_argument('--latency-ms', type=float, default=20)
+    parser.add_argument('--failure-rate', type=float, default=0.01)
+    parser.add_argument('--timeout', type=float, default=3)
+    parser.add_argument('--repeat', type=int, default=5, help="collection calls per collect-reachability case")
+    parser.add_argument('--max-sequential-targets', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="write results to this JSON file (use as a baseline)")
+    parser.add_argument('--compare', help="baseline JSON file to compare against")
+    parser.add_argument('--threshold', type=float, default=0.2)
+    parser.add_argument('--min-delta', type=float, default=0.05, help="seconds a case must slow down by to count as a regression")
+    parser.add_argument('--run-case', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_case:
+        print(json.dumps(run_case(json.loads(args.run_case))))
+        return 0
+
+    from servers import StandInHTTPServer, StandInTCPServer, StandInDNSServer
+    http_server = StandInHTTPServer(args.latency_ms, args.failure_rate, args.seed).start()
+    tcp_server = StandInTCPServer().start()
+    dns_server = StandInDNSServer(args.latency_ms, args.failure_rate, args.seed).start()
+    ports = {
+        'http': http_server.port, 'http-head': http_server.port,
+        'dns-connect': tcp_server.port, 'dns-parallel': tcp_server.port,
+        'dns-query': dns_server.port
+    }
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        log_path = os.path.join(directory, 'bench.log')
+        for case in build_cases(args):
+            case['port'] = ports.get(case['suite'])
+            measurement = run_in_child(case, log_path)
+            result = {'case': case_key(case), **case, **measurement}
+            results.append(result)
+            print(f"{result['case']:<60} wall {result['wall_seconds']:>9.3f}s  cpu {result['cpu_seconds']:>8.3f}s  rss {result['peak_rss_kib'] / 1024:>7.1f} MiB", flush=True)
+
+    http_server.stop()
+    tcp_server.stop()
+    dns_server.stop()
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump({
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'latency_ms': args.latency_ms,
+                'failure_rate': args.failure_rate,
+                'results': results
+            }, output_file, indent=2)
+
+    if args.compare:
+        regressions = compare(results, args.compare, args.threshold, args.min_delta)
+        if regressions:
+            print(f"{len(regressions)} case(s) regressed by more than {args.threshold:.0%}")
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
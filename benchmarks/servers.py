@@ -0,0 +1,136 @@
+import heapq
+import random
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import sleep, monotonic
+
+
+# Local stand-ins for the things the monitor probes. Each one listens on
+# every loopback address (0.0.0.0) so that targets such as 127.1.0.5 and
+# 127.1.0.6 are distinct targets served by the same process.
+
+
+# HTTP server that waits `latency_ms` before answering and answers 503
+# for `failure_rate` of the requests
+class StandInHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 4096
+
+    def __init__(self, latency_ms=0, failure_rate=0, seed=0):
+        self.latency = latency_ms / 1_000
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        super().__init__(('0.0.0.0', 0), StandInHTTPHandler)
+        self.port = self.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def handle_error(self, request, client_address):
+        pass
+
+
+class StandInHTTPHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def respond(self, send_body):
+        if self.server.latency:
+            sleep(self.server.latency)
+        status = 503 if self.server.random.random() < self.server.failure_rate else 200
+        body = b'ok' * 512
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+    def do_HEAD(self):
+        self.respond(send_body=False)
+
+    def do_GET(self):
+        self.respond(send_body=True)
+
+
+# TCP listener that accepts and immediately closes connections, standing
+# in for port 53 on a resolver
+class StandInTCPServer:
+
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('0.0.0.0', 0))
+        self.sock.listen(4096)
+        self.port = self.sock.getsockname()[1]
+
+    def start(self):
+        threading.Thread(target=self.serve, daemon=True).start()
+        return self
+
+    def serve(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            conn.close()
+
+    def stop(self):
+        self.sock.close()
+
+
+# UDP DNS server that answers NOERROR after `latency_ms` and never answers
+# `failure_rate` of the queries. Delayed replies are sent from one thread
+# off a heap of due times so latency does not cost a thread per query.
+class StandInDNSServer:
+
+    def __init__(self, latency_ms=0, failure_rate=0, seed=0):
+        self.latency = latency_ms / 1_000
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+        self.sock.bind(('0.0.0.0', 0))
+        self.port = self.sock.getsockname()[1]
+        self._due = []
+        self._ready = threading.Condition()
+
+    def start(self):
+        threading.Thread(target=self.receive, daemon=True).start()
+        threading.Thread(target=self.send, daemon=True).start()
+        return self
+
+    def receive(self):
+        while True:
+            try:
+                query, source = self.sock.recvfrom(512)
+            except OSError:
+                return
+            if len(query) < 12 or self.random.random() < self.failure_rate:
+                continue
+            response = query[:2] + b'\x81\x80' + query[4:]
+            with self._ready:
+                heapq.heappush(self._due, (monotonic() + self.latency, id(response), response, source))
+                self._ready.notify()
+
+    def send(self):
+        while True:
+            with self._ready:
+                while not self._due or self._due[0][0] > monotonic():
+                    self._ready.wait(self._due[0][0] - monotonic() if self._due else None)
+                _, _, response, source = heapq.heappop(self._due)
+            try:
+                self.sock.sendto(response, source)
+            except OSError:
+                return
+
+    def stop(self):
+        self.sock.close()
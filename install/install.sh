@@ -8,6 +8,8 @@ set -e
 LOGS_FILE_PATH="${LOGS_FILE_PATH:-/var/log/internet-speed/internet-speed.log}"
 HTTP_DOMAINS="${HTTP_DOMAINS:-bbc.co.uk,google.co.uk,apple.com}"
 DNS_DOMAINS="${DNS_DOMAINS:-1.1.1.1,8.8.8.8}"
+SPEEDTEST_STATE_FILE="${SPEEDTEST_STATE_FILE:-/opt/internet-speed/speedtest-state.json}"
+PUSH_SPOOL_DIR="${PUSH_SPOOL_DIR:-/opt/internet-speed/push-spool}"
 
 # Extract log directory from log file path
 LOGS_DIR=$(dirname "$LOGS_FILE_PATH")
@@ -52,6 +54,8 @@ sudo -u internet-speed touch /opt/internet-speed/.env
 echo "LOGS_FILE_PATH=$LOGS_FILE_PATH" | sudo tee -a /opt/internet-speed/.env > /dev/null
 echo "HTTP_DOMAINS=$HTTP_DOMAINS" | sudo tee -a /opt/internet-speed/.env > /dev/null
 echo "DNS_DOMAINS=$DNS_DOMAINS" | sudo tee -a /opt/internet-speed/.env > /dev/null
+echo "SPEEDTEST_STATE_FILE=$SPEEDTEST_STATE_FILE" | sudo tee -a /opt/internet-speed/.env > /dev/null
+echo "PUSH_SPOOL_DIR=$PUSH_SPOOL_DIR" | sudo tee -a /opt/internet-speed/.env > /dev/null
 
 echo "Installing systemd service..."
 sudo cp /opt/internet-speed/systemd/internet-speed.service.template /etc/systemd/system/internet-speed.service
@@ -0,0 +1,83 @@
+import logging
+from collections import deque
+from threading import Lock
+from time import monotonic
+
+logger = logging.getLogger('internet-speed')
+
+
+class TargetState:
+    __slots__ = ('results', 'consecutive_failures', 'interval', 'next_due')
+
+    def __init__(self, window):
+        self.results = deque(maxlen=window)
+        self.consecutive_failures = 0
+        self.interval = None
+        self.next_due = 0
+
+
+# Per-target probe intervals for one protocol. A target starts on its base
+# interval; once the last `healthy_window` results are all successes the
+# interval doubles on every further success, up to `max_interval`. A
+# failure drops it straight to `confirm_interval` so an outage is confirmed
+# (and its end seen) within seconds. After `confirm_probes` failures in a
+# row the interval doubles again back up to the base interval, so a target
+# that stays down is not hammered.
+# The protocol's check runs every `confirm_interval` and probes due(...).
+class AdaptiveProbeRate:
+
+    def __init__(self, confirm_interval=15, max_interval=1800, healthy_window=5, confirm_probes=3, clock=monotonic):
+        self.confirm_interval = confirm_interval
+        self.max_interval = max_interval
+        self.healthy_window = healthy_window
+        self.confirm_probes = confirm_probes
+        self.clock = clock
+        self.states = {}
+        self._lock = Lock()
+
+    # Returns the targets in `base_intervals` ({name: seconds}) that are due
+    # now. New targets are due straight away.
+    def due(self, base_intervals, now=None):
+        now = self.clock() if now is None else now
+        with self._lock:
+            due = []
+            for name, base_interval in base_intervals.items():
+                state = self.states.get(name)
+                if state is None:
+                    state = self.states[name] = TargetState(self.healthy_window)
+                    state.interval = base_interval
+                # Half a confirm interval of slack so scheduling jitter
+                # does not push a due target to the following tick
+                if state.next_due <= now + self.confirm_interval / 2:
+                    due.append(name)
+            return due
+
+    def record(self, name, reachable, base_interval, now=None):
+        now = self.clock() if now is None else now
+        with self._lock:
+            state = self.states.get(name)
+            if state is None:
+                state = self.states[name] = TargetState(self.healthy_window)
+                state.interval = base_interval
+            state.results.append(reachable)
+            if reachable:
+                if state.consecutive_failures:
+                    logger.info(f"{name} recovered after {state.consecutive_failures} failed probes.")
+                    state.interval = base_interval
+                elif len(state.results) == state.results.maxlen and all(state.results):
+                    state.interval = min(max(state.interval, base_interval) * 2, max(self.max_interval, base_interval))
+                else:
+                    state.interval = base_interval
+                state.consecutive_failures = 0
+            else:
+                state.consecutive_failures += 1
+                if state.consecutive_failures <= self.confirm_probes:
+                    state.interval = self.confirm_interval
+                else:
+                    state.interval = min(state.interval * 2, max(base_interval, self.confirm_interval))
+            state.next_due = now + state.interval
+            return state.interval, state.consecutive_failures
+
+    def forget(self, name):
+        with self._lock:
+            self.states.pop(name, None)
@@ -0,0 +1,98 @@
+import logging
+from collections import deque
+from socket import create_connection
+from threading import Thread, Condition
+from time import time
+
+from site_messages import encode_hello, encode_reachability, encode_speedtest
+
+logger = logging.getLogger('internet-speed')
+
+
+# Streams results to an aggregator over one persistent TCP connection. The
+# checks only queue encoded messages; a background thread connects (with
+# a growing backoff), says which site it is and sends the queue in order.
+# While the aggregator is unreachable at most `max_queue` messages are
+# kept, dropping the oldest.
+class SiteAgent:
+
+    def __init__(self, host, port, site, max_queue=10000, timeout=10, max_backoff=60, clock=time):
+        self.host = host
+        self.port = port
+        self.site = site
+        self.timeout = timeout
+        self.max_backoff = max_backoff
+        self.clock = clock
+        self._queue = deque(maxlen=max_queue)
+        self._condition = Condition()
+        self._stopped = False
+        self._thread = None
+
+    def start(self):
+        self._stopped = False
+        self._thread = Thread(target=self.run, name='site-agent', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def pending(self):
+        with self._condition:
+            return len(self._queue)
+
+    def _enqueue(self, messages):
+        with self._condition:
+            self._queue.extend(messages)
+            self._condition.notify_all()
+
+    def send_reachability(self, protocol, checks):
+        now = self.clock()
+        self._enqueue(encode_reachability(now, protocol, target, check) for target, check in checks.items())
+
+    def send_speedtest(self, result):
+        if result and (result.get('server') or {}).get('name'):
+            self._enqueue([encode_speedtest(self.clock(), result)])
+
+    def run(self):
+        backoff = min(1, self.max_backoff)
+        while True:
+            with self._condition:
+                if self._stopped:
+                    return
+            try:
+                connection = create_connection((self.host, self.port), timeout=self.timeout)
+            except OSError as err:
+                logger.error(f"Could not connect to the aggregator at {self.host}:{self.port}: {err}")
+                with self._condition:
+                    self._condition.wait_for(lambda: self._stopped, backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+                continue
+
+            logger.info(f"Connected to the aggregator at {self.host}:{self.port} as {self.site}.")
+            backoff = min(1, self.max_backoff)
+            try:
+                with connection:
+                    connection.sendall(encode_hello(self.site))
+                    self._send_queue(connection)
+            except OSError as err:
+                logger.error(f"Lost the connection to the aggregator: {err}")
+
+    # Sends queued messages until stopped; a message is only removed from
+    # the queue once it has been written
+    def _send_queue(self, connection):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._queue or self._stopped)
+                if self._stopped and not self._queue:
+                    return
+                batch = list(self._queue)
+            connection.sendall(b''.join(batch))
+            with self._condition:
+                # The queue may have dropped some of the batch while full
+                for message in batch:
+                    if self._queue and self._queue[0] is message:
+                        self._queue.popleft()
@@ -0,0 +1,176 @@
+import logging
+from socket import SOL_SOCKET, SO_KEEPALIVE
+from socketserver import ThreadingTCPServer, StreamRequestHandler
+from threading import Thread, Lock
+from time import time
+
+from prometheus_client import CollectorRegistry
+from prometheus_client.core import GaugeMetricFamily, InfoMetricFamily, StateSetMetricFamily
+
+from site_messages import decode, read_frame, MessageError, HELLO, REACHABILITY, SPEEDTEST, SPEEDTEST_FIELDS
+
+logger = logging.getLogger('internet-speed')
+
+SPEEDTEST_METRICS = {
+    'download_speed': 'Download speed in Mbps',
+    'download_latency_iqm': 'Download latency IQM in ms',
+    'download_latency_jitter': 'Download latency jitter in ms',
+    'upload_speed': 'Upload speed in Mbps',
+    'upload_latency_iqm': 'Upload latency IQM in ms',
+    'upload_latency_jitter': 'Upload latency jitter in ms',
+    'ping_latency': 'Ping latency in ms',
+    'ping_jitter': 'Ping jitter in ms',
+    'packet_loss': 'Packet loss'
+}
+
+
+# Latest result per site and target (or speedtest server), by the time
+# the site measured it. Results older than `max_age` seconds are not
+# exported, so a backlog replayed after an outage does not look fresh, and
+# a result older than the one already held is ignored.
+class SiteResults:
+
+    def __init__(self, max_age=3600, clock=time):
+        self.max_age = max_age
+        self.clock = clock
+        self.reachability = {}
+        self.speedtests = {}
+        self.last_seen = {}
+        self.connections = {}
+        self._lock = Lock()
+
+    def connected(self, site, change):
+        with self._lock:
+            self.connections[site] = self.connections.get(site, 0) + change
+
+    def add(self, site, message_type, fields):
+        with self._lock:
+            self.last_seen[site] = self.clock()
+            if message_type == REACHABILITY:
+                self._keep_latest(self.reachability, (site, fields['protocol'], fields['target']), fields)
+            elif message_type == SPEEDTEST:
+                self._keep_latest(self.speedtests, (site, fields['server_name'], fields['server_location']), fields)
+
+    def _keep_latest(self, results, key, fields):
+        held = results.get(key)
+        if held is None or held[0] <= fields['timestamp']:
+            results[key] = (fields['timestamp'], fields)
+
+    # Returns (reachability, speedtests, last_seen, connections) with stale
+    # results removed
+    def snapshot(self):
+        with self._lock:
+            cutoff = self.clock() - self.max_age
+            for results in (self.reachability, self.speedtests):
+                for key in [key for key, (measured, _) in results.items() if measured < cutoff]:
+                    del results[key]
+            return (
+                {key: fields for key, (_, fields) in self.reachability.items()},
+                {key: fields for key, (_, fields) in self.speedtests.items()},
+                dict(self.last_seen),
+                dict(self.connections)
+            )
+
+
+# Exports every site's results under the monitor's own metric names, with
+# a `site` label added
+class SiteCollector:
+
+    def __init__(self, results):
+        self.results = results
+
+    def collect(self):
+        reachability, speedtests, last_seen, connections = self.results.snapshot()
+
+        response_time = GaugeMetricFamily('internet_response_time_ms', 'Response time in ms', labels=['site', 'target', 'protocol'])
+        states = StateSetMetricFamily('internet_reachability', 'Status of reachability', labels=['site', 'target', 'protocol'])
+        for (site, protocol, target), fields in reachability.items():
+            if fields['response_time_ms'] is not None:
+                response_time.add_metric([site, target, protocol], fields['response_time_ms'])
+            states.add_metric([site, target, protocol], {'available': fields['reachable'], 'unavailable': not fields['reachable']})
+        yield response_time
+        yield states
+
+        families = {key: GaugeMetricFamily(f"internet_{key}", SPEEDTEST_METRICS[key], labels=['site', 'server_name', 'server_location']) for key, _ in SPEEDTEST_FIELDS}
+        latest_info = {}
+        for (site, server_name, server_location), fields in speedtests.items():
+            for key, family in families.items():
+                if fields[key] is not None:
+                    family.add_metric([site, server_name, server_location], fields[key])
+            if fields['isp'] and fields['external_ip'] and fields['timestamp'] >= latest_info.get(site, {'timestamp': float('-inf')})['timestamp']:
+                latest_info[site] = fields
+        # One info sample per site, from its most recent speedtest
+        info = InfoMetricFamily('internet_speedtest_info', 'Other info i.e. ISP and external IP', labels=['site'])
+        for site, fields in latest_info.items():
+            info.add_metric([site], {'isp': fields['isp'], 'external_ip': fields['external_ip']})
+        yield from families.values()
+        yield info
+
+        seen = GaugeMetricFamily('aggregator_site_last_seen_timestamp_seconds', 'Time of the last message from a site', labels=['site'])
+        connected = GaugeMetricFamily('aggregator_site_connections', 'Open agent connections of a site', labels=['site'])
+        for site, timestamp in last_seen.items():
+            seen.add_metric([site], timestamp)
+        for site, count in connections.items():
+            connected.add_metric([site], count)
+        yield seen
+        yield connected
+
+
+class AgentHandler(StreamRequestHandler):
+
+    def handle(self):
+        self.connection.setsockopt(SOL_SOCKET, SO_KEEPALIVE, 1)
+        results = self.server.results
+        site = None
+        try:
+            payload = read_frame(self.rfile)
+            if payload is None:
+                return
+            message_type, fields = decode(payload)
+            if message_type != HELLO or not fields['site']:
+                logger.error(f"Agent at {self.client_address[0]} did not say which site it is.")
+                return
+            site = fields['site']
+            results.connected(site, 1)
+            logger.info(f"Agent for site {site} connected from {self.client_address[0]}.")
+            while True:
+                payload = read_frame(self.rfile)
+                if payload is None:
+                    break
+                results.add(site, *decode(payload))
+        except (MessageError, OSError) as err:
+            logger.error(f"Dropping agent connection from {self.client_address[0]}: {err}")
+        finally:
+            if site is not None:
+                results.connected(site, -1)
+                logger.info(f"Agent for site {site} disconnected.")
+
+
+class AggregatorServer(ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, results):
+        self.results = results
+        super().__init__(address, AgentHandler)
+
+
+# Receives results from SiteAgents on `address` and exports them through
+# its own registry, to be served on a single /metrics endpoint. Agents are
+# not authenticated and the stream is not encrypted, so it listens on
+# loopback unless given an address that a firewall or tunnel protects.
+class Aggregator:
+
+    def __init__(self, address=('127.0.0.1', 9900), max_age=3600, clock=time):
+        self.results = SiteResults(max_age, clock)
+        self.registry = CollectorRegistry()
+        self.registry.register(SiteCollector(self.results))
+        self.server = AggregatorServer(address, self.results)
+        self.address = self.server.server_address
+
+    def start(self):
+        Thread(target=self.server.serve_forever, name='aggregator', daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
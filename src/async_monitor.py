@@ -0,0 +1,545 @@
+import asyncio
+import logging
+import ssl
+from json import loads as jsonload, JSONDecodeError
+from math import ceil
+from random import getrandbits, uniform
+from struct import pack, unpack_from
+from time import perf_counter
+from urllib.parse import urlsplit, urljoin, parse_qs
+
+from prometheus_client import CONTENT_TYPE_LATEST
+
+import monitor
+from dns_client import build_query, parse_response_header, summarise_query_results
+from exposition import CachedExposition
+from http_probe import REDIRECT_CODES, MAX_REDIRECTS, USER_AGENT
+from prometheus import schedule_lag, schedule_overruns
+from profiler import SamplingProfiler, ProfilerBusy
+
+logger = logging.getLogger('internet-speed')
+
+ssl_context = ssl.create_default_context()
+
+# Held while a speedtest runs, so a throughput trigger and the periodic
+# run never test at the same time
+speedtest_lock = asyncio.Lock()
+
+
+def unreachable():
+    return {
+        'reachable': False,
+        'response_time_ms': None
+    }
+
+async def close_writer(writer):
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except Exception:
+        pass
+
+
+# Speedtest
+
+async def run_speedtest_async(timeout=60, server_ids=None):
+    run_args = monitor.speedtest_args(server_ids=server_ids)
+    try:
+        logger.info('Running speed test...')
+        process = await asyncio.create_subprocess_exec(
+            *run_args,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+    except Exception as err:
+        logger.error("Speedtest failed.")
+        logger.error(err)
+        return {}
+
+    try:
+        output_bytes, error_bytes = await asyncio.wait_for(process.communicate(), timeout)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        logger.error("Speedtest took too long.")
+        return {}
+    if process.returncode != 0:
+        logger.error("Speedtest failed.")
+        logger.error(error_bytes)
+        return {}
+    logger.info('Speedtest subprocess succeeded.')
+
+    try:
+        output = jsonload(output_bytes.decode('utf-8'))
+    except JSONDecodeError:
+        logger.error("Failed to parse speedtest output")
+        return {}
+    logger.info('Finished speedtest.')
+    return monitor.parse_speedtest_output(output)
+
+# Async counterpart of monitor.run_speedtest_streaming for
+# SPEEDTEST_MODE=jsonl: progress events update the live gauges as they
+# arrive and on_phase is called with 'download' or 'upload'
+async def run_speedtest_streaming_async(timeout=60, server_ids=None, on_phase=None):
+    run_args = monitor.speedtest_args("jsonl", server_ids) + ["--progress=yes"]
+    try:
+        logger.info('Running streaming speed test...')
+        process = await asyncio.create_subprocess_exec(
+            *run_args,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT
+        )
+    except Exception as err:
+        logger.error("Speedtest failed.")
+        logger.error(err)
+        return {}
+
+    output = {}
+
+    async def read_events():
+        async for line in process.stdout:
+            try:
+                event = jsonload(line.decode('utf-8'))
+            except (JSONDecodeError, UnicodeDecodeError):
+                event = None
+            if not isinstance(event, dict):
+                logger.error(f"Speedtest: {line.decode('utf-8', 'replace').strip()}")
+                continue
+            logger.debug("Speedtest event: %s", event)
+            monitor.fold_speedtest_event(output, event)
+            if on_phase and event.get('type') in ('download', 'upload'):
+                on_phase(event['type'])
+        await process.wait()
+
+    try:
+        await asyncio.wait_for(read_events(), timeout)
+    except asyncio.TimeoutError:
+        logger.error("Speedtest took too long.")
+        return {}
+    finally:
+        # Also when reading failed or this task was cancelled
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+    if process.returncode != 0:
+        logger.error("Speedtest failed.")
+        return {}
+    if output.get('type') != 'result':
+        logger.error("Speedtest finished without a result.")
+        return {}
+
+    logger.info('Finished speedtest.')
+    return monitor.parse_speedtest_output(output)
+
+
+# HTTP
+
+# Sends a request and reads the status line and headers, and the body
+# only when `read_body` is set. Returns (status_code, location header)
+async def request_headers(url, method, timeout, read_body=False):
+    parts = urlsplit(url)
+    is_tls = parts.scheme == 'https'
+    port = parts.port or (443 if is_tls else 80)
+    path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+    reader, writer = await asyncio.wait_for(
+        asyncio.open_connection(parts.hostname, port, ssl=ssl_context if is_tls else None),
+        timeout
+    )
+    try:
+        writer.write(
+            f"{method} {path} HTTP/1.1\r\nHost: {parts.netloc}\r\nUser-Agent: {USER_AGENT}\r\nConnection: close\r\n\r\n".encode('latin-1')
+        )
+        await writer.drain()
+        status_line = await asyncio.wait_for(reader.readline(), timeout)
+        location = None
+        while True:
+            line = await asyncio.wait_for(reader.readline(), timeout)
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            if name.strip().lower() == 'location':
+                location = value.strip()
+        if read_body:
+            # Sent with Connection: close, so the body ends at EOF
+            await asyncio.wait_for(reader.read(), timeout)
+        return int(status_line.split()[1]), location
+    finally:
+        await close_writer(writer)
+
+# Follows redirects with the request HTTP_PROBE_METHOD asks for: 'head'
+# is a HEAD (falling back to a GET closed after the headers) as in
+# http_probe.HttpProbe, 'stream' a GET closed after the headers and 'get'
+# a GET that downloads the body, as requests does
+async def check_http_domain_async(domain, timeout=3):
+    logger.debug("Domain: %s", domain)
+    target = monitor.inventory.get('HTTP', domain) if monitor.inventory else None
+    url = target.url if target else f"https://{domain}"
+    method = 'HEAD' if monitor.http_probe_method == 'head' else 'GET'
+    read_body = monitor.http_probe_method == 'get'
+    start_time = perf_counter()
+    try:
+        for _ in range(MAX_REDIRECTS + 1):
+            status_code, location = await request_headers(url, method, timeout, read_body)
+            if method == 'HEAD' and status_code in (405, 501):
+                method = 'GET'
+                status_code, location = await request_headers(url, method, timeout)
+            if status_code not in REDIRECT_CODES or not location:
+                break
+            url = urljoin(url, location)
+    except Exception as err:
+        logger.error(f"Request failed for {domain}.")
+        logger.error(err)
+        return unreachable()
+
+    return {
+        'reachable': target.accepts(status_code) if target else 200 <= status_code < 300,
+        'response_time_ms': (perf_counter() - start_time) * 1_000
+    }
+
+# Runs `check` for every target with at most `concurrency` in flight;
+# anything unfinished after `deadline` seconds is cancelled and unreachable
+async def gather_checks(check, targets, concurrency, deadline):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def bounded(target):
+        async with semaphore:
+            return await check(target)
+
+    tasks = {target: asyncio.ensure_future(bounded(target)) for target in targets}
+    if not tasks:
+        return {}
+    await asyncio.wait(tasks.values(), timeout=deadline)
+    results = {}
+    for target, task in tasks.items():
+        if task.done() and not task.cancelled():
+            results[target] = task.result()
+        else:
+            task.cancel()
+            logger.error(f"Check for {target} did not finish within {deadline}s.")
+            results[target] = unreachable()
+    return results
+
+
+# DNS
+
+async def check_dns_connect_async(ip_addr, port=53, timeout=3):
+    logger.debug("IP Address: %s", ip_addr)
+    try:
+        start_time = perf_counter()
+        _, writer = await asyncio.wait_for(asyncio.open_connection(ip_addr, port), timeout)
+        response_time = perf_counter() - start_time
+        await close_writer(writer)
+    except Exception as err:
+        logger.error(f"Request failed for {ip_addr}")
+        logger.error(err)
+        return unreachable()
+
+    return {
+        'reachable': True,
+        'response_time_ms': response_time * 1_000
+    }
+
+
+class DnsQueryProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self):
+        self.pending = {}
+
+    def datagram_received(self, data, addr):
+        if len(data) < 12:
+            return
+        header = parse_response_header(data)
+        future = self.pending.pop(header['transaction_id'], None)
+        if future is not None and not future.done() and header['is_response']:
+            future.set_result(header)
+
+    def error_received(self, exc):
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(exc)
+        self.pending = {}
+
+async def tcp_query_async(resolver, port, query, timeout):
+    reader, writer = await asyncio.wait_for(asyncio.open_connection(resolver, port), timeout)
+    try:
+        writer.write(pack('!H', len(query)) + query)
+        await writer.drain()
+        length = unpack_from('!H', await asyncio.wait_for(reader.readexactly(2), timeout))[0]
+        return await asyncio.wait_for(reader.readexactly(length), timeout)
+    finally:
+        await close_writer(writer)
+
+# Async counterpart of dns_client.query_resolvers for one resolver: one
+# UDP endpoint, every query in flight at once, TCP on truncation
+async def query_resolver_async(resolver, names, query_types, port=53, timeout=3):
+    loop = asyncio.get_running_loop()
+    try:
+        transport, protocol = await loop.create_datagram_endpoint(DnsQueryProtocol, remote_addr=(resolver, port))
+    except Exception as err:
+        logger.error(f"Could not open DNS socket for {resolver}")
+        logger.error(err)
+        return [{'name': name, 'type': query_type, 'rcode': 'ERROR', 'response_time_ms': None} for name in names for query_type in query_types]
+
+    async def query_one(transaction_id, name, query_type):
+        query = build_query(transaction_id, name, query_type)
+        future = loop.create_future()
+        protocol.pending[transaction_id] = future
+        start_time = perf_counter()
+        transport.sendto(query)
+        try:
+            header = await asyncio.wait_for(future, timeout)
+            if header['truncated']:
+                header = parse_response_header(await tcp_query_async(resolver, port, query, timeout))
+        except asyncio.TimeoutError:
+            logger.error(f"DNS query for {name} {query_type} timed out for {resolver}.")
+            return {'name': name, 'type': query_type, 'rcode': 'TIMEOUT', 'response_time_ms': None}
+        except Exception as err:
+            logger.error(f"DNS query failed for {resolver}")
+            logger.error(err)
+            return {'name': name, 'type': query_type, 'rcode': 'ERROR', 'response_time_ms': None}
+        return {'name': name, 'type': query_type, 'rcode': header['rcode'], 'response_time_ms': (perf_counter() - start_time) * 1_000}
+
+    base = getrandbits(16)
+    queries = [(name, query_type) for name in names for query_type in query_types]
+    try:
+        return list(await asyncio.gather(*[
+            query_one((base + i) & 0xFFFF, name, query_type) for i, (name, query_type) in enumerate(queries)
+        ]))
+    finally:
+        transport.close()
+
+
+# Checks
+
+# The pings run on the sampler's own thread; only waiting out the idle
+# baseline and joining the thread are moved off the loop. Without the
+# jsonl events there are no download/upload phases, so the test is one
+# 'loaded' phase.
+async def run_speedtest_under_load_async(server_ids):
+    latency_under_load = monitor.latency_under_load
+    await asyncio.to_thread(latency_under_load.start)
+    try:
+        if monitor.speedtest_mode == 'jsonl':
+            internet_speed = await run_speedtest_streaming_async(server_ids=server_ids, on_phase=latency_under_load.set_phase)
+        else:
+            latency_under_load.set_phase('loaded')
+            internet_speed = await run_speedtest_async(server_ids=server_ids)
+    finally:
+        await asyncio.to_thread(latency_under_load.stop)
+    if internet_speed:
+        internet_speed['bufferbloat'] = latency_under_load.result(monitor.ping_quantiles)
+    return internet_speed
+
+# Async counterpart of monitor.measure_speedtest
+async def measure_speedtest_async(server_ids):
+    if monitor.latency_under_load:
+        return await run_speedtest_under_load_async(server_ids)
+    if monitor.speedtest_mode == 'jsonl':
+        return await run_speedtest_streaming_async(server_ids=server_ids)
+    return await run_speedtest_async(server_ids=server_ids)
+
+# Publishing writes the history database and the state file, so it runs
+# on a worker thread
+async def speedtest_check_async():
+    if speedtest_lock.locked():
+        logger.info("A speedtest is already running, not starting another.")
+        return
+    async with speedtest_lock:
+        for server_ids in monitor.next_speedtest_servers():
+            await asyncio.to_thread(monitor.speedtest_started)
+            start = perf_counter()
+            with monitor.link_coordinator.busy():
+                internet_speed = await measure_speedtest_async(server_ids)
+            await asyncio.to_thread(monitor.publish_speedtest_result, internet_speed, (perf_counter() - start) * 1_000)
+        await asyncio.to_thread(monitor.export_speedtest_results)
+
+async def http_check_async():
+    logger.info('Starting HTTP reachability checks...')
+    domains = monitor.due_targets('HTTP')
+    if not domains:
+        return
+    mark = await asyncio.to_thread(monitor.wait_for_link, 'HTTP')
+    http_start = perf_counter()
+    http_reachability_checks = await gather_checks(
+        check_http_domain_async,
+        domains,
+        monitor.http_concurrency,
+        monitor.http_check_deadline
+    )
+    monitor.mark_during_speedtest(http_reachability_checks, mark)
+    logger.info('Finished HTTP reachability checks.')
+    await asyncio.to_thread(monitor.publish_http_checks, http_reachability_checks, (perf_counter() - http_start) * 1_000)
+
+async def dns_check_async():
+    logger.info('Starting DNS reachability checks...')
+    resolvers = monitor.due_targets('DNS')
+    if not resolvers:
+        return
+    mark = await asyncio.to_thread(monitor.wait_for_link, 'DNS')
+    dns_start = perf_counter()
+    addresses = [monitor.target_address('DNS', resolver, 53) for resolver in resolvers]
+    dns_query_results = None
+    if monitor.dns_check_mode == 'query':
+        names = monitor.split_targets(monitor.dns_query_names)
+        query_types = monitor.dns_query_types
+        answers = await asyncio.gather(*[query_resolver_async(host, names, query_types, port) for host, port in addresses])
+        dns_query_results = dict(zip(resolvers, answers))
+        dns_reachability_checks = summarise_query_results(dns_query_results)
+    else:
+        answers = await asyncio.gather(*[check_dns_connect_async(host, port) for host, port in addresses])
+        dns_reachability_checks = dict(zip(resolvers, answers))
+    monitor.mark_during_speedtest(dns_reachability_checks, mark)
+    logger.info('Finished DNS reachability checks.')
+    await asyncio.to_thread(monitor.publish_dns_checks, dns_reachability_checks, (perf_counter() - dns_start) * 1_000, dns_query_results)
+
+
+# Same grid-based schedule as scheduler.Scheduler, on the event loop clock.
+# after_run renders the exposition, so it runs on a worker thread.
+async def run_periodically(name, check, interval, jitter=0, after_run=None, initial_delay=0):
+    loop = asyncio.get_running_loop()
+    next_run = loop.time() + initial_delay
+    while True:
+        scheduled = next_run + (uniform(0, jitter) if jitter else 0)
+        await asyncio.sleep(max(0, scheduled - loop.time()))
+
+        schedule_lag.labels(name).set(loop.time() - scheduled)
+        try:
+            await check()
+        except Exception as err:
+            logger.error(f"Check {name} failed.")
+            logger.error(err)
+        if after_run:
+            await asyncio.to_thread(after_run)
+
+        next_run += interval
+        finished = loop.time()
+        if finished > next_run:
+            missed = ceil((finished - next_run) / interval)
+            logger.error(f"Check {name} overran its {interval}s interval.")
+            schedule_overruns.labels(name).inc(missed)
+            next_run += missed * interval
+
+
+# Metrics endpoint
+
+async def handle_scrape(reader, writer, exposition, profiler=None):
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), 10)
+        accept_gzip = False
+        while True:
+            line = await asyncio.wait_for(reader.readline(), 10)
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            if name.strip().lower() == 'accept-encoding' and 'gzip' in value:
+                accept_gzip = True
+
+        parts = request_line.decode('latin-1').split()
+        url = urlsplit(parts[1]) if len(parts) >= 2 else None
+        if url and url.path == '/debug/profile' and profiler:
+            writer.write(await profile_response(profiler, url.query))
+        elif url is None or url.path not in ('/', '/metrics'):
+            writer.write(b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+        else:
+            body, is_gzipped = exposition.body(accept_gzip)
+            headers = f"HTTP/1.1 200 OK\r\nContent-Type: {CONTENT_TYPE_LATEST}\r\nContent-Length: {len(body)}\r\nConnection: close\r\n"
+            if is_gzipped:
+                headers += "Content-Encoding: gzip\r\n"
+            writer.write(headers.encode('latin-1') + b"\r\n")
+            if parts[0] != 'HEAD':
+                writer.write(body)
+        await writer.drain()
+    except Exception as err:
+        logger.debug("Scrape failed: %s", err)
+    finally:
+        await close_writer(writer)
+
+# Samples on a worker thread so the event loop (and the checks on it) keep
+# running and show up in the profile
+async def profile_response(profiler, query):
+    try:
+        seconds = float(parse_qs(query).get('seconds', ['10'])[0])
+    except ValueError:
+        body = b"seconds must be a number"
+        return f"HTTP/1.1 400 Bad Request\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode('latin-1') + body
+    try:
+        body = (await asyncio.to_thread(profiler.profile, seconds)).encode('utf-8')
+    except ProfilerBusy as err:
+        body = str(err).encode('utf-8')
+        return f"HTTP/1.1 409 Conflict\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode('latin-1') + body
+    return f"HTTP/1.1 200 OK\r\nContent-Type: text/plain; charset=utf-8\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode('latin-1') + body
+
+async def start_metrics_server(exposition, port=8000, host='0.0.0.0', profiler=None):
+    return await asyncio.start_server(lambda reader, writer: handle_scrape(reader, writer, exposition, profiler), host, port)
+
+
+# Runs the speedtest, HTTP and DNS checks and the metrics endpoint on one
+# event loop in one thread
+async def main(port=8000):
+    if monitor.metrics_precomputed:
+        exposition = CachedExposition(max_age=monitor.metrics_max_age)
+        after_run = exposition.refresh
+    else:
+        # A max_age of 0 renders the exposition on every scrape
+        exposition = CachedExposition(max_age=0)
+        after_run = None
+    server = None
+    if monitor.site_agent and not monitor.agent_serve_metrics:
+        logger.info(f"Sending results to the aggregator at {monitor.aggregator_address} instead of serving metrics.")
+    else:
+        server = await start_metrics_server(exposition, port, profiler=SamplingProfiler() if monitor.profiler_enabled else None)
+        logger.info(f"Serving metrics on port {port} from the event loop.")
+
+    checks = [
+        run_periodically('speedtest', speedtest_check_async, monitor.speedtest_interval, monitor.speedtest_jitter, after_run, monitor.restore_speedtest_state()),
+        run_periodically('http', http_check_async, *monitor.check_schedule('HTTP'), after_run),
+        run_periodically('dns', dns_check_async, *monitor.check_schedule('DNS'), after_run)
+    ]
+    if monitor.history:
+        async def maintain_history():
+            await asyncio.to_thread(monitor.history.maintain)
+        checks.append(run_periodically('history', maintain_history, 3600))
+    if monitor.inventory:
+        async def reload_targets():
+            await asyncio.to_thread(monitor.reload_targets)
+        checks.append(run_periodically('targets', reload_targets, monitor.targets_reload_interval))
+    if monitor.throughput_estimator:
+        loop = asyncio.get_running_loop()
+        triggered = set()
+
+        # May be called from the probe's worker thread
+        def start_speedtest():
+            task = loop.create_task(speedtest_check_async())
+            triggered.add(task)
+            task.add_done_callback(triggered.discard)
+
+        def trigger_speedtest():
+            loop.call_soon_threadsafe(start_speedtest)
+
+        async def throughput_check():
+            monitor.throughput_check()
+
+        async def throughput_probe_check():
+            await asyncio.to_thread(monitor.throughput_probe_check)
+
+        monitor.speedtest_trigger = trigger_speedtest
+        checks.append(run_periodically('throughput', throughput_check, monitor.throughput_sample_interval))
+        if monitor.throughput_probe_url:
+            checks.append(run_periodically('throughput-probe', throughput_probe_check, monitor.throughput_probe_interval))
+    if monitor.ping_sampler:
+        async def ping_check():
+            monitor.ping_check()
+        monitor.ping_sampler.start()
+        checks.append(run_periodically('ping', ping_check, monitor.ping_publish_interval, initial_delay=monitor.ping_publish_interval))
+    if monitor.pusher:
+        async def push():
+            await asyncio.to_thread(monitor.pusher.push)
+        checks.append(run_periodically('push', push, monitor.push_interval, initial_delay=monitor.push_interval))
+    if monitor.site_agent:
+        monitor.site_agent.start()
+
+    try:
+        await asyncio.gather(*checks)
+    finally:
+        if server:
+            server.close()
@@ -0,0 +1,130 @@
+from contextlib import contextmanager
+from statistics import median
+from threading import Lock
+from time import sleep
+
+from ping import PingSampler, PingWindow
+
+PHASES = ('idle', 'download', 'upload', 'loaded')
+LOADED_PHASES = ('download', 'upload', 'loaded')
+GRADES = ['A+', 'A', 'B', 'C', 'D', 'F']
+
+# Upper bound (ms) of the median latency increase under load for each grade
+GRADE_THRESHOLDS = [(5, 'A+'), (30, 'A'), (60, 'B'), (200, 'C'), (400, 'D')]
+
+
+def bufferbloat_grade(increase_ms):
+    for threshold, grade in GRADE_THRESHOLDS:
+        if increase_ms < threshold:
+            return grade
+    return 'F'
+
+
+# Latency under load: pings run at a high rate for the whole speedtest and
+# every result is filed under the phase the test is in. The phase starts
+# as 'idle' for `idle_seconds` before the test and is moved on with
+# set_phase (download/upload from the streaming events, or 'loaded' when
+# the test reports no phases). Each target has its own window per phase so
+# jitter is never taken across hosts; `max_seconds` bounds the memory kept
+# per window.
+class LatencyUnderLoad:
+
+    def __init__(self, targets, rate=10, idle_seconds=3, timeout=1, mode='auto', udp_port=7, max_seconds=300, sampler_factory=PingSampler):
+        self.targets = list(targets)
+        self.rate = rate
+        self.idle_seconds = idle_seconds
+        self.timeout = timeout
+        self.mode = mode
+        self.udp_port = udp_port
+        self.window_size = max(1, int(rate * max_seconds))
+        self.sampler_factory = sampler_factory
+        self.phase = 'idle'
+        self.windows = {}
+        self._sampler = None
+        self._lock = Lock()
+
+    def set_phase(self, phase):
+        self.phase = phase
+
+    def record(self, target, rtt_ms):
+        with self._lock:
+            key = (self.phase, target)
+            window = self.windows.get(key)
+            if window is None:
+                window = self.windows[key] = PingWindow(self.window_size)
+        window.add(rtt_ms)
+
+    # Starts pinging and returns after the idle baseline
+    def start(self):
+        with self._lock:
+            self.phase = 'idle'
+            self.windows = {}
+        self._sampler = self.sampler_factory(self.targets, rate=self.rate, window=1, timeout=self.timeout, mode=self.mode, udp_port=self.udp_port)
+        self._sampler.listeners.append(self.record)
+        self._sampler.start()
+        sleep(self.idle_seconds)
+
+    # Pings still in flight when the test ends are not counted
+    def stop(self):
+        self._sampler.listeners.remove(self.record)
+        self._sampler.stop(self.timeout + 1)
+
+    @contextmanager
+    def measuring(self):
+        self.start()
+        try:
+            yield self
+        finally:
+            self.stop()
+
+    # Returns {'phases': {phase: summary}, 'increase_ms': {phase: ms},
+    # 'grade': grade}. A phase's loss is over every ping sent in it; its
+    # jitter and RTT quantiles, and its increase (each target's median RTT
+    # over its own idle median), are the median across targets. The grade
+    # is taken from the worst loaded phase, or None without an idle baseline.
+    def result(self, quantiles=(0.5, 0.9, 0.99)):
+        quantiles = tuple(dict.fromkeys(tuple(quantiles) + (0.5,)))
+        with self._lock:
+            windows = dict(self.windows)
+        by_phase = {}
+        for (phase, target), window in windows.items():
+            summary = window.summary(quantiles)
+            if summary is not None:
+                by_phase.setdefault(phase, {})[target] = summary
+
+        phases = {phase: combine_summaries(list(summaries.values()), quantiles) for phase, summaries in by_phase.items()}
+
+        idle = by_phase.get('idle', {})
+        increase = {}
+        for phase in LOADED_PHASES:
+            increases = [
+                max(summary['rtt'][0.5] - idle[target]['rtt'][0.5], 0)
+                for target, summary in by_phase.get(phase, {}).items()
+                if 0.5 in summary['rtt'] and 0.5 in idle.get(target, {}).get('rtt', {})
+            ]
+            if increases:
+                increase[phase] = median(increases)
+        return {
+            'phases': phases,
+            'increase_ms': increase,
+            'grade': bufferbloat_grade(max(increase.values())) if increase else None
+        }
+
+
+# Folds per-target PingWindow summaries of one phase into one summary, with
+# the quantiles keyed by str(q)
+def combine_summaries(summaries, quantiles):
+    sent = sum(summary['sent'] for summary in summaries)
+    lost = sum(summary['loss'] * summary['sent'] for summary in summaries)
+    jitters = [summary['jitter'] for summary in summaries if summary['jitter'] is not None]
+    rtt = {}
+    for q in quantiles:
+        values = [summary['rtt'][q] for summary in summaries if q in summary['rtt']]
+        if values:
+            rtt[str(q)] = median(values)
+    return {
+        'sent': sent,
+        'loss': lost / sent,
+        'jitter': median(jitters) if jitters else None,
+        'rtt': rtt
+    }
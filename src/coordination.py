@@ -0,0 +1,50 @@
+from contextlib import contextmanager
+from threading import Condition
+from time import monotonic
+
+
+# Tracks whether a speedtest is saturating the link so probes can either
+# wait for it to finish or be marked as having run while it was busy.
+class LinkCoordinator:
+
+    def __init__(self, clock=monotonic):
+        self.clock = clock
+        self._speedtests = 0
+        self._generation = 0
+        self._condition = Condition()
+
+    # Marks the link busy for the duration of the block
+    @contextmanager
+    def busy(self):
+        with self._condition:
+            self._speedtests += 1
+            self._generation += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._speedtests -= 1
+                if not self._speedtests:
+                    self._condition.notify_all()
+
+    def is_busy(self):
+        with self._condition:
+            return self._speedtests > 0
+
+    # Blocks until no speedtest is running, for at most `timeout` seconds.
+    # Returns True if the link is idle.
+    def wait_until_idle(self, timeout=None):
+        with self._condition:
+            return self._condition.wait_for(lambda: not self._speedtests, timeout)
+
+    # A mark taken before a probe run, for overlapped
+    def mark(self):
+        with self._condition:
+            return self._speedtests > 0, self._generation
+
+    # True if the link was busy at any point since `mark`: at the mark,
+    # now, or because a speedtest started and finished in between
+    def overlapped(self, mark):
+        busy_at_mark, generation = mark
+        with self._condition:
+            return busy_at_mark or self._speedtests > 0 or self._generation != generation
@@ -0,0 +1,198 @@
+import logging
+from random import getrandbits
+from struct import pack, unpack_from
+from socket import socket, getaddrinfo, create_connection, SOCK_DGRAM
+from selectors import DefaultSelector, EVENT_READ
+from time import perf_counter
+
+logger = logging.getLogger('internet-speed')
+
+QUERY_TYPES = {'A': 1, 'NS': 2, 'CNAME': 5, 'SOA': 6, 'PTR': 12, 'MX': 15, 'TXT': 16, 'AAAA': 28, 'SRV': 33, 'HTTPS': 65}
+RCODES = {0: 'NOERROR', 1: 'FORMERR', 2: 'SERVFAIL', 3: 'NXDOMAIN', 4: 'NOTIMP', 5: 'REFUSED'}
+
+FLAG_RESPONSE = 0x8000
+FLAG_TRUNCATED = 0x0200
+FLAG_RECURSION_DESIRED = 0x0100
+
+
+# Builds a standard recursive query for a single question e.g.
+# build_query(0x1234, "google.com", "A")
+def build_query(transaction_id, name, query_type):
+    header = pack('!HHHHHH', transaction_id, FLAG_RECURSION_DESIRED, 1, 0, 0, 0)
+    question = b''
+    for label in name.rstrip('.').encode('idna').split(b'.'):
+        question += bytes([len(label)]) + label
+    return header + question + b'\x00' + pack('!HH', QUERY_TYPES[query_type], 1)
+
+# Upper-cases DNS_QUERY_TYPES entries and drops, with an error, any type
+# build_query has no code for
+def supported_query_types(query_types):
+    supported = []
+    for query_type in query_types:
+        query_type = query_type.strip().upper()
+        if query_type not in QUERY_TYPES:
+            logger.error(f"Skipping unsupported DNS query type {query_type}, expected one of {', '.join(QUERY_TYPES)}.")
+        elif query_type not in supported:
+            supported.append(query_type)
+    return supported
+
+# Only the 12 byte header is needed to match a response to its query
+# and to read the outcome, so the answer records are never decoded
+def parse_response_header(data):
+    transaction_id, flags, _, answer_count, _, _ = unpack_from('!HHHHHH', data)
+    return {
+        'transaction_id': transaction_id,
+        'is_response': bool(flags & FLAG_RESPONSE),
+        'truncated': bool(flags & FLAG_TRUNCATED),
+        'rcode': RCODES.get(flags & 0x000F, 'OTHER'),
+        'answer_count': answer_count
+    }
+
+# Re-sends a truncated query over TCP (2 byte length prefix, RFC 1035 4.2.2)
+def tcp_query(resolver, port, query, timeout):
+    with create_connection((resolver, port), timeout=timeout) as sock:
+        sock.sendall(pack('!H', len(query)) + query)
+        length = unpack_from('!H', _recv_exactly(sock, 2))[0]
+        return _recv_exactly(sock, length)
+
+def _recv_exactly(sock, length):
+    data = b''
+    while len(data) < length:
+        chunk = sock.recv(length - len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed before full DNS message was received")
+        data += chunk
+    return data
+
+def _unanswered(name, query_type, rcode):
+    return {
+        'name': name,
+        'type': query_type,
+        'rcode': rcode,
+        'response_time_ms': None
+    }
+
+# Sends every (name, type) query to every resolver and waits for the
+# answers on one selector. Each resolver gets a single connected UDP
+# socket and all of its queries are in flight at once, matched back up
+# by transaction ID. Truncated answers are retried over TCP once the UDP
+# answers are in, within a further `timeout` seconds, and their response
+# time is the UDP round trip plus the TCP exchange.
+# `addresses` optionally maps a resolver name to the (host, port) to query.
+# Returns {resolver: [{'name', 'type', 'rcode', 'response_time_ms'}, ...]}
+def query_resolvers(resolvers, names, query_types, port=53, timeout=3, addresses=None):
+    results = {}
+    pending = {}
+    endpoints = {resolver: (addresses or {}).get(resolver, (resolver, port)) for resolver in resolvers}
+    selector = DefaultSelector()
+
+    for resolver in resolvers:
+        results[resolver] = []
+        try:
+            family, _, _, _, address = getaddrinfo(*endpoints[resolver], type=SOCK_DGRAM)[0]
+            sock = socket(family, SOCK_DGRAM)
+            sock.connect(address)
+            sock.setblocking(False)
+        except Exception as err:
+            logger.error(f"Could not open DNS socket for {resolver}")
+            logger.error(err)
+            results[resolver] = [_unanswered(name, query_type, 'ERROR') for name in names for query_type in query_types]
+            continue
+        selector.register(sock, EVENT_READ, resolver)
+
+        transaction_id = getrandbits(16)
+        for name in names:
+            for query_type in query_types:
+                transaction_id = (transaction_id + 1) & 0xFFFF
+                query = build_query(transaction_id, name, query_type)
+                try:
+                    pending[(resolver, transaction_id)] = (name, query_type, query, perf_counter())
+                    sock.send(query)
+                except OSError as err:
+                    logger.error(f"Failed to send DNS query to {resolver}")
+                    logger.error(err)
+                    del pending[(resolver, transaction_id)]
+                    results[resolver].append(_unanswered(name, query_type, 'ERROR'))
+
+    truncated = []
+    deadline = perf_counter() + timeout
+    while pending:
+        remaining = deadline - perf_counter()
+        if remaining <= 0:
+            break
+        for key, _ in selector.select(remaining):
+            resolver = key.data
+            while True:
+                try:
+                    data = key.fileobj.recv(4096)
+                except BlockingIOError:
+                    break
+                except OSError as err:
+                    # ICMP port unreachable surfaces here as ECONNREFUSED
+                    logger.error(f"DNS query failed for {resolver}")
+                    logger.error(err)
+                    selector.unregister(key.fileobj)
+                    key.fileobj.close()
+                    for (pending_resolver, transaction_id) in [k for k in pending if k[0] == resolver]:
+                        name, query_type, _, _ = pending.pop((pending_resolver, transaction_id))
+                        results[resolver].append(_unanswered(name, query_type, 'ERROR'))
+                    break
+                if len(data) < 12:
+                    continue
+                header = parse_response_header(data)
+                entry = pending.pop((resolver, header['transaction_id']), None)
+                if entry is None or not header['is_response']:
+                    continue
+                name, query_type, query, start_time = entry
+                if header['truncated']:
+                    truncated.append((resolver, name, query_type, query, perf_counter() - start_time))
+                    continue
+                results[resolver].append({
+                    'name': name,
+                    'type': query_type,
+                    'rcode': header['rcode'],
+                    'response_time_ms': (perf_counter() - start_time) * 1_000
+                })
+
+    for (resolver, _), (name, query_type, _, _) in pending.items():
+        logger.error(f"DNS query for {name} {query_type} timed out for {resolver}.")
+        results[resolver].append(_unanswered(name, query_type, 'TIMEOUT'))
+
+    tcp_deadline = perf_counter() + timeout
+    for resolver, name, query_type, query, udp_time in truncated:
+        remaining = tcp_deadline - perf_counter()
+        if remaining <= 0:
+            logger.error(f"No time left for the TCP fallback of {name} {query_type} for {resolver}.")
+            results[resolver].append(_unanswered(name, query_type, 'TIMEOUT'))
+            continue
+        tcp_start = perf_counter()
+        try:
+            header = parse_response_header(tcp_query(*endpoints[resolver], query, remaining))
+        except Exception as err:
+            logger.error(f"TCP fallback failed for {resolver}")
+            logger.error(err)
+            results[resolver].append(_unanswered(name, query_type, 'ERROR'))
+            continue
+        results[resolver].append({
+            'name': name,
+            'type': query_type,
+            'rcode': header['rcode'],
+            'response_time_ms': (udp_time + perf_counter() - tcp_start) * 1_000
+        })
+    for key in list(selector.get_map().values()):
+        key.fileobj.close()
+    selector.close()
+    return results
+
+# Reduces query results to the {ip: {'reachable', 'response_time_ms'}}
+# mapping used by collect_reachability_metrics. A resolver is reachable
+# when it answered at least one query; the response time is the mean RTT.
+def summarise_query_results(results):
+    summary = {}
+    for resolver, queries in results.items():
+        response_times = [query['response_time_ms'] for query in queries if query['response_time_ms'] is not None]
+        summary[resolver] = {
+            'reachable': bool(response_times),
+            'response_time_ms': sum(response_times) / len(response_times) if response_times else None
+        }
+    return summary
@@ -0,0 +1,113 @@
+import gzip
+import logging
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread, Lock
+from time import monotonic
+from urllib.parse import urlsplit, parse_qs
+
+from prometheus_client import REGISTRY, CONTENT_TYPE_LATEST, generate_latest
+
+from profiler import ProfilerBusy
+
+logger = logging.getLogger('internet-speed')
+
+
+# Text exposition of a registry, rendered once per probe cycle rather than
+# once per scrape. refresh() walks the registry and stores both the plain
+# and the gzip-compressed body; scrapes just write out the stored bytes.
+# If nothing has refreshed it for `max_age` seconds (e.g. during a long
+# speedtest) the next scrape rebuilds it, so it is never more than
+# `max_age` seconds out of date.
+class CachedExposition:
+
+    def __init__(self, registry=REGISTRY, max_age=15, clock=monotonic):
+        self.registry = registry
+        self.max_age = max_age
+        self.clock = clock
+        self._lock = Lock()
+        self._plain = None
+        self._gzipped = None
+        self._built_at = None
+
+    def refresh(self):
+        plain = generate_latest(self.registry)
+        gzipped = gzip.compress(plain, compresslevel=6)
+        with self._lock:
+            self._plain, self._gzipped, self._built_at = plain, gzipped, self.clock()
+
+    # Returns (body, is_gzipped)
+    def body(self, accept_gzip):
+        with self._lock:
+            stale = self._built_at is None or self.clock() - self._built_at > self.max_age
+        if stale:
+            self.refresh()
+        with self._lock:
+            return (self._gzipped, True) if accept_gzip else (self._plain, False)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def send_body(self, include_body):
+        url = urlsplit(self.path)
+        if url.path == '/debug/profile' and self.server.profiler:
+            self.send_profile(url.query, include_body)
+            return
+        if url.path not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        accept_gzip = 'gzip' in self.headers.get('Accept-Encoding', '')
+        body, is_gzipped = self.server.exposition.body(accept_gzip)
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE_LATEST)
+        self.send_header('Content-Length', str(len(body)))
+        if is_gzipped:
+            self.send_header('Content-Encoding', 'gzip')
+        self.end_headers()
+        if include_body:
+            self.wfile.write(memoryview(body))
+
+    # Samples for ?seconds=N (default 10) and returns folded stacks
+    def send_profile(self, query, include_body):
+        try:
+            seconds = float(parse_qs(query).get('seconds', ['10'])[0])
+        except ValueError:
+            self.send_error(400, "seconds must be a number")
+            return
+        try:
+            body = self.server.profiler.profile(seconds).encode('utf-8')
+        except ProfilerBusy as err:
+            self.send_error(409, str(err))
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if include_body:
+            self.wfile.write(body)
+
+    def do_GET(self):
+        self.send_body(include_body=True)
+
+    def do_HEAD(self):
+        self.send_body(include_body=False)
+
+
+class MetricsServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, exposition, profiler=None):
+        self.exposition = exposition
+        self.profiler = profiler
+        super().__init__(address, MetricsHandler)
+
+
+# Drop-in for prometheus_client.start_http_server that serves a CachedExposition
+# (and /debug/profile if given a profiler.SamplingProfiler)
+def start_cached_http_server(port, exposition, addr='0.0.0.0', profiler=None):
+    server = MetricsServer((addr, port), exposition, profiler)
+    Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    logger.info(f"Serving precomputed metrics on port {server.server_address[1]}.")
+    return server
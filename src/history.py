@@ -0,0 +1,172 @@
+import logging
+import sqlite3
+from threading import Lock
+from time import time
+
+logger = logging.getLogger('internet-speed')
+
+HOUR = 3600
+DAY = 86400
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS series (
+    id INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL,
+    target TEXT NOT NULL,
+    metric TEXT NOT NULL,
+    UNIQUE (kind, target, metric)
+);
+CREATE TABLE IF NOT EXISTS samples (
+    series_id INTEGER NOT NULL,
+    ts INTEGER NOT NULL,
+    value REAL NOT NULL,
+    PRIMARY KEY (series_id, ts)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS rollup_1h (
+    series_id INTEGER NOT NULL,
+    ts INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    sum REAL NOT NULL,
+    min REAL NOT NULL,
+    max REAL NOT NULL,
+    PRIMARY KEY (series_id, ts)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS rollup_1d (
+    series_id INTEGER NOT NULL,
+    ts INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    sum REAL NOT NULL,
+    min REAL NOT NULL,
+    max REAL NOT NULL,
+    PRIMARY KEY (series_id, ts)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS watermarks (
+    name TEXT PRIMARY KEY,
+    ts INTEGER NOT NULL
+);
+"""
+
+
+# Append-only SQLite history of every speedtest and probe result.
+# Samples are buffered in memory and written in one transaction per
+# flush. maintain() rolls complete hours of raw samples up into
+# rollup_1h, complete days of hourly rollups into rollup_1d, and deletes
+# anything older than its retention, so the file and memory use stay
+# bounded no matter how long the service runs.
+class HistoryStore:
+
+    def __init__(self, db_path, batch_size=500, raw_retention=7 * DAY, hourly_retention=90 * DAY, daily_retention=5 * 365 * DAY, clock=time):
+        self.batch_size = batch_size
+        self.retention = {'samples': raw_retention, 'rollup_1h': hourly_retention, 'rollup_1d': daily_retention}
+        self.clock = clock
+        self._pending = []
+        self._series = {}
+        self._lock = Lock()
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        # Cap SQLite's page cache at ~2 MiB so memory stays flat
+        self.connection.execute("PRAGMA cache_size=-2000")
+        self.connection.executescript(SCHEMA)
+
+    def _series_id(self, kind, target, metric):
+        key = (kind, target, metric)
+        if key not in self._series:
+            self.connection.execute("INSERT OR IGNORE INTO series (kind, target, metric) VALUES (?, ?, ?)", key)
+            self._series[key] = self.connection.execute(
+                "SELECT id FROM series WHERE kind = ? AND target = ? AND metric = ?", key
+            ).fetchone()[0]
+        return self._series[key]
+
+    # Buffers one value per metric e.g.
+    # record('HTTP', 'bbc.co.uk', {'reachable': 1, 'response_time_ms': 120.5})
+    def record(self, kind, target, values, timestamp=None):
+        timestamp = int(timestamp if timestamp is not None else self.clock())
+        with self._lock:
+            for metric, value in values.items():
+                if value is not None:
+                    self._pending.append((kind, target, metric, timestamp, float(value)))
+            full = len(self._pending) >= self.batch_size
+        if full:
+            self.flush()
+
+    def record_reachability(self, protocol, checks_output, timestamp=None):
+        for target, check in checks_output.items():
+            self.record(protocol, target, {
+                'reachable': 1 if check['reachable'] else 0,
+                'response_time_ms': check['response_time_ms']
+            }, timestamp)
+
+    def record_speedtest(self, speedtest_output, timestamp=None):
+        if not speedtest_output or not speedtest_output.get('server') or not speedtest_output['server'].get('name'):
+            return
+        self.record('speedtest', speedtest_output['server']['name'], {
+            'download_speed': speedtest_output['download']['download_speed'],
+            'upload_speed': speedtest_output['upload']['upload_speed'],
+            'ping_latency': speedtest_output['ping']['latency'],
+            'ping_jitter': speedtest_output['ping']['jitter'],
+            'packet_loss': speedtest_output['packet_loss']
+        }, timestamp)
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+            if not pending:
+                return
+            with self.connection:
+                rows = [(self._series_id(kind, target, metric), ts, value) for kind, target, metric, ts, value in pending]
+                self.connection.executemany("INSERT OR REPLACE INTO samples (series_id, ts, value) VALUES (?, ?, ?)", rows)
+        logger.debug("Flushed %s history samples.", len(rows))
+
+    def _rollup(self, source, destination, resolution, now):
+        # Only whole buckets are rolled up, each exactly once
+        end = int(now) // resolution * resolution
+        row = self.connection.execute("SELECT ts FROM watermarks WHERE name = ?", (destination,)).fetchone()
+        start = row[0] if row else 0
+        if end <= start:
+            return
+        if source == 'samples':
+            select = "SELECT series_id, ts / ? * ? AS bucket, COUNT(*), SUM(value), MIN(value), MAX(value)"
+        else:
+            select = "SELECT series_id, ts / ? * ? AS bucket, SUM(count), SUM(sum), MIN(min), MAX(max)"
+        self.connection.execute(
+            f"INSERT OR REPLACE INTO {destination} (series_id, ts, count, sum, min, max) "
+            f"{select} FROM {source} WHERE ts >= ? AND ts < ? GROUP BY series_id, bucket",
+            (resolution, resolution, start, end)
+        )
+        self.connection.execute("INSERT OR REPLACE INTO watermarks (name, ts) VALUES (?, ?)", (destination, end))
+
+    def maintain(self):
+        self.flush()
+        now = self.clock()
+        with self._lock, self.connection:
+            self._rollup('samples', 'rollup_1h', HOUR, now)
+            self._rollup('rollup_1h', 'rollup_1d', DAY, now)
+            for table, retention in self.retention.items():
+                self.connection.execute(f"DELETE FROM {table} WHERE ts < ?", (int(now - retention),))
+        logger.info("Finished history maintenance.")
+
+    # Returns [(ts, value)] for resolution 'raw', otherwise
+    # [(ts, count, mean, min, max)] from the '1h' or '1d' rollups
+    def query(self, kind, target, metric, start, end, resolution='raw'):
+        self.flush()
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT id FROM series WHERE kind = ? AND target = ? AND metric = ?", (kind, target, metric)
+            ).fetchone()
+            if row is None:
+                return []
+            if resolution == 'raw':
+                return self.connection.execute(
+                    "SELECT ts, value FROM samples WHERE series_id = ? AND ts >= ? AND ts < ? ORDER BY ts",
+                    (row[0], int(start), int(end))
+                ).fetchall()
+            table = {'1h': 'rollup_1h', '1d': 'rollup_1d'}[resolution]
+            return self.connection.execute(
+                f"SELECT ts, count, sum / count, min, max FROM {table} WHERE series_id = ? AND ts >= ? AND ts < ? ORDER BY ts",
+                (row[0], int(start), int(end))
+            ).fetchall()
+
+    def close(self):
+        self.flush()
+        self.connection.close()
@@ -0,0 +1,188 @@
+import logging
+from http.client import HTTPConnection, HTTPSConnection, HTTPException
+from socket import socket, getaddrinfo, SOCK_STREAM
+from threading import Lock
+from time import perf_counter, monotonic
+from urllib.parse import urlsplit, urljoin
+
+logger = logging.getLogger('internet-speed')
+
+PHASES = ['dns', 'connect', 'tls', 'ttfb']
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+MAX_REDIRECTS = 5
+USER_AGENT = 'internet-speed-monitor'
+
+
+# Opens the socket itself so DNS resolution, the TCP handshake and the
+# TLS handshake can each be timed. Timings are left in `phase_timings`
+# (seconds) for the probe to pick up after connect().
+class TimedConnectionMixin:
+
+    def connect(self):
+        start = perf_counter()
+        family, sock_type, proto, _, address = getaddrinfo(self.host, self.port, type=SOCK_STREAM)[0]
+        resolved = perf_counter()
+        sock = socket(family, sock_type, proto)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(address)
+        except Exception:
+            sock.close()
+            raise
+        connected = perf_counter()
+        try:
+            self.sock = self.wrap(sock)
+        except Exception:
+            # A failed TLS handshake would otherwise leak the raw socket
+            sock.close()
+            raise
+        self.phase_timings = {
+            'dns': resolved - start,
+            'connect': connected - resolved,
+            'tls': perf_counter() - connected if self.is_tls else None
+        }
+
+class TimedHTTPConnection(TimedConnectionMixin, HTTPConnection):
+    is_tls = False
+
+    def wrap(self, sock):
+        return sock
+
+class TimedHTTPSConnection(TimedConnectionMixin, HTTPSConnection):
+    is_tls = True
+
+    def wrap(self, sock):
+        return self._context.wrap_socket(sock, server_hostname=self.host)
+
+
+# Probes URLs with HEAD requests (or GETs that are closed as soon as the
+# headers arrive) over pooled keep-alive connections, one idle pool per
+# (scheme, host, port). A probe on a reused connection has no dns,
+# connect or tls phase; those phases are None in the result. At most
+# `max_idle_per_host` connections per pool and `max_idle` in all are kept,
+# and a connection idle for over `max_idle_age` seconds is closed rather
+# than reused, since the server has most likely dropped it by then.
+class HttpProbe:
+
+    def __init__(self, method='HEAD', timeout=3, max_idle_per_host=4, max_idle=256, max_idle_age=30, clock=monotonic):
+        self.method = method.upper()
+        self.timeout = timeout
+        self.max_idle_per_host = max_idle_per_host
+        self.max_idle = max_idle
+        self.max_idle_age = max_idle_age
+        self.clock = clock
+        self._idle = {}
+        self._idle_count = 0
+        self._lock = Lock()
+
+    def _checkout(self, key):
+        expired = []
+        connection = None
+        with self._lock:
+            connections = self._idle.get(key)
+            if connections:
+                # Newest last; anything older than max_idle_age goes
+                cutoff = self.clock() - self.max_idle_age
+                while connections and connections[0][1] < cutoff:
+                    expired.append(connections.pop(0)[0])
+                if connections:
+                    connection = connections.pop()[0]
+                self._idle_count -= len(expired) + (connection is not None)
+                if not connections:
+                    del self._idle[key]
+        for stale in expired:
+            stale.close()
+        if connection is not None:
+            return connection
+        scheme, host, port = key
+        connection_class = TimedHTTPSConnection if scheme == 'https' else TimedHTTPConnection
+        return connection_class(host, port, timeout=self.timeout)
+
+    def _checkin(self, key, connection):
+        with self._lock:
+            connections = self._idle.setdefault(key, [])
+            if len(connections) < self.max_idle_per_host and self._idle_count < self.max_idle:
+                connections.append((connection, self.clock()))
+                self._idle_count += 1
+                return
+            if not connections:
+                del self._idle[key]
+        connection.close()
+
+    def idle_connections(self):
+        with self._lock:
+            return self._idle_count
+
+    def close(self):
+        with self._lock:
+            for connections in self._idle.values():
+                for connection, _ in connections:
+                    connection.close()
+            self._idle = {}
+            self._idle_count = 0
+
+    # Sends one request and returns (status_code, location, phase timings)
+    def _request(self, url, method):
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port or (443 if parts.scheme == 'https' else 80))
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        for attempt in range(2):
+            connection = self._checkout(key)
+            reused = connection.sock is not None
+            phases = dict.fromkeys(PHASES)
+            try:
+                if not reused:
+                    connection.connect()
+                    phases.update(connection.phase_timings)
+                request_start = perf_counter()
+                connection.request(method, path, headers={'User-Agent': USER_AGENT})
+                response = connection.getresponse()
+                phases['ttfb'] = perf_counter() - request_start
+            except (ConnectionError, HTTPException) as err:
+                connection.close()
+                # The server may have dropped an idle keep-alive connection
+                if reused and attempt == 0:
+                    logger.debug("Pooled connection to %s was stale: %s", key[1], err)
+                    continue
+                raise
+            except Exception:
+                connection.close()
+                raise
+
+            # HEAD has no body so the connection can go back in the pool;
+            # a streamed GET is closed instead of downloading the body
+            if method == 'HEAD' and not response.will_close:
+                response.read()
+                self._checkin(key, connection)
+            else:
+                response.close()
+                connection.close()
+            return response.status, response.getheader('Location'), phases
+
+    # Follows redirects and returns
+    # {'status_code', 'response_time_ms', 'phases': {phase: ms or None}}
+    # where each phase is summed over every hop it occurred in
+    def probe(self, url):
+        start = perf_counter()
+        method = self.method
+        totals = dict.fromkeys(PHASES)
+        for _ in range(MAX_REDIRECTS + 1):
+            status_code, location, phases = self._request(url, method)
+            if method == 'HEAD' and status_code in (405, 501):
+                # Some servers refuse HEAD; retry the same URL with a streamed GET
+                method = 'GET'
+                status_code, location, phases = self._request(url, method)
+            for phase, value in phases.items():
+                if value is not None:
+                    totals[phase] = (totals[phase] or 0) + value
+            if status_code not in REDIRECT_CODES or not location:
+                break
+            url = urljoin(url, location)
+        return {
+            'status_code': status_code,
+            'response_time_ms': (perf_counter() - start) * 1_000,
+            'phases': {phase: value * 1_000 if value is not None else None for phase, value in totals.items()}
+        }
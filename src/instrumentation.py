@@ -0,0 +1,33 @@
+from contextlib import contextmanager
+from time import perf_counter
+
+from prometheus import check_phase_duration, probes_in_flight
+
+
+# A supervised worker's registry is never scraped, so there the phase
+# timings are collected here instead and sent back with each answer for
+# the supervisor to observe (see supervisor.worker_main)
+worker_observations = None
+
+def observe_phase(check, phase, seconds):
+    if worker_observations is not None:
+        worker_observations.append((check, phase, seconds))
+    else:
+        check_phase_duration.labels(check, phase).observe(seconds)
+
+# Observes the time spent in the block as one phase of a check run
+@contextmanager
+def timed(check, phase):
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        observe_phase(check, phase, perf_counter() - start)
+
+# Wraps a single-target probe function so every call is timed as the
+# check's 'probe' phase and counted in probes_in_flight while it runs
+def instrumented_probe(check, protocol, probe):
+    def run(target):
+        with probes_in_flight.labels(protocol).track_inprogress(), timed(check, 'probe'):
+            return probe(target)
+    return run
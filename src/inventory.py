@@ -0,0 +1,165 @@
+import csv
+import json
+import logging
+from collections import namedtuple
+from os import stat
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+logger = logging.getLogger('internet-speed')
+
+PROTOCOLS = ('HTTP', 'DNS')
+DEFAULT_PORTS = {'HTTP': 443, 'DNS': 53}
+FIELDS = ['name', 'protocol', 'host', 'port', 'scheme', 'path', 'expected_status', 'interval', 'tags']
+
+
+class InventoryError(ValueError):
+    pass
+
+
+# One validated target. `expected_status` is an inclusive (low, high) range,
+# `interval` is None to probe on every check cycle, and `tags` is a tuple.
+class Target(namedtuple('Target', FIELDS)):
+    __slots__ = ()
+
+    @property
+    def url(self):
+        default_port = 80 if self.scheme == 'http' else 443
+        netloc = self.host if self.port == default_port else f"{self.host}:{self.port}"
+        return f"{self.scheme}://{netloc}{self.path}"
+
+    def accepts(self, status_code):
+        return self.expected_status[0] <= status_code <= self.expected_status[1]
+
+
+def parse_expected_status(value):
+    if value in (None, ''):
+        return (200, 299)
+    if isinstance(value, int):
+        return (value, value)
+    low, _, high = str(value).partition('-')
+    return (int(low), int(high or low))
+
+def parse_tags(value):
+    if not value:
+        return ()
+    if isinstance(value, str):
+        value = value.replace(';', ',').split(',')
+    return tuple(sorted(str(tag).strip() for tag in value if str(tag).strip()))
+
+# Turns one raw entry (a dict from YAML/JSON/CSV) into a Target
+def parse_target(entry):
+    protocol = str(entry.get('protocol') or 'HTTP').upper()
+    if protocol not in PROTOCOLS:
+        raise InventoryError(f"unknown protocol {protocol}")
+    host = str(entry.get('host') or '').strip()
+    if not host:
+        raise InventoryError("missing host")
+    try:
+        port = int(entry.get('port') or DEFAULT_PORTS[protocol])
+        expected_status = parse_expected_status(entry.get('expected_status'))
+        interval = float(entry['interval']) if entry.get('interval') not in (None, '') else None
+    except (TypeError, ValueError) as err:
+        raise InventoryError(str(err))
+    if not 0 < port < 65536:
+        raise InventoryError(f"invalid port {port}")
+    scheme = str(entry.get('scheme') or ('http' if port == 80 else 'https')).lower()
+    path = str(entry.get('path') or '/')
+    if not path.startswith('/'):
+        path = '/' + path
+
+    name = str(entry.get('name') or '').strip()
+    if not name:
+        # Matches the labels used for HTTP_DOMAINS / DNS_DOMAINS entries
+        name = host
+        if port != DEFAULT_PORTS[protocol] and not (protocol == 'HTTP' and scheme == 'http' and port == 80):
+            name += f":{port}"
+        if protocol == 'HTTP' and path != '/':
+            name += path
+    return Target(name, protocol, host, port, scheme, path, expected_status, interval, parse_tags(entry.get('tags')))
+
+# Reads the raw entries from a .yaml/.yml, .json or .csv file
+def read_entries(file_path):
+    with open(file_path, newline='') as targets_file:
+        if file_path.endswith('.csv'):
+            return list(csv.DictReader(targets_file))
+        if file_path.endswith(('.yaml', '.yml')):
+            if yaml is None:
+                raise InventoryError("PyYAML is required for YAML target files")
+            data = yaml.safe_load(targets_file)
+        else:
+            data = json.load(targets_file)
+    if isinstance(data, dict):
+        data = data.get('targets', [])
+    if not isinstance(data, list):
+        raise InventoryError("expected a list of targets")
+    return data
+
+
+# Targets loaded from TARGETS_FILE, keyed by (protocol, name). poll()
+# re-reads the file only when its mtime or size changes and applies just
+# the difference, so the running state of unchanged targets is kept. A
+# file that fails to parse leaves the current targets in place.
+class TargetInventory:
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.targets = {}
+        self._names = {protocol: [] for protocol in PROTOCOLS}
+        self._signature = None
+
+    def _load(self):
+        loaded = {}
+        for position, entry in enumerate(read_entries(self.file_path), start=1):
+            try:
+                target = parse_target(entry)
+            except InventoryError as err:
+                logger.error(f"Skipping target {position} in {self.file_path}: {err}")
+                continue
+            if (target.protocol, target.name) in loaded:
+                logger.error(f"Duplicate {target.protocol} target {target.name} in {self.file_path}, keeping the last one.")
+            loaded[(target.protocol, target.name)] = target
+        return loaded
+
+    # Returns (added, removed, changed) lists of Targets, or None if the
+    # file has not changed since the last poll
+    def poll(self):
+        try:
+            file_stat = stat(self.file_path)
+        except OSError as err:
+            logger.error(f"Could not read targets file {self.file_path}")
+            logger.error(err)
+            return None
+        signature = (file_stat.st_mtime_ns, file_stat.st_size)
+        if signature == self._signature:
+            return None
+
+        try:
+            loaded = self._load()
+        except Exception as err:
+            logger.error(f"Failed to load targets file {self.file_path}, keeping the current targets.")
+            logger.error(err)
+            return None
+        self._signature = signature
+
+        added = [target for key, target in loaded.items() if key not in self.targets]
+        removed = [target for key, target in self.targets.items() if key not in loaded]
+        changed = [target for key, target in loaded.items() if key in self.targets and self.targets[key] != target]
+        for target in removed:
+            del self.targets[(target.protocol, target.name)]
+        for target in added + changed:
+            self.targets[(target.protocol, target.name)] = target
+        if added or removed:
+            for protocol in PROTOCOLS:
+                self._names[protocol] = [name for target_protocol, name in self.targets if target_protocol == protocol]
+        logger.info(f"Loaded targets from {self.file_path}: {len(added)} added, {len(removed)} removed, {len(changed)} changed.")
+        return added, removed, changed
+
+    def names(self, protocol):
+        return self._names[protocol]
+
+    def get(self, protocol, name):
+        return self.targets.get((protocol, name))
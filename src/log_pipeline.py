@@ -0,0 +1,84 @@
+import atexit
+import json
+import logging
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from os import register_at_fork
+from queue import SimpleQueue
+from threading import Lock
+
+
+# One JSON object per line. Fields passed as extra={'fields': {...}} (e.g.
+# a probe result) are merged into the object so they can be queried.
+class JsonLinesFormatter(logging.Formatter):
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'message': record.getMessage()
+        }
+        entry.update(getattr(record, 'fields', None) or {})
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+# Keeps one in `rate` records logged with extra={'sample_key': key}, counted
+# per key, so a target that keeps succeeding logs every `rate`-th success.
+# Records without a sample_key (failures, everything else) always pass.
+class SuccessSampler(logging.Filter):
+
+    def __init__(self, rate=1):
+        super().__init__()
+        self.rate = max(1, rate)
+        self._counts = {}
+        self._lock = Lock()
+
+    def filter(self, record):
+        key = getattr(record, 'sample_key', None)
+        if key is None or self.rate == 1:
+            return True
+        with self._lock:
+            count = self._counts.get(key, 0)
+            self._counts[key] = count + 1
+        return count % self.rate == 0
+
+
+# QueueHandler.prepare() formats the message on the logging thread so the
+# record can be pickled. This queue never leaves the process, so the record
+# is enqueued as it is and the listener's handler formats it instead.
+class DeferredQueueHandler(QueueHandler):
+
+    def prepare(self, record):
+        return record
+
+
+# Attaches `handler` to `logger`, either directly or (queued) behind a
+# DeferredQueueHandler so callers only enqueue the record and a listener
+# thread does the formatting and file I/O. Returns the listener, or None.
+def attach_handler(logger, handler, queued=False):
+    if not queued:
+        logger.addHandler(handler)
+        return None
+
+    queue = SimpleQueue()
+    queue_handler = DeferredQueueHandler(queue)
+    logger.addHandler(queue_handler)
+    listener = QueueListener(queue, handler, respect_handler_level=True)
+    listener.start()
+
+    # Flushes what is still queued at exit, unless already stopped
+    def stop_listener():
+        if listener._thread is not None:
+            listener.stop()
+
+    atexit.register(stop_listener)
+
+    # A forked worker has no listener thread; it writes directly instead
+    def log_directly():
+        logger.removeHandler(queue_handler)
+        logger.addHandler(handler)
+
+    register_at_fork(after_in_child=log_directly)
+    return listener
@@ -1,21 +1,104 @@
 import logging
+import sys
+from argparse import ArgumentParser
 from dotenv import load_dotenv
 from logging.handlers import RotatingFileHandler
-from os import path, getenv
+from os import path, getenv, strerror
 from json import loads as jsonload, JSONDecodeError
-from subprocess import run, TimeoutExpired
-from socket import create_connection
-from time import perf_counter, sleep
+from subprocess import run, TimeoutExpired, Popen, PIPE, STDOUT
+from socket import create_connection, getaddrinfo, gethostname, socket, SOCK_STREAM, SOL_SOCKET, SO_ERROR
+from selectors import DefaultSelector, EVENT_WRITE
+from errno import EINPROGRESS, EWOULDBLOCK
+from time import perf_counter, monotonic
+from concurrent.futures import ThreadPoolExecutor, wait
+from threading import Timer, Event
 from requests import get as http_get, Timeout
 from prometheus_client import start_http_server, Gauge
 
-from prometheus import collect_speedtest_metrics, collect_reachability_metrics
-
+# Load .env before the project modules, some of which read their settings
+# when they are imported
 load_dotenv()
 
+from prometheus import collect_speedtest_metrics, collect_reachability_metrics, collect_dns_query_metrics, collect_http_phase_metrics, \
+    collect_speedtest_progress, collect_speedtest_age, sync_reachability_targets, collect_probe_rate_metrics, \
+    collect_throughput_metrics, collect_throughput_probe, probes_in_flight, collect_ping_sample_metrics, \
+    collect_bufferbloat_metrics, probes_deferred, collect_target_info, remove_speedtest_metrics, \
+    probe_during_speedtest
+from dns_client import query_resolvers, summarise_query_results, supported_query_types
+from http_probe import HttpProbe
+from scheduler import Scheduler
+from speedtest_cache import SpeedtestResultCache
+from history import HistoryStore, DAY
+from exposition import CachedExposition, start_cached_http_server
+from inventory import TargetInventory, PROTOCOLS
+from adaptive import AdaptiveProbeRate
+from throughput import InterfaceRateMeter, ThroughputEstimator, ranged_download
+from supervisor import Supervisor
+from log_pipeline import JsonLinesFormatter, SuccessSampler, attach_handler
+from instrumentation import timed, instrumented_probe, observe_phase
+from profiler import SamplingProfiler
+from ping import PingSampler
+from bufferbloat import LatencyUnderLoad
+from coordination import LinkCoordinator
+from push import Pusher, Spool
+from agent import SiteAgent
+from aggregator import Aggregator
+
 log_filename = getenv("LOGS_FILE_PATH" ,'/var/log/internet-speed/internet-speed.log')
+log_queue = getenv("LOG_QUEUE", "false").lower() == "true"
+log_format = getenv("LOG_FORMAT", "text")
+log_probe_results = getenv("LOG_PROBE_RESULTS", "false").lower() == "true"
+log_success_sample = int(getenv("LOG_SUCCESS_SAMPLE", "1"))
 http_domains = getenv("HTTP_DOMAINS", "bbc.co.uk,google.co.uk,apple.com")
 dns_domains = getenv("DNS_DOMAINS", "1.1.1.1,8.8.8.8")
+http_concurrency = int(getenv("HTTP_CONCURRENCY", "10"))
+http_check_deadline = float(getenv("HTTP_CHECK_DEADLINE", "60"))
+http_probe_method = getenv("HTTP_PROBE_METHOD", "get").lower()
+speedtest_mode = getenv("SPEEDTEST_MODE", "json")
+speedtest_server_ids = getenv("SPEEDTEST_SERVER_IDS", "23968,40628,72004")
+speedtest_server_mode = getenv("SPEEDTEST_SERVER_MODE", "any")
+speedtest_interval = float(getenv("SPEEDTEST_INTERVAL", "900"))
+speedtest_jitter = float(getenv("SPEEDTEST_JITTER", "0"))
+http_interval = float(getenv("HTTP_INTERVAL", "300"))
+http_jitter = float(getenv("HTTP_JITTER", "0"))
+dns_interval = float(getenv("DNS_INTERVAL", "300"))
+dns_jitter = float(getenv("DNS_JITTER", "0"))
+history_db_path = getenv("HISTORY_DB_PATH", "")
+speedtest_state_file = getenv("SPEEDTEST_STATE_FILE", "")
+worker_timeout = float(getenv("WORKER_TIMEOUT", "120"))
+profiler_enabled = getenv("PROFILER_ENABLED", "false").lower() == "true"
+worker_max_rss_mb = float(getenv("WORKER_MAX_RSS_MB", "256"))
+worker_max_cpu_seconds = int(getenv("WORKER_MAX_CPU_SECONDS", "60"))
+metrics_precomputed = getenv("METRICS_PRECOMPUTED", "false").lower() == "true"
+metrics_max_age = float(getenv("METRICS_MAX_AGE", "15"))
+dns_check_mode = getenv("DNS_CHECK_MODE", "sequential")
+dns_query_names = getenv("DNS_QUERY_NAMES", "google.com")
+dns_query_types = getenv("DNS_QUERY_TYPES", "A,AAAA")
+targets_file = getenv("TARGETS_FILE", "")
+targets_reload_interval = float(getenv("TARGETS_RELOAD_INTERVAL", "30"))
+probe_adaptive = getenv("PROBE_ADAPTIVE", "false").lower() == "true"
+throughput_estimation = getenv("THROUGHPUT_ESTIMATION", "false").lower() == "true"
+throughput_sample_interval = float(getenv("THROUGHPUT_SAMPLE_INTERVAL", "5"))
+throughput_interfaces = getenv("THROUGHPUT_INTERFACES", "")
+throughput_probe_url = getenv("THROUGHPUT_PROBE_URL", "")
+throughput_probe_bytes = int(getenv("THROUGHPUT_PROBE_BYTES", "1048576"))
+throughput_probe_interval = float(getenv("THROUGHPUT_PROBE_INTERVAL", "300"))
+ping_targets = getenv("PING_TARGETS", "")
+ping_publish_interval = float(getenv("PING_PUBLISH_INTERVAL", "5"))
+ping_quantiles = [float(q) for q in getenv("PING_QUANTILES", "0.5,0.9,0.99").split(',') if q.strip()]
+ping_timeout = float(getenv("PING_TIMEOUT", "1"))
+ping_mode = getenv("PING_MODE", "auto").lower()
+ping_udp_port = int(getenv("PING_UDP_PORT", "7"))
+bufferbloat_targets = getenv("BUFFERBLOAT_TARGETS", "")
+probe_defer_max = float(getenv("PROBE_DEFER_MAX", "300"))
+push_url = getenv("PUSH_URL", "")
+push_interval = float(getenv("PUSH_INTERVAL", "60"))
+push_spool_dir = getenv("PUSH_SPOOL_DIR", "")
+# Without a directory the spool is lost on restart and shares the process's
+# memory, so it is kept much smaller
+push_spool_max_mb = float(getenv("PUSH_SPOOL_MAX_MB", "64" if push_spool_dir else "8"))
+aggregator_address = getenv("AGGREGATOR_ADDRESS", "")
+agent_serve_metrics = getenv("AGENT_SERVE_METRICS", "false").lower() == "true"
 
 logger = logging.getLogger('internet-speed')
 logger.setLevel(logging.INFO)
@@ -28,9 +111,112 @@ handler = RotatingFileHandler(
 )
 handler.setLevel(logging.INFO)
 
-formatter = logging.Formatter('%(asctime)s %(levelname)s: %(message)s')
+if log_format == 'json':
+    formatter = JsonLinesFormatter()
+else:
+    formatter = logging.Formatter('%(asctime)s %(levelname)s: %(message)s')
 handler.setFormatter(formatter)
-logger.addHandler(handler)
+# On the logger rather than the handler so sampled-out records are dropped
+# before they are queued or formatted
+logger.addFilter(SuccessSampler(log_success_sample))
+# With LOG_QUEUE the checks only enqueue records; a listener thread writes them
+log_listener = attach_handler(logger, handler, queued=log_queue)
+
+# Latest result per speedtest server; by default a result is kept until
+# every server has had two chances to be re-measured
+speedtest_results = SpeedtestResultCache(float(getenv(
+    "SPEEDTEST_RESULT_MAX_AGE",
+    str(2 * speedtest_interval * len(speedtest_server_ids.split(',')))
+)))
+speedtest_round_robin = 0
+
+# On-disk history of every result, disabled unless HISTORY_DB_PATH is set
+history = HistoryStore(
+    history_db_path,
+    raw_retention=float(getenv("HISTORY_RAW_RETENTION_DAYS", "7")) * DAY,
+    hourly_retention=float(getenv("HISTORY_HOURLY_RETENTION_DAYS", "90")) * DAY,
+    daily_retention=float(getenv("HISTORY_DAILY_RETENTION_DAYS", "1825")) * DAY
+) if history_db_path else None
+
+# Per-target settings from TARGETS_FILE, which replaces HTTP_DOMAINS and
+# DNS_DOMAINS when set
+inventory = TargetInventory(targets_file) if targets_file else None
+if inventory:
+    inventory.poll()
+    collect_target_info(list(inventory.targets.values()))
+last_probed = {}
+
+# Per-target probe intervals when PROBE_ADAPTIVE is set
+adaptive_rates = {
+    protocol: AdaptiveProbeRate(
+        confirm_interval=float(getenv("PROBE_CONFIRM_INTERVAL", "15")),
+        max_interval=float(getenv("PROBE_MAX_INTERVAL", "1800")),
+        healthy_window=int(getenv("PROBE_HEALTHY_WINDOW", "5")),
+        confirm_probes=int(getenv("PROBE_CONFIRM_PROBES", "3"))
+    ) for protocol in PROTOCOLS
+} if probe_adaptive else None
+check_intervals = {'HTTP': http_interval, 'DNS': dns_interval}
+check_jitters = {'HTTP': http_jitter, 'DNS': dns_jitter}
+
+# Passive link usage between full speedtests when THROUGHPUT_ESTIMATION is
+# set; speedtest_trigger is set to run a speedtest now by the scheduler
+throughput_estimator = ThroughputEstimator(
+    threshold=float(getenv("THROUGHPUT_TRIGGER_THRESHOLD", "0.3")),
+    cooldown=float(getenv("THROUGHPUT_TRIGGER_COOLDOWN", "600"))
+) if throughput_estimation else None
+interface_rate_meter = InterfaceRateMeter(
+    interfaces=[interface.strip() for interface in throughput_interfaces.split(',') if interface.strip()] or None
+)
+speedtest_trigger = None
+
+# Continuous pings to PING_TARGETS, started with the checks
+ping_sampler = PingSampler(
+    [target.strip() for target in ping_targets.split(',') if target.strip()],
+    rate=float(getenv("PING_RATE", "5")),
+    window=float(getenv("PING_WINDOW", "60")),
+    timeout=ping_timeout,
+    mode=ping_mode,
+    udp_port=ping_udp_port
+) if ping_targets else None
+
+# High-rate pings around each speedtest when BUFFERBLOAT_TARGETS is set
+latency_under_load = LatencyUnderLoad(
+    [target.strip() for target in bufferbloat_targets.split(',') if target.strip()],
+    rate=float(getenv("BUFFERBLOAT_RATE", "10")),
+    idle_seconds=float(getenv("BUFFERBLOAT_IDLE_SECONDS", "3")),
+    timeout=ping_timeout,
+    mode=ping_mode,
+    udp_port=ping_udp_port
+) if bufferbloat_targets else None
+
+# Busy while a speedtest runs; HTTP/DNS checks wait for it to finish with
+# PROBE_DURING_SPEEDTEST=defer and are marked during_speedtest otherwise
+link_coordinator = LinkCoordinator()
+
+# Pushes every metric to PUSH_URL each PUSH_INTERVAL, spooling batches
+# while the receiver is unreachable
+pusher = Pusher(
+    push_url,
+    getenv("PUSH_FORMAT", "remote_write").lower(),
+    spool=Spool(push_spool_dir or None, max_bytes=push_spool_max_mb * 1024 * 1024),
+    job=getenv("PUSH_JOB", "internet-speed"),
+    instance=getenv("PUSH_INSTANCE", "") or None
+) if push_url else None
+
+# Streams every result to the aggregator at AGGREGATOR_ADDRESS (host:port)
+aggregator_host, _, aggregator_port = aggregator_address.rpartition(':')
+site_agent = SiteAgent(
+    aggregator_host.strip('[]'),
+    int(aggregator_port),
+    getenv("AGENT_SITE", "") or gethostname(),
+    max_queue=int(getenv("AGENT_QUEUE_SIZE", "10000"))
+) if aggregator_address else None
+
+# Worker processes for the checks, only with --supervised
+supervisor = None
+
+# Pooled probe engine used when HTTP_PROBE_METHOD is 'head' or 'stream'
+http_probe = HttpProbe(method='HEAD' if http_probe_method == 'head' else 'GET', timeout=3)
 
 speedtest_duration_milliseconds = Gauge('speedtest_duration_milliseconds', 'Time taken to run speedtest in ms')
 http_check_duration_milliseconds = Gauge('http_check_duration_milliseconds', 'Time taken to run HTTP checks in ms')
@@ -40,19 +226,26 @@ dns_check_duration_milliseconds = Gauge('dns_check_duration_milliseconds', 'Time
 def convert_bps_to_Mbps(bytes_per_second):
     return bytes_per_second / 125000
 
-def run_speedtest():
-    run_args = ["speedtest", "--format=json", "--server-id=23968,40628,72004"]
+def speedtest_args(output_format="json", server_ids=None):
+    run_args = ["speedtest", f"--format={output_format}"]
+    if server_ids or speedtest_server_ids:
+        run_args.append(f"--server-id={server_ids or speedtest_server_ids}")
     if (not path.exists('../.config/ookla/speedtest-cli.json')):
         run_args += ["--accept-license", "--accept-gdpr"]
+    return run_args
+
+def run_speedtest(server_ids=None):
+    run_args = speedtest_args(server_ids=server_ids)
     try:
         logger.info('Running speed test...')
-        output_bytes = run(
-                run_args, 
-                capture_output=True,
-                timeout=60,
-                check=True
-            ).stdout
-        logger.debug(f"output_bytes: {output_bytes}")
+        with timed('speedtest', 'subprocess'):
+            output_bytes = run(
+                    run_args, 
+                    capture_output=True,
+                    timeout=60,
+                    check=True
+                ).stdout
+        logger.debug("output_bytes: %s", output_bytes)
     except TimeoutExpired:
         logger.error("Speedtest took too long.")
         return {}
@@ -64,17 +257,105 @@ def run_speedtest():
     
     logger.info('Starting data processing...')
     try:
-        output = jsonload(output_bytes.decode('utf-8'))
-        logger.debug(f"Decoded JSON: {output}")
+        with timed('speedtest', 'parse'):
+            output = parse_speedtest_output(jsonload(output_bytes.decode('utf-8')))
+        logger.debug("Decoded JSON: %s", output)
     except JSONDecodeError:
         logger.error("Failed to parse speedtest output")
         return {}
 
+    logger.info('Finished speedtest.')
+    return output
+
+# Runs the speedtest with --format=jsonl --progress=yes and reads stdout a
+# line at a time. Progress events update the live gauges while the test
+# runs and are folded into the final result as they arrive, so the full
+# output is never held in memory. on_phase is called with 'download' or
+# 'upload' as each progress event arrives.
+def run_speedtest_streaming(timeout=60, server_ids=None, on_phase=None):
+    run_args = speedtest_args("jsonl", server_ids) + ["--progress=yes"]
+    try:
+        logger.info('Running streaming speed test...')
+        with timed('speedtest', 'spawn'):
+            process = Popen(run_args, stdout=PIPE, stderr=STDOUT, text=True)
+    except Exception as err:
+        logger.error("Speedtest failed.")
+        logger.error(err)
+        return {}
+
+    timed_out = Event()
+
+    def kill():
+        timed_out.set()
+        process.kill()
+
+    timer = Timer(timeout, kill)
+    timer.start()
+    output = {}
+    try:
+        subprocess_start = perf_counter()
+        for line in process.stdout:
+            try:
+                event = jsonload(line)
+            except JSONDecodeError:
+                event = None
+            # stderr is merged in, so a line may be plain text or a bare value
+            if not isinstance(event, dict):
+                logger.error(f"Speedtest: {line.strip()}")
+                continue
+            logger.debug("Speedtest event: %s", event)
+            fold_speedtest_event(output, event)
+            if on_phase and event.get('type') in ('download', 'upload'):
+                on_phase(event['type'])
+        process.wait()
+        observe_phase('speedtest', 'subprocess', perf_counter() - subprocess_start)
+    finally:
+        timer.cancel()
+        # Never leave the speedtest saturating the link if reading failed
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        process.stdout.close()
+
+    if timed_out.is_set():
+        logger.error("Speedtest took too long.")
+        return {}
+    if process.returncode != 0:
+        logger.error("Speedtest failed.")
+        return {}
+    if output.get('type') != 'result':
+        logger.error("Speedtest finished without a result.")
+        return {}
+
+    logger.info('Finished speedtest.')
+    return parse_speedtest_output(output)
+
+# Folds one jsonl event into the result being built and updates the
+# live progress gauges. The final 'result' event carries every field.
+def fold_speedtest_event(output, event):
+    event_type = event.get('type')
+    if event_type in ('ping', 'download', 'upload'):
+        phase = event.get(event_type, {})
+        output[event_type] = phase
+        bandwidth = phase.get('bandwidth')
+        collect_speedtest_progress(
+            event_type,
+            phase.get('progress'),
+            convert_bps_to_Mbps(bandwidth) if bandwidth is not None else None
+        )
+    elif event_type == 'testStart':
+        for key in ('isp', 'interface', 'server'):
+            if key in event:
+                output[key] = event[key]
+    elif event_type == 'result':
+        output.update(event)
+
+# Converts decoded speedtest JSON into the dict used by collect_speedtest_metrics
+def parse_speedtest_output(output):
     ping = output.get('ping', {})
     download = output.get('download', {})
     upload = output.get('upload', {})
     server = output.get('server', {})
-    logger.info('Finished speedtest.')
     return {
             'timestamp' : output.get('timestamp', None),
             'ping': {
@@ -99,44 +380,169 @@ def run_speedtest():
             'isp': output.get('isp', None),
             'external_ip' : output.get('interface', {}).get('externalIp', None),
             'server' : {
+                'id' : server.get('id', None),
                 'name' : server.get('name', None),
                 'location' : server.get('location', None)
             }
         }
 
-# Takes in a comma separated list of domains e.g.
-# "bbc.co.uk,google.co.uk,apple.com"
-def run_http_reachability_checks(domains):
-    logger.info('Starting HTTP reachability checks...')
-    domain_checks = {}
-    for domain in domains.split(','):
-        domain = domain.strip()
-        logger.debug(f"Domain: {domain}")
-        try:
-            start_time = perf_counter()
-            response = http_get(f"https://{domain}", timeout=3)
-            response_time = perf_counter() - start_time
-            logger.debug(f"Response for {domain}: {response}")
-        except Timeout:
-            logger.error(f"Request timed out for {domain}.")
-            domain_checks[domain] = {
-                'reachable': False,
-                'response_time_ms': None
-            }
-            continue
-        except Exception as err:
-            logger.error(f"Request failed for {domain}.")
-            logger.error(err)
-            domain_checks[domain] = {
+# Takes in a comma separated string (or a list) of targets and
+# returns the stripped, non-empty, de-duplicated entries in order
+def split_targets(targets):
+    if isinstance(targets, str):
+        targets = targets.split(',')
+    return list(dict.fromkeys(target.strip() for target in targets if target.strip()))
+
+# HTTP_DOMAINS / DNS_DOMAINS are only split once, at startup
+env_targets = {'HTTP': split_targets(http_domains), 'DNS': split_targets(dns_domains)}
+# As are DNS_QUERY_TYPES, which are checked against the types dns_client knows
+dns_query_types = supported_query_types(split_targets(dns_query_types))
+
+# Names of every configured target for a protocol
+def configured_targets(protocol):
+    if inventory:
+        return inventory.names(protocol)
+    return env_targets[protocol]
+
+# A target's own interval from TARGETS_FILE, else the protocol's interval
+def base_interval(protocol, name):
+    target = inventory.get(protocol, name) if inventory else None
+    return target.interval if target and target.interval else check_intervals[protocol]
+
+# (interval, jitter) the protocol's check runs on. With PROBE_ADAPTIVE it
+# runs every PROBE_CONFIRM_INTERVAL and only probes the targets that are due.
+def check_schedule(protocol):
+    if adaptive_rates:
+        confirm_interval = adaptive_rates[protocol].confirm_interval
+        return confirm_interval, min(check_jitters[protocol], confirm_interval / 2)
+    return check_intervals[protocol], check_jitters[protocol]
+
+# Targets to probe this cycle. Targets with their own interval in
+# TARGETS_FILE are skipped until it has passed (with a second of slack
+# for scheduling jitter); everything else is probed every cycle.
+def due_targets(protocol, now=None):
+    if adaptive_rates:
+        base_intervals = {name: base_interval(protocol, name) for name in configured_targets(protocol)}
+        return adaptive_rates[protocol].due(base_intervals, now)
+    if not inventory:
+        return env_targets[protocol]
+    now = monotonic() if now is None else now
+    due = []
+    for name in inventory.names(protocol):
+        interval = inventory.get(protocol, name).interval
+        last = last_probed.get((protocol, name))
+        if interval is None or last is None or now - last >= interval - 1:
+            last_probed[(protocol, name)] = now
+            due.append(name)
+    return due
+
+# (host, port) to connect to for a target name
+def target_address(protocol, name, default_port):
+    target = inventory.get(protocol, name) if inventory else None
+    return (target.host, target.port) if target else (name, default_port)
+
+# Re-reads TARGETS_FILE if it changed and drops the metrics of removed targets
+def reload_targets():
+    changes = inventory.poll()
+    if not changes:
+        return
+    added, removed, changed = changes
+    collect_target_info(added + changed)
+    for target in removed:
+        last_probed.pop((target.protocol, target.name), None)
+        if adaptive_rates:
+            adaptive_rates[target.protocol].forget(target.name)
+    for protocol in PROTOCOLS:
+        sync_reachability_targets(protocol, inventory.names(protocol))
+    # Workers loaded the targets file when they started
+    if supervisor:
+        supervisor.restart('http', "targets changed")
+        supervisor.restart('dns', "targets changed")
+
+# Runs check(target) for every target on a pool of at most `concurrency`
+# threads. Targets that have not finished by `deadline` seconds are
+# reported as unreachable so a few dead targets cannot overrun the cycle.
+def run_concurrently(check, targets, concurrency, deadline):
+    results = {}
+    if not targets:
+        return results
+    executor = ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(targets))))
+    futures = {target: executor.submit(check, target) for target in targets}
+    done, _ = wait(futures.values(), timeout=deadline)
+    executor.shutdown(wait=False, cancel_futures=True)
+    for target, future in futures.items():
+        if future in done:
+            results[target] = future.result()
+        else:
+            logger.error(f"Check for {target} did not finish within {deadline}s.")
+            results[target] = {
                 'reachable': False,
                 'response_time_ms': None
             }
-            continue
+    return results
+
+# Probes a domain with the pooled engine and keeps the per-phase timings
+def probe_http_domain(domain):
+    logger.debug("Domain: %s", domain)
+    target = inventory.get('HTTP', domain) if inventory else None
+    try:
+        result = http_probe.probe(target.url if target else f"https://{domain}")
+        logger.debug("Probe result for %s: %s", domain, result)
+    except Exception as err:
+        logger.error(f"Request failed for {domain}.")
+        logger.error(err)
+        return {
+            'reachable': False,
+            'response_time_ms': None
+        }
+
+    return {
+        'reachable': target.accepts(result['status_code']) if target else 200 <= result['status_code'] < 300,
+        'response_time_ms': result['response_time_ms'],
+        'phases': result['phases']
+    }
 
-        domain_checks[domain] = {
-            'reachable': 200 <= response.status_code < 300,
-            'response_time_ms': response_time * 1_000
+def check_http_domain(domain):
+    if http_probe_method != 'get':
+        return probe_http_domain(domain)
+    logger.debug("Domain: %s", domain)
+    target = inventory.get('HTTP', domain) if inventory else None
+    try:
+        start_time = perf_counter()
+        response = http_get(target.url if target else f"https://{domain}", timeout=3)
+        response_time = perf_counter() - start_time
+        logger.debug("Response for %s: %s", domain, response)
+    except Timeout:
+        logger.error(f"Request timed out for {domain}.")
+        return {
+            'reachable': False,
+            'response_time_ms': None
         }
+    except Exception as err:
+        logger.error(f"Request failed for {domain}.")
+        logger.error(err)
+        return {
+            'reachable': False,
+            'response_time_ms': None
+        }
+
+    return {
+        'reachable': target.accepts(response.status_code) if target else 200 <= response.status_code < 300,
+        'response_time_ms': response_time * 1_000
+    }
+
+# Takes in a comma separated list of domains e.g.
+# "bbc.co.uk,google.co.uk,apple.com"
+# Domains are probed concurrently (HTTP_CONCURRENCY workers) and the
+# whole cycle is bounded by HTTP_CHECK_DEADLINE seconds.
+def run_http_reachability_checks(domains, concurrency=None, deadline=None):
+    logger.info('Starting HTTP reachability checks...')
+    domain_checks = run_concurrently(
+        instrumented_probe('http', 'HTTP', check_http_domain),
+        split_targets(domains),
+        concurrency or http_concurrency,
+        deadline or http_check_deadline
+    )
     logger.info('Finished HTTP reachability checks.')
     return domain_checks
 
@@ -144,63 +550,453 @@ def run_http_reachability_checks(domains):
 # "1.1.1.1,8.8.8.8,192.168.1.111"
 def run_dns_reachability_checks(ip_addrs):
     logger.info('Starting DNS reachability checks...')
+    check = instrumented_probe('dns', 'DNS', check_dns_connect)
+    ip_checks = {ip_addr: check(ip_addr) for ip_addr in split_targets(ip_addrs)}
+    logger.info('Finished DNS reachability checks.')
+    return ip_checks
+
+def check_dns_connect(ip_addr):
+    logger.debug("IP Address: %s", ip_addr)
+    try:
+        start_time = perf_counter()
+        response = create_connection(target_address('DNS', ip_addr, 53), timeout=3)
+        response_time = perf_counter() - start_time
+        response.close()
+        logger.debug("Response: %s", response)
+    except TimeoutError:
+        logger.error(f"Request timed out for {ip_addr}.")
+        return {
+            'reachable': False,
+            'response_time_ms': None
+        }
+    except Exception as err:
+        logger.error(f"Request failed for {ip_addr}")
+        logger.error(err)
+        return {
+            'reachable': False,
+            'response_time_ms': None
+        }
+
+    return {
+        'reachable': True,
+        'response_time_ms': response_time * 1_000
+    }
+
+
+# Same checks as run_dns_reachability_checks, but every connection is
+# opened at once with non-blocking sockets and driven from one selector
+# loop, so the whole cycle takes at most `timeout` seconds.
+def run_dns_reachability_checks_parallel(ip_addrs, port=53, timeout=3):
+    logger.info('Starting parallel DNS reachability checks...')
     ip_checks = {}
-    for ip_addr in ip_addrs.split(','):
-        ip_addr = ip_addr.strip()
-        logger.debug(f"IP Address: {ip_addr}")
+    selector = DefaultSelector()
+    for ip_addr in split_targets(ip_addrs):
+        ip_checks[ip_addr] = {
+            'reachable': False,
+            'response_time_ms': None
+        }
+        sock = None
         try:
+            family, sock_type, proto, _, address = getaddrinfo(*target_address('DNS', ip_addr, port), type=SOCK_STREAM)[0]
+            sock = socket(family, sock_type, proto)
+            sock.setblocking(False)
             start_time = perf_counter()
-            response = create_connection((ip_addr, 53), timeout=3)
-            response_time = perf_counter() - start_time
-            response.close()
-            logger.debug(f"Response: {response}")
-        except TimeoutError:
-            logger.error(f"Request timed out for {ip_addr}.")
-            ip_checks[ip_addr] = {
-                'reachable': False,
-                'response_time_ms': None
-            }
-            continue
+            err = sock.connect_ex(address)
+            if err not in (0, EINPROGRESS, EWOULDBLOCK):
+                raise OSError(err, strerror(err))
+            selector.register(sock, EVENT_WRITE, (ip_addr, start_time))
+            probes_in_flight.labels('DNS').inc()
         except Exception as err:
             logger.error(f"Request failed for {ip_addr}")
             logger.error(err)
-            ip_checks[ip_addr] = {
-                'reachable': False,
-                'response_time_ms': None
-            }
-            continue
+            if sock is not None:
+                sock.close()
 
-        ip_checks[ip_addr] = {
+    deadline = perf_counter() + timeout
+    while selector.get_map():
+        remaining = deadline - perf_counter()
+        if remaining <= 0:
+            break
+        for key, _ in selector.select(remaining):
+            ip_addr, start_time = key.data
+            response_time = perf_counter() - start_time
+            selector.unregister(key.fileobj)
+            probes_in_flight.labels('DNS').dec()
+            observe_phase('dns', 'probe', response_time)
+            err = key.fileobj.getsockopt(SOL_SOCKET, SO_ERROR)
+            key.fileobj.close()
+            if err:
+                logger.error(f"Request failed for {ip_addr}")
+                logger.error(strerror(err))
+                continue
+            ip_checks[ip_addr] = {
                 'reachable': True,
                 'response_time_ms': response_time * 1_000
             }
-    logger.info('Finished DNS reachability checks.')
+
+    for key in list(selector.get_map().values()):
+        ip_addr, _ = key.data
+        logger.error(f"Request timed out for {ip_addr}.")
+        selector.unregister(key.fileobj)
+        probes_in_flight.labels('DNS').dec()
+        observe_phase('dns', 'probe', timeout)
+        key.fileobj.close()
+    selector.close()
+    logger.info('Finished parallel DNS reachability checks.')
     return ip_checks
 
+# Sends real A/AAAA queries for DNS_QUERY_NAMES to each resolver and
+# returns the per-query results from dns_client.query_resolvers
+def run_dns_query_checks(ip_addrs, names=None, query_types=None, port=53, timeout=3):
+    logger.info('Starting DNS query checks...')
+    resolvers = split_targets(ip_addrs)
+    query_results = query_resolvers(
+        resolvers,
+        split_targets(names or dns_query_names),
+        supported_query_types(split_targets(query_types)) if query_types else dns_query_types,
+        port=port,
+        timeout=timeout,
+        addresses={resolver: target_address('DNS', resolver, port) for resolver in resolvers}
+    )
+    logger.debug("DNS query results: %s", query_results)
+    logger.info('Finished DNS query checks.')
+    return query_results
+
+# Runs the DNS checks in the mode selected by DNS_CHECK_MODE
+def run_dns_checks(ip_addrs):
+    if dns_check_mode == 'parallel':
+        return run_dns_reachability_checks_parallel(ip_addrs)
+    return run_dns_reachability_checks(ip_addrs)
 
-if __name__ == "__main__":
 
-    start_http_server(8000)
+# Returns the server ID groups to test this cycle for SPEEDTEST_SERVER_MODE:
+#   any         - one test, the CLI picks one of the configured servers
+#   each        - one test per configured server
+#   round-robin - one test per cycle, moving to the next server each cycle
+# Without any SPEEDTEST_SERVER_IDS every mode is one test on the server the
+# CLI selects itself.
+def next_speedtest_servers():
+    global speedtest_round_robin
+    server_ids = split_targets(speedtest_server_ids)
+    if not server_ids:
+        return [None]
+    if speedtest_server_mode == 'each':
+        return server_ids
+    if speedtest_server_mode == 'round-robin':
+        server_id = server_ids[speedtest_round_robin % len(server_ids)]
+        speedtest_round_robin += 1
+        return [server_id]
+    return [','.join(server_ids)]
 
-    # Speedtest runs every 3rd iteration (15 min), HTTP/DNS checks run every iteration (5 min)
-    i = 0
-    while True:
-        if i == 0:
-            start = perf_counter()
-            internet_speed = run_speedtest()
-            speedtest_duration_milliseconds.set((perf_counter() - start) * 1_000)
+# One record per probe result when LOG_PROBE_RESULTS is set; successes are
+# sampled per target by LOG_SUCCESS_SAMPLE
+def log_probe_result_lines(protocol, checks):
+    for target, result in checks.items():
+        reachable = result['reachable']
+        logger.info(
+            "%s probe of %s: %s in %s ms", protocol, target, 'available' if reachable else 'unavailable', result['response_time_ms'],
+            extra={
+                'fields': {'protocol': protocol, 'target': target, 'reachable': reachable, 'response_time_ms': result['response_time_ms'],
+                           'during_speedtest': result.get('during_speedtest', False)},
+                'sample_key': (protocol, target) if reachable else None
+            }
+        )
+
+# Feeds probe results into the adaptive per-target intervals
+def adapt_probe_rates(protocol, checks):
+    probe_rates = {
+        name: adaptive_rates[protocol].record(name, result['reachable'], base_interval(protocol, name))
+        for name, result in checks.items()
+    }
+    collect_probe_rate_metrics(protocol, probe_rates)
+
+# The publish_* functions take the output of one run of a check and
+# export it (metrics, result cache, history). They are shared by every
+# way of running the checks.
+def publish_speedtest_result(internet_speed, duration_ms):
+    speedtest_duration_milliseconds.set(duration_ms)
+    speedtest_results.add(internet_speed)
+    if site_agent:
+        site_agent.send_speedtest(internet_speed)
+    if latency_under_load and internet_speed.get('bufferbloat'):
+        collect_bufferbloat_metrics(internet_speed['bufferbloat'])
+    save_speedtest_state()
+    if throughput_estimator:
+        throughput_estimator.set_capacity(
+            internet_speed.get('download', {}).get('download_speed'),
+            internet_speed.get('upload', {}).get('upload_speed')
+        )
+    if history:
+        with timed('speedtest', 'history'):
+            history.record_speedtest(internet_speed)
+            history.flush()
+
+# Called as each speedtest starts. The start is saved as the last run
+# straight away, so a crash during the test does not re-run it at once on
+# restart; publish_speedtest_result then saves the result.
+def speedtest_started():
+    if throughput_estimator:
+        throughput_estimator.speedtest_started()
+    save_speedtest_state(last_run=speedtest_results.clock())
+
+def save_speedtest_state(last_run=None):
+    if not speedtest_state_file:
+        return
+    try:
+        speedtest_results.save(speedtest_state_file, last_run=last_run)
+    except Exception as err:
+        logger.error(f"Could not save speedtest state to {speedtest_state_file}.")
+        logger.error(err)
+
+def export_speedtest_results():
+    with timed('speedtest', 'collect'):
+        for server_name, server_location in speedtest_results.expire():
+            remove_speedtest_metrics(server_name, server_location)
+        for age, internet_speed in speedtest_results.fresh():
             collect_speedtest_metrics(internet_speed)
-        
-        http_start = perf_counter()
-        http_reachability_checks = run_http_reachability_checks(http_domains)
-        http_check_duration_milliseconds.set((perf_counter() - http_start) * 1_000)
+            collect_speedtest_age(internet_speed, age)
+
+# Re-exports the results saved in SPEEDTEST_STATE_FILE and returns the
+# seconds to wait before the first speedtest, so a restart (or a crash
+# loop) does not run speedtests ahead of SPEEDTEST_INTERVAL
+def restore_speedtest_state():
+    if not speedtest_state_file:
+        return 0
+    last_run = speedtest_results.load(speedtest_state_file)
+    export_speedtest_results()
+    if last_run is None:
+        return 0
+    delay = min(max(0, speedtest_interval - (speedtest_results.clock() - last_run)), speedtest_interval)
+    if delay:
+        logger.info(f"Last speedtest ran {speedtest_interval - delay:.0f}s ago, waiting {delay:.0f}s for the next one.")
+    return delay
+
+def publish_http_checks(http_reachability_checks, duration_ms):
+    http_check_duration_milliseconds.set(duration_ms)
+    with timed('http', 'collect'):
+        sync_reachability_targets("HTTP", configured_targets("HTTP"))
         collect_reachability_metrics("HTTP", http_reachability_checks)
+        collect_http_phase_metrics(http_reachability_checks)
+    if site_agent:
+        site_agent.send_reachability("HTTP", http_reachability_checks)
+    if log_probe_results:
+        log_probe_result_lines("HTTP", http_reachability_checks)
+    if adaptive_rates:
+        adapt_probe_rates("HTTP", http_reachability_checks)
+    if history:
+        with timed('http', 'history'):
+            history.record_reachability("HTTP", http_reachability_checks)
+            history.flush()
 
-        dns_start = perf_counter()
-        dns_reachability_checks = run_dns_reachability_checks(dns_domains)
-        dns_check_duration_milliseconds.set((perf_counter() - dns_start) * 1_000)
+# dns_query_results is only set in DNS_CHECK_MODE=query
+def publish_dns_checks(dns_reachability_checks, duration_ms, dns_query_results=None):
+    dns_check_duration_milliseconds.set(duration_ms)
+    with timed('dns', 'collect'):
+        if dns_query_results is not None:
+            collect_dns_query_metrics(dns_query_results)
+        sync_reachability_targets("DNS", configured_targets("DNS"))
         collect_reachability_metrics("DNS", dns_reachability_checks)
+    if site_agent:
+        site_agent.send_reachability("DNS", dns_reachability_checks)
+    if log_probe_results:
+        log_probe_result_lines("DNS", dns_reachability_checks)
+    if adaptive_rates:
+        adapt_probe_rates("DNS", dns_reachability_checks)
+    if history:
+        with timed('dns', 'history'):
+            history.record_reachability("DNS", dns_reachability_checks)
+            history.flush()
+
+# The measure_* functions do the network side of one check run and return
+# plain data, so they can run in this process or in a supervised worker
+def measure_speedtest(server_ids):
+    if latency_under_load:
+        return measure_speedtest_under_load(server_ids)
+    if speedtest_mode == 'jsonl':
+        return run_speedtest_streaming(server_ids=server_ids)
+    return run_speedtest(server_ids=server_ids)
+
+# Pings BUFFERBLOAT_TARGETS for the whole speedtest and adds the per-phase
+# latency to the result. Without the streaming events there are no
+# download/upload phases, so the test is one 'loaded' phase.
+def measure_speedtest_under_load(server_ids):
+    with latency_under_load.measuring():
+        if speedtest_mode == 'jsonl':
+            internet_speed = run_speedtest_streaming(server_ids=server_ids, on_phase=latency_under_load.set_phase)
+        else:
+            latency_under_load.set_phase('loaded')
+            internet_speed = run_speedtest(server_ids=server_ids)
+    if internet_speed:
+        internet_speed['bufferbloat'] = latency_under_load.result(ping_quantiles)
+    return internet_speed
+
+def measure_http(domains):
+    return run_http_reachability_checks(domains)
+
+# Returns (reachability checks, DNS query results or None)
+def measure_dns(ip_addrs):
+    if dns_check_mode == 'query':
+        dns_query_results = run_dns_query_checks(ip_addrs)
+        return summarise_query_results(dns_query_results), dns_query_results
+    return run_dns_checks(ip_addrs), None
+
+# Runs a measure_* function here, or in its worker process with
+# --supervised. Returns None if the worker failed.
+def measure(name, func, argument):
+    if supervisor is None:
+        return func(argument)
+    return supervisor.call(name, argument)
+
+# Holds a check run back while a speedtest is running when deferring, for
+# at most PROBE_DEFER_MAX seconds. Returns a mark for mark_during_speedtest.
+def wait_for_link(protocol):
+    if probe_during_speedtest == 'defer' and link_coordinator.is_busy():
+        logger.info(f"Deferring {protocol} checks until the speedtest finishes.")
+        probes_deferred.labels(protocol).inc()
+        if not link_coordinator.wait_until_idle(probe_defer_max):
+            logger.warning(f"Speedtest still running after {probe_defer_max}s, running {protocol} checks anyway.")
+    return link_coordinator.mark()
+
+def mark_during_speedtest(checks, mark):
+    if link_coordinator.overlapped(mark):
+        for check in checks.values():
+            check['during_speedtest'] = True
+    return checks
+
+def unreachable_checks(targets):
+    return {target: {'reachable': False, 'response_time_ms': None} for target in targets}
+
+def speedtest_check():
+    for server_ids in next_speedtest_servers():
+        speedtest_started()
+        start = perf_counter()
+        with link_coordinator.busy():
+            internet_speed = measure('speedtest', measure_speedtest, server_ids) or {}
+        publish_speedtest_result(internet_speed, (perf_counter() - start) * 1_000)
+    export_speedtest_results()
+
+def request_speedtest(reason):
+    logger.info(f"Requesting a speedtest: {reason}.")
+    if speedtest_trigger:
+        speedtest_trigger()
+
+# Samples the interface counters; runs every THROUGHPUT_SAMPLE_INTERVAL
+def throughput_check():
+    rates = interface_rate_meter.sample()
+    if rates is None:
+        return
+    reason = throughput_estimator.observe_traffic(*rates)
+    collect_throughput_metrics(*rates, throughput_estimator.estimate())
+    if reason:
+        request_speedtest(reason)
+
+# Ranged download of THROUGHPUT_PROBE_URL; runs every THROUGHPUT_PROBE_INTERVAL
+def throughput_probe_check():
+    probe_mbps = ranged_download(throughput_probe_url, throughput_probe_bytes)
+    collect_throughput_probe(probe_mbps)
+    reason = throughput_estimator.observe_probe(probe_mbps)
+    if reason:
+        request_speedtest(reason)
+
+def ping_check():
+    collect_ping_sample_metrics(ping_sampler.summaries(ping_quantiles))
+
+def http_check():
+    domains = due_targets("HTTP")
+    if not domains:
+        return
+    mark = wait_for_link("HTTP")
+    http_start = perf_counter()
+    http_reachability_checks = measure('http', measure_http, domains)
+    if http_reachability_checks is None:
+        http_reachability_checks = unreachable_checks(domains)
+    mark_during_speedtest(http_reachability_checks, mark)
+    publish_http_checks(http_reachability_checks, (perf_counter() - http_start) * 1_000)
+
+def dns_check():
+    ip_addrs = due_targets("DNS")
+    if not ip_addrs:
+        return
+    mark = wait_for_link("DNS")
+    dns_start = perf_counter()
+    dns_reachability_checks, dns_query_results = measure('dns', measure_dns, ip_addrs) or (unreachable_checks(ip_addrs), None)
+    mark_during_speedtest(dns_reachability_checks, mark)
+    publish_dns_checks(dns_reachability_checks, (perf_counter() - dns_start) * 1_000, dns_query_results)
+
+
+if __name__ == "__main__":
+
+    parser = ArgumentParser(description="Internet speed and reachability monitor")
+    parser.add_argument('--async', dest='use_async', action='store_true', help="run every check and the metrics endpoint on one asyncio event loop")
+    parser.add_argument('--supervised', action='store_true', help="run the speedtest, HTTP and DNS checks in separate worker processes")
+    parser.add_argument('--aggregator', action='store_true', help="run no checks; serve the results streamed by agents on one /metrics endpoint")
+    args = parser.parse_args()
+    if args.use_async and args.supervised:
+        parser.error("--async and --supervised cannot be used together")
+
+    if args.aggregator:
+        listen_host, _, listen_port = getenv("AGGREGATOR_LISTEN", "127.0.0.1:9900").rpartition(':')
+        aggregator = Aggregator((listen_host.strip('[]'), int(listen_port)), max_age=float(getenv("AGGREGATOR_MAX_AGE", "3600")))
+        aggregator.start()
+        start_http_server(8000, registry=aggregator.registry)
+        logger.info(f"Aggregating agent results on {listen_host}:{listen_port}.")
+        Event().wait()
+
+    if args.use_async:
+        import asyncio
+        # async_monitor imports this module as `monitor`; point that name at
+        # the running __main__ module so metrics are not registered twice
+        sys.modules['monitor'] = sys.modules[__name__]
+        import async_monitor
+        asyncio.run(async_monitor.main())
+        sys.exit(0)
+
+    if args.supervised:
+        supervisor = Supervisor(
+            {'speedtest': measure_speedtest, 'http': measure_http, 'dns': measure_dns},
+            timeout=worker_timeout,
+            max_rss_bytes=worker_max_rss_mb * 1024 * 1024,
+            cpu_limit=worker_max_cpu_seconds
+        )
+        supervisor.start()
+
+    # Either render the exposition once per check run and serve the cached
+    # (optionally gzipped) bytes, or render it on every scrape. The
+    # profiler endpoint needs this module's server rather than prometheus_client's.
+    # An agent leaves serving to the aggregator unless AGENT_SERVE_METRICS is set
+    after_run = None
+    if site_agent and not agent_serve_metrics:
+        logger.info(f"Sending results to the aggregator at {aggregator_address} instead of serving metrics.")
+    elif metrics_precomputed or profiler_enabled:
+        exposition = CachedExposition(max_age=metrics_max_age if metrics_precomputed else 0)
+        start_cached_http_server(8000, exposition, profiler=SamplingProfiler() if profiler_enabled else None)
+        if metrics_precomputed:
+            after_run = exposition.refresh
+    else:
+        start_http_server(8000)
 
-        i += 1
-        i = i % 3
-        sleep(300)
\ No newline at end of file
+    # Each check runs on its own thread and interval, by default the
+    # speedtest every 15 min and HTTP/DNS checks every 5 min
+    scheduler = Scheduler(after_run=after_run)
+    scheduler.add('speedtest', speedtest_check, speedtest_interval, speedtest_jitter, restore_speedtest_state())
+    scheduler.add('http', http_check, *check_schedule('HTTP'))
+    scheduler.add('dns', dns_check, *check_schedule('DNS'))
+    if history:
+        scheduler.add('history', history.maintain, 3600)
+    if inventory:
+        scheduler.add('targets', reload_targets, targets_reload_interval, initial_delay=targets_reload_interval)
+    if throughput_estimator:
+        speedtest_trigger = lambda: scheduler.trigger('speedtest')
+        scheduler.add('throughput', throughput_check, throughput_sample_interval)
+        if throughput_probe_url:
+            scheduler.add('throughput-probe', throughput_probe_check, throughput_probe_interval, initial_delay=throughput_probe_interval)
+    if supervisor:
+        scheduler.add('workers', supervisor.check_limits, 5)
+    if ping_sampler:
+        ping_sampler.start()
+        scheduler.add('ping', ping_check, ping_publish_interval, initial_delay=ping_publish_interval)
+    if site_agent:
+        site_agent.start()
+    if pusher:
+        scheduler.add('push', pusher.push, push_interval, initial_delay=push_interval)
+    scheduler.run_forever()
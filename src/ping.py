@@ -0,0 +1,187 @@
+import logging
+from collections import deque
+from math import ceil
+from selectors import DefaultSelector, EVENT_READ
+from socket import socket, getaddrinfo, AF_INET, AF_INET6, SOCK_DGRAM, IPPROTO_ICMP, IPPROTO_ICMPV6
+from struct import pack, unpack_from
+from threading import Thread, Event, Lock
+from time import monotonic
+
+logger = logging.getLogger('internet-speed')
+
+ICMP_ECHO_REQUEST = {AF_INET: 8, AF_INET6: 128}
+ICMP_ECHO_REPLY = {AF_INET: 0, AF_INET6: 129}
+PAYLOAD = b'internet-speed'
+
+
+def icmp_checksum(data):
+    if len(data) % 2:
+        data += b'\x00'
+    total = sum(unpack_from(f"!{len(data) // 2}H", data))
+    total = (total >> 16) + (total & 0xFFFF)
+    total += total >> 16
+    return ~total & 0xFFFF
+
+def build_echo_request(family, sequence):
+    header = pack('!BBHHH', ICMP_ECHO_REQUEST[family], 0, 0, 0, sequence)
+    return pack('!BBHHH', ICMP_ECHO_REQUEST[family], 0, icmp_checksum(header + PAYLOAD), 0, sequence) + PAYLOAD
+
+# Returns the sequence number of an echo reply, or None for anything else.
+# Datagram ICMP sockets deliver the ICMP message without the IP header.
+def parse_echo_reply(family, data):
+    if len(data) < 8 or data[0] != ICMP_ECHO_REPLY[family]:
+        return None
+    return unpack_from('!H', data, 6)[0]
+
+
+# Opens a connected socket for pinging `target`. 'icmp' uses an
+# unprivileged ICMP datagram socket (allowed by net.ipv4.ping_group_range),
+# 'udp' sends to a UDP echo service on `udp_port`, 'auto' tries ICMP first.
+# Returns (socket, kind, family).
+def open_ping_socket(target, mode='auto', udp_port=7):
+    family, _, _, _, address = getaddrinfo(target, udp_port, type=SOCK_DGRAM)[0]
+    if mode in ('auto', 'icmp'):
+        try:
+            sock = socket(family, SOCK_DGRAM, IPPROTO_ICMP if family == AF_INET else IPPROTO_ICMPV6)
+            sock.connect((address[0], 0) + tuple(address[2:]))
+            sock.setblocking(False)
+            return sock, 'icmp', family
+        except PermissionError as err:
+            if mode == 'icmp':
+                raise
+            logger.info(f"ICMP datagram sockets are not permitted ({err}), pinging {target} over UDP echo.")
+    sock = socket(family, SOCK_DGRAM)
+    sock.connect(address)
+    sock.setblocking(False)
+    return sock, 'udp', family
+
+
+# The last `size` ping results of one target (an RTT in ms, or None for a
+# lost probe) in a fixed-size ring, so memory stays constant however long
+# the sampler runs.
+class PingWindow:
+
+    def __init__(self, size):
+        self._samples = deque(maxlen=size)
+        self._lock = Lock()
+
+    def add(self, rtt_ms):
+        with self._lock:
+            self._samples.append(rtt_ms)
+
+    # Returns {'sent', 'loss', 'jitter', 'rtt': {quantile: ms}} or None if
+    # there are no samples. Jitter is the mean difference between
+    # consecutive RTTs (as in RFC 3550); RTT quantiles are nearest-rank.
+    def summary(self, quantiles=(0.5, 0.9, 0.99)):
+        with self._lock:
+            samples = list(self._samples)
+        if not samples:
+            return None
+        rtts = [rtt for rtt in samples if rtt is not None]
+        differences = [abs(current - previous) for previous, current in zip(rtts, rtts[1:])]
+        ordered = sorted(rtts)
+        return {
+            'sent': len(samples),
+            'loss': 1 - len(rtts) / len(samples),
+            'jitter': sum(differences) / len(differences) if differences else None,
+            'rtt': {q: ordered[max(ceil(q * len(ordered)), 1) - 1] for q in quantiles} if ordered else {}
+        }
+
+
+# Sends `rate` echo requests a second to every target from one thread and
+# matches the replies on a selector. A probe with no reply after `timeout`
+# seconds counts as lost. Each target keeps the last `window` seconds of
+# results in a PingWindow. Listeners are called as listener(target, rtt_ms)
+# for every result (rtt_ms is None for a loss).
+class PingSampler:
+
+    def __init__(self, targets, rate=5, window=60, timeout=1, mode='auto', udp_port=7, clock=monotonic):
+        self.targets = list(targets)
+        self.rate = rate
+        self.timeout = timeout
+        self.mode = mode
+        self.udp_port = udp_port
+        self.clock = clock
+        self.windows = {target: PingWindow(max(1, int(rate * window))) for target in self.targets}
+        self.listeners = []
+        self._stop = Event()
+        self._thread = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = Thread(target=self.run, name='ping-sampler', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def summaries(self, quantiles=(0.5, 0.9, 0.99)):
+        return {target: window.summary(quantiles) for target, window in self.windows.items()}
+
+    def record(self, target, rtt_ms):
+        self.windows[target].add(rtt_ms)
+        for listener in self.listeners:
+            listener(target, rtt_ms)
+
+    def run(self):
+        selector = DefaultSelector()
+        sockets = {}
+        for target in self.targets:
+            try:
+                sock, kind, family = open_ping_socket(target, self.mode, self.udp_port)
+            except Exception as err:
+                logger.error(f"Could not open ping socket for {target}")
+                logger.error(err)
+                continue
+            sockets[target] = (sock, kind, family)
+            selector.register(sock, EVENT_READ, target)
+
+        pending = {}
+        sequence = 0
+        next_send = self.clock()
+        try:
+            while not self._stop.is_set():
+                now = self.clock()
+                if now >= next_send:
+                    sequence = (sequence + 1) & 0xFFFF
+                    for target, (sock, kind, family) in sockets.items():
+                        try:
+                            sock.send(build_echo_request(family, sequence) if kind == 'icmp' else pack('!H', sequence) + PAYLOAD)
+                        except OSError:
+                            pass
+                        pending[(target, sequence)] = now
+                    next_send += 1 / self.rate
+                    if next_send < now:
+                        next_send = now + 1 / self.rate
+
+                for (target, sent_sequence), sent in list(pending.items()):
+                    if now - sent > self.timeout:
+                        del pending[(target, sent_sequence)]
+                        self.record(target, None)
+
+                for key, _ in selector.select(max(0, min(next_send - self.clock(), 0.1))):
+                    target = key.data
+                    sock, kind, family = sockets[target]
+                    while True:
+                        try:
+                            data = sock.recv(2048)
+                        except (BlockingIOError, InterruptedError):
+                            break
+                        except OSError:
+                            # ICMP port unreachable from a host without an
+                            # echo service; the probe times out as lost
+                            break
+                        received = self.clock()
+                        if kind == 'icmp':
+                            reply_sequence = parse_echo_reply(family, data)
+                        else:
+                            reply_sequence = unpack_from('!H', data)[0] if len(data) >= 2 else None
+                        sent = pending.pop((target, reply_sequence), None)
+                        if sent is not None:
+                            self.record(target, (received - sent) * 1_000)
+        finally:
+            selector.close()
+            for sock, _, _ in sockets.values():
+                sock.close()
@@ -0,0 +1,52 @@
+import sys
+from collections import Counter
+from os import path
+from threading import Lock, enumerate as enumerate_threads, get_ident
+from time import monotonic, sleep
+
+
+class ProfilerBusy(Exception):
+    pass
+
+
+# Stack of one thread, root first, as "thread;file:function;..." with the
+# frames' line numbers left out so calls from one function merge
+def fold_stack(thread_name, frame):
+    frames = []
+    while frame is not None:
+        code = frame.f_code
+        frames.append(f"{path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    frames.append(thread_name)
+    return ';'.join(reversed(frames))
+
+
+# Wall-clock sampling profiler over every thread of the process. A profile
+# samples every other thread's stack each `interval` seconds for the
+# requested time and returns them in the folded format ("stack count" per
+# line) read by flamegraph.pl, speedscope and inferno. Only one profile
+# runs at a time and it costs nothing while not profiling.
+class SamplingProfiler:
+
+    def __init__(self, interval=0.01, max_seconds=60):
+        self.interval = interval
+        self.max_seconds = max_seconds
+        self._lock = Lock()
+
+    def profile(self, seconds):
+        seconds = min(max(seconds, self.interval), self.max_seconds)
+        if not self._lock.acquire(blocking=False):
+            raise ProfilerBusy("a profile is already running")
+        try:
+            samples = Counter()
+            profiler_thread = get_ident()
+            deadline = monotonic() + seconds
+            while monotonic() < deadline:
+                names = {thread.ident: thread.name for thread in enumerate_threads()}
+                for thread_id, frame in sys._current_frames().items():
+                    if thread_id != profiler_thread:
+                        samples[fold_stack(names.get(thread_id, str(thread_id)), frame)] += 1
+                sleep(self.interval)
+        finally:
+            self._lock.release()
+        return ''.join(f"{stack} {count}\n" for stack, count in samples.most_common())
@@ -1,10 +1,28 @@
 import logging
-from prometheus_client import Gauge, Info, Enum
+from os import getenv
+from threading import active_count, RLock
+from prometheus_client import Gauge, Info, Enum, Histogram, Counter
+
+from quantiles import SlidingWindowQuantiles
+from bufferbloat import GRADES
 
 logger = logging.getLogger('internet-speed')
 
 speedtest_labels = ['server_name', 'server_location']
 reachability_labels = ['target', 'protocol']
+dns_query_labels = ['target', 'query_name', 'query_type']
+http_phase_labels = ['target', 'phase']
+http_phase_buckets = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000]
+check_phase_buckets = [0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+response_time_buckets = [float(bucket) for bucket in getenv("RESPONSE_TIME_BUCKETS", "5,10,25,50,100,250,500,1000,2500,5000").split(',')]
+response_time_quantiles = [float(q) for q in getenv("RESPONSE_TIME_QUANTILES", "").split(',') if q.strip()]
+response_time_quantile_window = float(getenv("RESPONSE_TIME_QUANTILE_WINDOW", "3600"))
+# How checks behave while a speedtest runs (run/defer/tag). Read here, not
+# in monitor, because with tag the response time series are created with a
+# during_speedtest label so probes made on a saturated link stay separate
+probe_during_speedtest = getenv("PROBE_DURING_SPEEDTEST", "run").lower()
+tag_during_speedtest = probe_during_speedtest == "tag"
+response_time_labels = reachability_labels + ['during_speedtest'] if tag_during_speedtest else reachability_labels
 
 download_speed = Gauge('download_speed', 'Download speed in Mbps', speedtest_labels, namespace='internet')
 download_latency_iqm = Gauge('download_latency_iqm', 'Download latency IQM in ms', speedtest_labels, namespace='internet')
@@ -14,13 +32,96 @@ upload_latency_iqm = Gauge('upload_latency_iqm', 'Upload latency IQM in ms', spe
 upload_latency_jitter = Gauge('upload_latency_jitter', 'Upload latency jitter in ms', speedtest_labels, namespace='internet')
 ping_jitter = Gauge('ping_jitter', 'Ping jitter in ms', speedtest_labels, namespace='internet')
 ping_latency = Gauge('ping_latency', 'Ping latency in ms', speedtest_labels, namespace='internet')
+result_age = Gauge('speedtest_result_age_seconds', 'Seconds since this server was last measured', speedtest_labels, namespace='internet')
 packet_loss = Gauge('packet_loss', 'Packet loss', speedtest_labels, namespace='internet')
-response_time = Gauge('response_time_ms', 'Response time in ms', reachability_labels, namespace='internet')
+speedtest_live_bandwidth = Gauge('speedtest_live_bandwidth_mbps', 'Bandwidth of the running speedtest phase in Mbps', ['phase'], namespace='internet')
+speedtest_progress = Gauge('speedtest_progress', 'Progress of the running speedtest phase from 0 to 1', ['phase'], namespace='internet')
+response_time = Gauge('response_time_ms', 'Response time in ms', response_time_labels, namespace='internet')
+http_phase_duration = Histogram('http_phase_duration_ms', 'Time spent in each phase of an HTTP probe in ms', http_phase_labels, buckets=http_phase_buckets, namespace='internet')
+response_time_histogram = Histogram('response_time_milliseconds', 'Distribution of response times in ms', response_time_labels, buckets=response_time_buckets, namespace='internet')
+response_time_quantile = Gauge('response_time_quantile_ms', 'Response time quantile over a sliding window in ms', response_time_labels + ['quantile'], namespace='internet')
+probe_interval = Gauge('probe_interval_seconds', 'Current seconds between probes of a target', reachability_labels, namespace='internet')
+consecutive_failures = Gauge('consecutive_failures', 'Failed probes of a target in a row', reachability_labels, namespace='internet')
+link_throughput = Gauge('link_throughput_mbps', 'Traffic on the monitored interfaces in Mbps', ['direction'], namespace='internet')
+link_utilisation = Gauge('link_utilisation_ratio', 'Traffic as a fraction of the last measured speed', ['direction'], namespace='internet')
+link_headroom = Gauge('link_headroom_mbps', 'Last measured speed minus the current traffic in Mbps', ['direction'], namespace='internet')
+throughput_probe = Gauge('throughput_probe_mbps', 'Throughput of the last ranged download probe in Mbps', namespace='internet')
+ping_sample_rtt = Gauge('ping_sample_rtt_ms', 'Round trip time quantile over the ping sampler window in ms', ['target', 'quantile'], namespace='internet')
+ping_sample_loss = Gauge('ping_sample_loss_ratio', 'Fraction of lost pings over the ping sampler window', ['target'], namespace='internet')
+bufferbloat_rtt = Gauge('bufferbloat_rtt_ms', 'Ping round trip time quantile during each phase of the last speedtest in ms', ['phase', 'quantile'], namespace='internet')
+bufferbloat_loss = Gauge('bufferbloat_loss_ratio', 'Fraction of lost pings during each phase of the last speedtest', ['phase'], namespace='internet')
+bufferbloat_jitter = Gauge('bufferbloat_jitter_ms', 'Ping jitter during each phase of the last speedtest in ms', ['phase'], namespace='internet')
+bufferbloat_increase = Gauge('bufferbloat_latency_increase_ms', 'Median across targets of the rise in median round trip time from idle to a loaded phase in ms', ['phase'], namespace='internet')
+ping_sample_jitter = Gauge('ping_sample_jitter_ms', 'Mean difference between consecutive ping round trip times in ms', ['target'], namespace='internet')
+dns_query_time = Gauge('dns_query_time_ms', 'DNS query round trip time in ms', dns_query_labels, namespace='internet')
 
 info = Info('speedtest_info', 'Other info i.e. ISP and external IP', namespace='internet')
+target_info = Info('target', 'Tags of each target in TARGETS_FILE', reachability_labels, namespace='internet')
+
+schedule_lag = Gauge('schedule_lag_seconds', 'Seconds between when a check was scheduled and when it started', ['check'])
+schedule_overruns = Counter('schedule_overruns', 'Scheduled runs skipped because the previous run of the check was still going', ['check'])
+worker_restarts = Counter('worker_restarts', 'Times a supervised worker process was restarted', ['worker'])
+worker_rss = Gauge('worker_rss_bytes', 'Resident memory of a supervised worker process', ['worker'])
 
+# Self-instrumentation. CPU, RSS and open FDs come from prometheus_client's
+# default process collector (process_cpu_seconds_total etc.)
+check_phase_duration = Histogram('check_phase_duration_seconds', 'Time spent in each phase of a check run', ['check', 'phase'], buckets=check_phase_buckets)
+probes_in_flight = Gauge('probes_in_flight', 'Probes currently running', ['protocol'])
+push_spool_batches = Gauge('push_spool_batches', 'Batches waiting to be pushed')
+push_spool_bytes = Gauge('push_spool_bytes', 'Bytes waiting to be pushed')
+push_failures = Counter('push_failures', 'Pushes that failed and were kept for a retry')
+push_dropped = Counter('push_dropped_batches', 'Batches dropped because the spool was full or the receiver rejected them')
+probes_deferred = Counter('probes_deferred', 'Probe runs held back until a speedtest finished', ['protocol'])
+process_threads = Gauge('process_threads', 'Threads running in the monitor process')
+process_threads.set_function(active_count)
+
+bufferbloat_grade = Enum('bufferbloat_grade', 'Bufferbloat grade of the last speedtest', states=GRADES, namespace='internet')
 reachability = Enum('reachability', 'Status of reachability', reachability_labels, states=['available', 'unavailable'], namespace='internet')
 
+# One sketch per response time series when RESPONSE_TIME_QUANTILES is set
+response_time_sketches = {}
+
+# Bound label children grouped by owner, a (target, protocol) pair. Reusing
+# a bound child skips prometheus_client's label validation and lock on
+# every update, and the grouping lets all of a target's series be removed
+# together when it is dropped from the config. The checks run on their own
+# threads, so the dict (and response_time_sketches) is only touched under
+# label_children_lock; a collection cycle holds it once for all its targets.
+label_children = {}
+label_children_lock = RLock()
+
+dns_query_status = Enum('dns_query_status', 'Response code of the last DNS query', dns_query_labels, states=['NOERROR', 'FORMERR', 'SERVFAIL', 'NXDOMAIN', 'NOTIMP', 'REFUSED', 'OTHER', 'TIMEOUT', 'ERROR'], namespace='internet')
+
+
+def child(owner, metric, *label_values):
+    with label_children_lock:
+        children = label_children.get(owner)
+        if children is None:
+            children = label_children[owner] = {}
+        bound = children.get((metric, label_values))
+        if bound is None:
+            bound = children[(metric, label_values)] = metric.labels(*label_values)
+        return bound
+
+# Removes every series bound through child() for one owner
+def remove_owner(owner):
+    with label_children_lock:
+        children = label_children.pop(owner, {})
+    for metric, label_values in children:
+        metric.remove(*label_values)
+
+# Removes the series of every `protocol` target not in `active_targets`
+def sync_reachability_targets(protocol, active_targets):
+    active_targets = set(active_targets)
+    with label_children_lock:
+        stale = [owner for owner in label_children if owner[1] == protocol and owner[0] not in active_targets]
+        removed = {owner: label_children.pop(owner) for owner in stale}
+        for labels in [labels for labels in response_time_sketches if labels[:2] in removed]:
+            del response_time_sketches[labels]
+    for owner, children in removed.items():
+        logger.info(f"Removing metrics for {protocol} target {owner[0]}.")
+        for metric, label_values in children:
+            metric.remove(*label_values)
 
 def collect_speedtest_metrics(speedtest_output):
 
@@ -30,43 +131,163 @@ def collect_speedtest_metrics(speedtest_output):
 
     server_name = speedtest_output['server']['name']
     server_location = speedtest_output['server']['location']
+    owner = ((server_name, server_location), 'speedtest')
 
     if speedtest_output['download']['download_speed'] is not None:
-        download_speed.labels(server_name, server_location).set(speedtest_output['download']['download_speed'])
+        child(owner, download_speed, server_name, server_location).set(speedtest_output['download']['download_speed'])
     if speedtest_output['download']['latency']['iqm'] is not None:    
-        download_latency_iqm.labels(server_name, server_location).set(speedtest_output['download']['latency']['iqm'])
+        child(owner, download_latency_iqm, server_name, server_location).set(speedtest_output['download']['latency']['iqm'])
     if speedtest_output['download']['latency']['jitter'] is not None:    
-        download_latency_jitter.labels(server_name, server_location).set(speedtest_output['download']['latency']['jitter'])
+        child(owner, download_latency_jitter, server_name, server_location).set(speedtest_output['download']['latency']['jitter'])
     if speedtest_output['upload']['upload_speed'] is not None:    
-        upload_speed.labels(server_name, server_location).set(speedtest_output['upload']['upload_speed'])
+        child(owner, upload_speed, server_name, server_location).set(speedtest_output['upload']['upload_speed'])
     if speedtest_output['upload']['latency']['iqm'] is not None:    
-        upload_latency_iqm.labels(server_name, server_location).set(speedtest_output['upload']['latency']['iqm'])
+        child(owner, upload_latency_iqm, server_name, server_location).set(speedtest_output['upload']['latency']['iqm'])
     if speedtest_output['upload']['latency']['jitter'] is not None:    
-        upload_latency_jitter.labels(server_name, server_location).set(speedtest_output['upload']['latency']['jitter'])
+        child(owner, upload_latency_jitter, server_name, server_location).set(speedtest_output['upload']['latency']['jitter'])
     if speedtest_output['ping']['jitter'] is not None:    
-        ping_jitter.labels(server_name, server_location).set(speedtest_output['ping']['jitter'])
+        child(owner, ping_jitter, server_name, server_location).set(speedtest_output['ping']['jitter'])
     if speedtest_output['ping']['latency'] is not None:    
-        ping_latency.labels(server_name, server_location).set(speedtest_output['ping']['latency'])
+        child(owner, ping_latency, server_name, server_location).set(speedtest_output['ping']['latency'])
     if speedtest_output['packet_loss'] is not None:    
-        packet_loss.labels(server_name, server_location).set(speedtest_output['packet_loss'])
+        child(owner, packet_loss, server_name, server_location).set(speedtest_output['packet_loss'])
 
     if (speedtest_output['isp'] is not None and speedtest_output['external_ip'] is not None):
         info.info({'isp': speedtest_output['isp'], 'external_ip': speedtest_output['external_ip']})
 
     logger.info("Finished collecting speedtest metrics.")
 
+# For a server whose cached result has expired
+def remove_speedtest_metrics(server_name, server_location):
+    logger.info(f"Removing speedtest metrics for {server_name}.")
+    remove_owner(((server_name, server_location), 'speedtest'))
+
+def collect_speedtest_age(speedtest_output, age):
+
+    server_name = speedtest_output['server']['name']
+    server_location = speedtest_output['server']['location']
+    child(((server_name, server_location), 'speedtest'), result_age, server_name, server_location).set(age)
+
+# Called for every progress line of a streaming speedtest
+def collect_speedtest_progress(phase, progress, bandwidth):
+
+    if progress is not None:
+        speedtest_progress.labels(phase).set(progress)
+    if bandwidth is not None:
+        speedtest_live_bandwidth.labels(phase).set(bandwidth)
+
 def collect_reachability_metrics(protocol, checks_output):
 
     logger.info(f"Collecting {protocol} reachability metrics...")
+    with label_children_lock:
+        for domain in checks_output:
+            owner = (domain, protocol)
+
+            if checks_output[domain]['response_time_ms'] is not None:
+                labels = owner
+                if tag_during_speedtest:
+                    labels += ('true' if checks_output[domain].get('during_speedtest') else 'false',)
+                child(owner, response_time, *labels).set(checks_output[domain]['response_time_ms'])
+                child(owner, response_time_histogram, *labels).observe(checks_output[domain]['response_time_ms'])
+                if response_time_quantiles:
+                    collect_response_time_quantiles(labels, checks_output[domain]['response_time_ms'])
+            
+            if checks_output[domain]['reachable']:
+                child(owner, reachability, domain, protocol).state('available')
+            
+            else:
+                child(owner, reachability, domain, protocol).state('unavailable')
+
+    logger.info(f"Finished collecting {protocol} reachability metrics.")
+
+# labels is (target, protocol), plus during_speedtest when tagging
+def collect_response_time_quantiles(labels, response_time_ms):
+
+    with label_children_lock:
+        sketch = response_time_sketches.get(labels)
+        if sketch is None:
+            sketch = response_time_sketches[labels] = SlidingWindowQuantiles(response_time_quantile_window)
+        sketch.observe(response_time_ms)
+        for q in response_time_quantiles:
+            child(labels[:2], response_time_quantile, *labels, str(q)).set(sketch.quantile(q))
+
+# Only checks made by the pooled probe engine carry a 'phases' entry
+def collect_http_phase_metrics(checks_output):
+
+    logger.info("Collecting HTTP phase metrics...")
     for domain in checks_output:
+        for phase, duration in checks_output[domain].get('phases', {}).items():
+            if duration is not None:
+                child((domain, 'HTTP'), http_phase_duration, domain, phase).observe(duration)
+
+    logger.info("Finished collecting HTTP phase metrics.")
+
+def collect_dns_query_metrics(query_results):
+
+    logger.info("Collecting DNS query metrics...")
+    with label_children_lock:
+        for resolver in query_results:
+            owner = (resolver, 'DNS')
+            for query in query_results[resolver]:
+
+                if query['response_time_ms'] is not None:
+                    child(owner, dns_query_time, resolver, query['name'], query['type']).set(query['response_time_ms'])
+
+                child(owner, dns_query_status, resolver, query['name'], query['type']).state(query['rcode'])
+
+    logger.info("Finished collecting DNS query metrics.")
+
+# One internet_target_info series per inventory target, carrying its tags
+# comma-separated, to join onto the other series by target and protocol
+def collect_target_info(targets):
+    with label_children_lock:
+        for target in targets:
+            child((target.name, target.protocol), target_info, target.name, target.protocol).info({'tags': ','.join(target.tags)})
+
+# probe_rates is {target: (interval_seconds, consecutive_failures)}
+def collect_probe_rate_metrics(protocol, probe_rates):
+    with label_children_lock:
+        for target, (interval, failures) in probe_rates.items():
+            owner = (target, protocol)
+            child(owner, probe_interval, target, protocol).set(interval)
+            child(owner, consecutive_failures, target, protocol).set(failures)
+
+# estimates is {direction: (throughput_mbps, utilisation, headroom_mbps)}
+# from throughput.ThroughputEstimator.estimate
+def collect_throughput_metrics(rx_mbps, tx_mbps, estimates):
+    link_throughput.labels('download').set(rx_mbps)
+    link_throughput.labels('upload').set(tx_mbps)
+    for direction, (_, utilisation, headroom) in estimates.items():
+        link_utilisation.labels(direction).set(utilisation)
+        link_headroom.labels(direction).set(headroom)
+
+def collect_throughput_probe(probe_mbps):
+    if probe_mbps is not None:
+        throughput_probe.set(probe_mbps)
 
-        if checks_output[domain]['response_time_ms'] is not None:
-            response_time.labels(domain, protocol).set(checks_output[domain]['response_time_ms'])
-        
-        if checks_output[domain]['reachable']:
-            reachability.labels(domain, protocol).state('available')
-        
-        else:
-            reachability.labels(domain, protocol).state('unavailable')
+# summaries is {target: summary} from ping.PingSampler.summaries
+def collect_ping_sample_metrics(summaries):
+    for target, summary in summaries.items():
+        if summary is None:
+            continue
+        ping_sample_loss.labels(target).set(summary['loss'])
+        if summary['jitter'] is not None:
+            ping_sample_jitter.labels(target).set(summary['jitter'])
+        for q, rtt in summary['rtt'].items():
+            ping_sample_rtt.labels(target, str(q)).set(rtt)
 
-    logger.info(f"Finished collecting {protocol} reachability metrics.")
\ No newline at end of file
+# result is from bufferbloat.LatencyUnderLoad.result; series of phases
+# the last test did not have are removed
+def collect_bufferbloat_metrics(result):
+    for metric in (bufferbloat_rtt, bufferbloat_loss, bufferbloat_jitter, bufferbloat_increase):
+        metric.clear()
+    for phase, summary in result['phases'].items():
+        bufferbloat_loss.labels(phase).set(summary['loss'])
+        if summary['jitter'] is not None:
+            bufferbloat_jitter.labels(phase).set(summary['jitter'])
+        for q, rtt in summary['rtt'].items():
+            bufferbloat_rtt.labels(phase, q).set(rtt)
+    for phase, increase in result['increase_ms'].items():
+        bufferbloat_increase.labels(phase).set(increase)
+    if result['grade'] is not None:
+        bufferbloat_grade.state(result['grade'])
@@ -0,0 +1,189 @@
+import logging
+from collections import OrderedDict
+from os import listdir, makedirs, path, unlink
+from socket import gethostname
+from threading import Lock
+from time import time
+from urllib.parse import quote
+
+from prometheus_client import REGISTRY
+from prometheus_client.exposition import generate_latest
+from requests import post, put
+
+from prometheus import push_spool_batches, push_spool_bytes, push_failures, push_dropped
+from remote_write import encode_write_request, snappy_compress
+from speedtest_cache import write_atomically
+
+logger = logging.getLogger('internet-speed')
+
+FORMATS = ('remote_write', 'pushgateway')
+
+
+class PushRejected(Exception):
+    pass
+
+
+# Every sample in `registry` as [(labels, [(value, timestamp_ms)])] for
+# encode_write_request, stamped with one timestamp. *_created samples are
+# left out, as in a text scrape.
+def registry_series(registry, timestamp_ms, extra_labels=None):
+    series = []
+    for metric in registry.collect():
+        for sample in metric.samples:
+            if sample.name.endswith('_created'):
+                continue
+            labels = dict(extra_labels or {})
+            labels.update(sample.labels)
+            labels['__name__'] = sample.name
+            series.append((labels, [(float(sample.value), timestamp_ms)]))
+    return series
+
+
+# First-in first-out queue of encoded batches bounded to `max_bytes`; the
+# oldest batches are dropped to make room. With a directory each batch is
+# a file named by its sequence number, so the queue survives a restart and
+# is replayed in order; without one it is kept in memory.
+class Spool:
+
+    def __init__(self, directory=None, max_bytes=64 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._batches = OrderedDict()
+        self._next = 0
+        self._lock = Lock()
+        if directory:
+            makedirs(directory, exist_ok=True)
+            for name in sorted(listdir(directory)):
+                if name.endswith('.batch'):
+                    sequence = int(name[:-len('.batch')])
+                    self._batches[sequence] = path.getsize(path.join(directory, name))
+                    self._next = sequence + 1
+        self._update_metrics()
+
+    def __len__(self):
+        return len(self._batches)
+
+    def size(self):
+        if self.directory:
+            return sum(self._batches.values())
+        return sum(len(batch) for batch in self._batches.values())
+
+    def _file(self, sequence):
+        return path.join(self.directory, f"{sequence:020d}.batch")
+
+    def _update_metrics(self):
+        push_spool_batches.set(len(self._batches))
+        push_spool_bytes.set(self.size())
+
+    def append(self, batch):
+        with self._lock:
+            sequence = self._next
+            self._next += 1
+            if self.directory:
+                write_atomically(self._file(sequence), batch)
+                self._batches[sequence] = len(batch)
+            else:
+                self._batches[sequence] = batch
+            while len(self._batches) > 1 and self.size() > self.max_bytes:
+                oldest = next(iter(self._batches))
+                logger.warning(f"Push spool is over {self.max_bytes} bytes, dropping its oldest batch.")
+                self._remove(oldest)
+                push_dropped.inc()
+            self._update_metrics()
+
+    def sequences(self):
+        with self._lock:
+            return list(self._batches)
+
+    # Yields (sequence, batch) oldest first
+    def batches(self):
+        for sequence in self.sequences():
+            if self.directory:
+                with open(self._file(sequence), 'rb') as batch_file:
+                    yield sequence, batch_file.read()
+            else:
+                yield sequence, self._batches[sequence]
+
+    def remove(self, sequence):
+        with self._lock:
+            self._remove(sequence)
+            self._update_metrics()
+
+    def _remove(self, sequence):
+        if self._batches.pop(sequence, None) is not None and self.directory:
+            unlink(self._file(sequence))
+
+
+# Pushes the registry to `url`, either as Prometheus remote-write requests
+# or to a Pushgateway. Every push() snapshots the registry into the spool
+# and then sends what is spooled, oldest first, stopping at the first
+# failure so the rest is kept for the next push and sent in order.
+# Remote-write samples carry the time of their snapshot, so a backlog is
+# backfilled with its original timestamps. A Pushgateway keeps only the
+# last push and refuses timestamps, so only the newest batch is sent.
+class Pusher:
+
+    def __init__(self, url, push_format='remote_write', spool=None, registry=REGISTRY, job='internet-speed', instance=None, timeout=10, clock=time):
+        if push_format not in FORMATS:
+            raise ValueError(f"unknown push format {push_format}")
+        self.url = url
+        self.push_format = push_format
+        self.spool = spool if spool is not None else Spool()
+        self.registry = registry
+        self.job = job
+        self.instance = instance or gethostname()
+        self.timeout = timeout
+        self.clock = clock
+
+    def snapshot(self):
+        if self.push_format == 'pushgateway':
+            return generate_latest(self.registry)
+        series = registry_series(self.registry, int(self.clock() * 1000), {'job': self.job, 'instance': self.instance})
+        return snappy_compress(encode_write_request(series))
+
+    def send(self, batch):
+        if self.push_format == 'pushgateway':
+            response = put(
+                f"{self.url.rstrip('/')}/metrics/job/{quote(self.job, safe='')}/instance/{quote(self.instance, safe='')}",
+                data=batch,
+                headers={'Content-Type': 'text/plain; version=0.0.4'},
+                timeout=self.timeout
+            )
+        else:
+            response = post(self.url, data=batch, headers={
+                'Content-Encoding': 'snappy',
+                'Content-Type': 'application/x-protobuf',
+                'User-Agent': 'internet-speed',
+                'X-Prometheus-Remote-Write-Version': '0.1.0'
+            }, timeout=self.timeout)
+        # 4xx other than 429 will fail the same way on every retry
+        if 400 <= response.status_code < 500 and response.status_code != 429:
+            raise PushRejected(f"{response.status_code} {response.text[:200]}")
+        response.raise_for_status()
+
+    def push(self):
+        self.spool.append(self.snapshot())
+        return self.flush()
+
+    # Returns the number of batches sent
+    def flush(self):
+        if self.push_format == 'pushgateway':
+            for sequence in self.spool.sequences()[:-1]:
+                self.spool.remove(sequence)
+
+        sent = 0
+        for sequence, batch in self.spool.batches():
+            try:
+                self.send(batch)
+            except PushRejected as err:
+                logger.error(f"Push to {self.url} was rejected, dropping the batch: {err}")
+                push_dropped.inc()
+            except Exception as err:
+                logger.error(f"Push to {self.url} failed, {len(self.spool)} batches spooled.")
+                logger.error(err)
+                push_failures.inc()
+                break
+            else:
+                sent += 1
+            self.spool.remove(sequence)
+        return sent
@@ -0,0 +1,66 @@
+from math import ceil, log
+from time import monotonic
+
+
+# Constant-memory quantile sketch over a sliding time window.
+#
+# Values are counted in logarithmic buckets (bucket i holds values in
+# (gamma^(i-1), gamma^i]) so any quantile is returned within
+# `relative_accuracy` of the true value, as in DDSketch. The window is
+# split into `sub_windows` slices that are dropped as they expire, and
+# each slice keeps at most `max_buckets` buckets (the lowest buckets are
+# merged when it overflows), so memory never grows with the number of
+# observations.
+class SlidingWindowQuantiles:
+
+    def __init__(self, window_seconds=3600, sub_windows=6, relative_accuracy=0.01, max_buckets=1024, clock=monotonic):
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = log(self.gamma)
+        self.slice_seconds = window_seconds / sub_windows
+        self.sub_windows = sub_windows
+        self.max_buckets = max_buckets
+        self.clock = clock
+        self._slices = []
+
+    def _current_slice(self):
+        slice_id = int(self.clock() // self.slice_seconds)
+        self._slices = [s for s in self._slices if s[0] > slice_id - self.sub_windows]
+        if not self._slices or self._slices[-1][0] != slice_id:
+            self._slices.append((slice_id, {}))
+        return self._slices[-1][1]
+
+    def observe(self, value):
+        buckets = self._current_slice()
+        key = ceil(log(value) / self.log_gamma) if value > 0 else None
+        buckets[key] = buckets.get(key, 0) + 1
+        if len(buckets) > self.max_buckets:
+            keys = sorted(k for k in buckets if k is not None)
+            lowest, next_lowest = keys[0], keys[1]
+            buckets[next_lowest] += buckets.pop(lowest)
+
+    def count(self):
+        self._current_slice()
+        return sum(sum(buckets.values()) for _, buckets in self._slices)
+
+    # Returns the q-quantile (0 <= q <= 1) of the window, or None if empty
+    def quantile(self, q):
+        self._current_slice()
+        merged = {}
+        for _, buckets in self._slices:
+            for key, count in buckets.items():
+                merged[key] = merged.get(key, 0) + count
+        total = sum(merged.values())
+        if not total:
+            return None
+
+        # Nearest-rank: the smallest value with at least q of the samples at or below it
+        rank = max(1, ceil(q * total))
+        seen = merged.get(None, 0)
+        if rank <= seen:
+            return 0.0
+        for key in sorted(k for k in merged if k is not None):
+            seen += merged[key]
+            if rank <= seen:
+                # Midpoint of the bucket (in relative terms)
+                return 2 * self.gamma ** key / (self.gamma + 1)
+        return 2 * self.gamma ** key / (self.gamma + 1)
@@ -0,0 +1,78 @@
+from struct import pack
+
+try:
+    import snappy
+except ImportError:
+    snappy = None
+
+# Prometheus remote-write 1.0: a snappy-compressed (block format) protobuf
+#
+#   message WriteRequest { repeated TimeSeries timeseries = 1; }
+#   message TimeSeries { repeated Label labels = 1; repeated Sample samples = 2; }
+#   message Label { string name = 1; string value = 2; }
+#   message Sample { double value = 1; int64 timestamp = 2; }
+#
+# encoded by hand so the protobuf runtime is not needed.
+
+WIRE_VARINT = 0
+WIRE_FIXED64 = 1
+WIRE_LENGTH_DELIMITED = 2
+
+
+def encode_varint(value):
+    # int64 fields are two's complement on the wire
+    if value < 0:
+        value += 1 << 64
+    encoded = bytearray()
+    while value > 0x7F:
+        encoded.append((value & 0x7F) | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+def encode_field(number, wire_type, payload):
+    key = encode_varint(number << 3 | wire_type)
+    if wire_type == WIRE_LENGTH_DELIMITED:
+        return key + encode_varint(len(payload)) + payload
+    return key + payload
+
+def encode_label(name, value):
+    return encode_field(1, WIRE_LENGTH_DELIMITED, name.encode('utf-8')) + encode_field(2, WIRE_LENGTH_DELIMITED, value.encode('utf-8'))
+
+def encode_sample(value, timestamp_ms):
+    return encode_field(1, WIRE_FIXED64, pack('<d', value)) + encode_field(2, WIRE_VARINT, encode_varint(timestamp_ms))
+
+# series is [(labels, [(value, timestamp_ms), ...]), ...] with labels a
+# dict including '__name__'; labels are sorted by name as the spec requires
+def encode_write_request(series):
+    request = bytearray()
+    for labels, samples in series:
+        timeseries = bytearray()
+        for name in sorted(labels):
+            timeseries += encode_field(1, WIRE_LENGTH_DELIMITED, encode_label(name, labels[name]))
+        for value, timestamp_ms in samples:
+            timeseries += encode_field(2, WIRE_LENGTH_DELIMITED, encode_sample(value, timestamp_ms))
+        request += encode_field(1, WIRE_LENGTH_DELIMITED, bytes(timeseries))
+    return bytes(request)
+
+
+# Snappy block format made only of literals: valid for any decoder but not
+# smaller than the input. Used when python-snappy is not installed.
+def snappy_literal_compress(data):
+    compressed = bytearray(encode_varint(len(data)))
+    for start in range(0, len(data), 65536):
+        chunk = data[start:start + 65536]
+        length = len(chunk) - 1
+        if length < 60:
+            compressed.append(length << 2)
+        elif length < 0x100:
+            compressed += bytes([60 << 2, length])
+        else:
+            compressed += bytes([61 << 2]) + pack('<H', length)
+        compressed += chunk
+    return bytes(compressed)
+
+def snappy_compress(data):
+    if snappy is not None:
+        return snappy.compress(data)
+    return snappy_literal_compress(data)
@@ -0,0 +1,100 @@
+import logging
+from math import ceil
+from random import uniform
+from threading import Thread, Event
+from time import monotonic
+
+from prometheus import schedule_lag, schedule_overruns
+
+logger = logging.getLogger('internet-speed')
+
+
+class Job:
+
+    def __init__(self, name, func, interval, jitter=0, initial_delay=0):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.jitter = jitter
+        self.initial_delay = initial_delay
+        self.thread = None
+        self.wake = Event()
+
+
+# Runs each check on its own thread against a monotonic clock. Run times
+# sit on a fixed grid (start + n * interval) plus a fresh random jitter
+# per run, so the period never drifts by the time the check takes and a
+# slow check cannot delay any other check. A run that finishes after its
+# next slot skips the missed slots and counts them as overruns.
+# `after_run` (if given) is called after every run of every check.
+# trigger(name) runs a check straight away and restarts its grid from then.
+class Scheduler:
+
+    def __init__(self, clock=monotonic, after_run=None):
+        self.clock = clock
+        self.after_run = after_run
+        self.jobs = {}
+        self._stop = Event()
+
+    def add(self, name, func, interval, jitter=0, initial_delay=0):
+        self.jobs[name] = Job(name, func, interval, jitter, initial_delay)
+
+    def trigger(self, name):
+        self.jobs[name].wake.set()
+
+    def start(self):
+        self._stop.clear()
+        for job in self.jobs.values():
+            job.thread = Thread(target=self._run_job, args=(job,), name=f"check-{job.name}", daemon=True)
+            job.thread.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        for job in self.jobs.values():
+            job.wake.set()
+        for job in self.jobs.values():
+            if job.thread is not None:
+                job.thread.join(timeout)
+
+    def run_forever(self):
+        self.start()
+        try:
+            while not self._stop.wait(60):
+                pass
+        except KeyboardInterrupt:
+            self.stop()
+
+    def _run_job(self, job):
+        next_run = self.clock() + job.initial_delay
+        while True:
+            scheduled = next_run + (uniform(0, job.jitter) if job.jitter else 0)
+            job.wake.wait(max(0, scheduled - self.clock()))
+            if self._stop.is_set():
+                return
+
+            started = self.clock()
+            if job.wake.is_set():
+                job.wake.clear()
+                logger.info(f"Check {job.name} triggered.")
+                next_run = started
+            else:
+                schedule_lag.labels(job.name).set(started - scheduled)
+            try:
+                job.func()
+            except Exception as err:
+                logger.error(f"Check {job.name} failed.")
+                logger.error(err)
+            if self.after_run:
+                try:
+                    self.after_run()
+                except Exception as err:
+                    logger.error(f"After-run hook failed for {job.name}.")
+                    logger.error(err)
+
+            next_run += job.interval
+            finished = self.clock()
+            if finished > next_run:
+                missed = ceil((finished - next_run) / job.interval)
+                logger.error(f"Check {job.name} overran its {job.interval}s interval.")
+                schedule_overruns.labels(job.name).inc(missed)
+                next_run += missed * job.interval
@@ -0,0 +1,116 @@
+from math import isnan, nan
+from struct import pack, unpack_from, error as StructError
+
+# Messages between an agent and the aggregator. Each is framed by a 4-byte
+# big-endian length and starts with a one-byte type; strings are a 2-byte
+# length and UTF-8, numbers are doubles with NaN for a missing value.
+#
+#   HELLO          site
+#   REACHABILITY   timestamp, protocol, target, reachable (byte), response_time_ms
+#   SPEEDTEST      timestamp, server_name, server_location, isp, external_ip,
+#                  one double per SPEEDTEST_FIELDS entry
+
+HELLO = 1
+REACHABILITY = 2
+SPEEDTEST = 3
+
+MAX_FRAME = 64 * 1024
+
+# (key, path into the parse_speedtest_output dict)
+SPEEDTEST_FIELDS = [
+    ('download_speed', ('download', 'download_speed')),
+    ('download_latency_iqm', ('download', 'latency', 'iqm')),
+    ('download_latency_jitter', ('download', 'latency', 'jitter')),
+    ('upload_speed', ('upload', 'upload_speed')),
+    ('upload_latency_iqm', ('upload', 'latency', 'iqm')),
+    ('upload_latency_jitter', ('upload', 'latency', 'jitter')),
+    ('ping_latency', ('ping', 'latency')),
+    ('ping_jitter', ('ping', 'jitter')),
+    ('packet_loss', ('packet_loss',))
+]
+SPEEDTEST_NUMBERS = f"!{len(SPEEDTEST_FIELDS)}d"
+
+
+class MessageError(ValueError):
+    pass
+
+
+def pack_string(value):
+    encoded = (value or '').encode('utf-8')[:0xFFFF]
+    return pack('!H', len(encoded)) + encoded
+
+def unpack_string(payload, offset):
+    length, = unpack_from('!H', payload, offset)
+    offset += 2
+    return payload[offset:offset + length].decode('utf-8'), offset + length
+
+def pack_number(value):
+    return pack('!d', nan if value is None else value)
+
+def unpack_number(payload, offset):
+    value, = unpack_from('!d', payload, offset)
+    return None if isnan(value) else value, offset + 8
+
+def frame(payload):
+    return pack('!I', len(payload)) + payload
+
+def encode_hello(site):
+    return frame(bytes([HELLO]) + pack_string(site))
+
+def encode_reachability(timestamp, protocol, target, check):
+    return frame(
+        bytes([REACHABILITY]) + pack('!d', timestamp) + pack_string(protocol) + pack_string(target) +
+        bytes([1 if check['reachable'] else 0]) + pack_number(check['response_time_ms'])
+    )
+
+def speedtest_value(result, keys):
+    for key in keys:
+        result = (result or {}).get(key)
+    return result
+
+def encode_speedtest(timestamp, result):
+    server = result.get('server') or {}
+    return frame(
+        bytes([SPEEDTEST]) + pack('!d', timestamp) + pack_string(server.get('name')) + pack_string(server.get('location')) +
+        pack_string(result.get('isp')) + pack_string(result.get('external_ip')) +
+        b''.join(pack_number(speedtest_value(result, keys)) for _, keys in SPEEDTEST_FIELDS)
+    )
+
+# Returns (type, fields) for one frame's payload
+def decode(payload):
+    try:
+        message_type, offset = payload[0], 1
+        if message_type == HELLO:
+            site, _ = unpack_string(payload, offset)
+            return HELLO, {'site': site}
+        timestamp, = unpack_from('!d', payload, offset)
+        offset += 8
+        if message_type == REACHABILITY:
+            protocol, offset = unpack_string(payload, offset)
+            target, offset = unpack_string(payload, offset)
+            reachable = payload[offset] == 1
+            response_time_ms, _ = unpack_number(payload, offset + 1)
+            return REACHABILITY, {'timestamp': timestamp, 'protocol': protocol, 'target': target, 'reachable': reachable, 'response_time_ms': response_time_ms}
+        if message_type == SPEEDTEST:
+            fields = {'timestamp': timestamp}
+            for key in ('server_name', 'server_location', 'isp', 'external_ip'):
+                fields[key], offset = unpack_string(payload, offset)
+            for (key, _), value in zip(SPEEDTEST_FIELDS, unpack_from(SPEEDTEST_NUMBERS, payload, offset)):
+                fields[key] = None if isnan(value) else value
+            return SPEEDTEST, fields
+    except (IndexError, StructError, UnicodeDecodeError) as err:
+        raise MessageError(f"malformed message: {err}")
+    raise MessageError(f"unknown message type {message_type}")
+
+# Reads one frame from a file-like socket reader; returns None at EOF
+def read_frame(reader):
+    header = reader.read(4)
+    if len(header) < 4:
+        return None
+    length, = unpack_from('!I', header)
+    if length == 0 or length > MAX_FRAME:
+        raise MessageError(f"bad frame length {length}")
+    payload = reader.read(length)
+    if len(payload) < length:
+        return None
+    return payload
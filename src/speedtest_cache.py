@@ -0,0 +1,95 @@
+import json
+import logging
+from os import fsync, replace, path, unlink
+from tempfile import NamedTemporaryFile
+from threading import Lock
+from time import time
+
+logger = logging.getLogger('internet-speed')
+
+
+# Keeps the latest speedtest result for each server so that, when servers
+# are measured one per cycle, every server's gauges can be re-exported
+# each cycle. Results older than `max_age` seconds are dropped by expire(),
+# which returns their servers so the caller can remove their series.
+# save()/load() keep the results and the time of the last run on disk so a
+# restarted process can re-export them and wait out the interval.
+class SpeedtestResultCache:
+
+    def __init__(self, max_age, clock=time):
+        self.max_age = max_age
+        self.clock = clock
+        self._results = {}
+        self._lock = Lock()
+        self.last_run = None
+
+    def add(self, result):
+        if not result or not result.get('server') or not result['server'].get('name'):
+            return
+        key = (result['server']['name'], result['server']['location'])
+        with self._lock:
+            self._results[key] = (self.clock(), result)
+
+    # Drops stale results and returns their (server_name, server_location) keys
+    def expire(self):
+        now = self.clock()
+        with self._lock:
+            stale = [key for key, (recorded, _) in self._results.items() if now - recorded > self.max_age]
+            for key in stale:
+                logger.info(f"Dropping stale speedtest result for {key[0]}.")
+                del self._results[key]
+        return stale
+
+    # Returns [(age_seconds, result), ...] for every result still fresh
+    def fresh(self):
+        now = self.clock()
+        with self._lock:
+            return [(now - recorded, result) for recorded, result in self._results.values() if now - recorded <= self.max_age]
+
+    def save(self, file_path, last_run=None):
+        with self._lock:
+            if last_run is not None:
+                self.last_run = last_run
+            state = {
+                'last_run': self.last_run,
+                'results': [{'recorded': recorded, 'result': result} for recorded, result in self._results.values()]
+            }
+        write_atomically(file_path, json.dumps(state))
+
+    # Restores a saved state; a missing or unreadable file is ignored.
+    # Returns the time of the last run, or None.
+    def load(self, file_path):
+        try:
+            with open(file_path) as state_file:
+                state = json.load(state_file)
+            entries = [(float(entry['recorded']), entry['result']) for entry in state.get('results', [])]
+            last_run = state.get('last_run')
+        except FileNotFoundError:
+            return None
+        except Exception as err:
+            logger.error(f"Could not load speedtest state from {file_path}.")
+            logger.error(err)
+            return None
+        with self._lock:
+            for recorded, result in entries:
+                if result.get('server') and result['server'].get('name'):
+                    self._results[(result['server']['name'], result['server']['location'])] = (recorded, result)
+            self.last_run = last_run
+        logger.info(f"Restored {len(entries)} speedtest results from {file_path}.")
+        return last_run
+
+
+# Writes to a temporary file next to `file_path` and renames it into place,
+# so a crash mid-write never leaves a truncated file behind
+def write_atomically(file_path, content):
+    directory = path.dirname(path.abspath(file_path))
+    with NamedTemporaryFile('wb' if isinstance(content, bytes) else 'w', dir=directory, prefix='.' + path.basename(file_path), delete=False) as temp_file:
+        try:
+            temp_file.write(content)
+            temp_file.flush()
+            fsync(temp_file.fileno())
+        except BaseException:
+            temp_file.close()
+            unlink(temp_file.name)
+            raise
+    replace(temp_file.name, file_path)
@@ -0,0 +1,172 @@
+import logging
+import multiprocessing
+import resource
+import signal
+from os import sysconf
+from threading import Lock
+
+import instrumentation
+from prometheus import worker_restarts, worker_rss
+
+logger = logging.getLogger('internet-speed')
+
+PAGE_SIZE = sysconf('SC_PAGE_SIZE')
+
+
+class WorkerError(Exception):
+    pass
+
+
+# Body of a worker process: answers each request from the pipe with
+# (handler(request), phase timings observed while handling it). Before
+# every request the soft CPU limit is moved to `cpu_limit` seconds past the
+# CPU already used, so one runaway request is killed by SIGXCPU however
+# long the worker has been running. Exits when the supervisor closes its
+# end of the pipe.
+def worker_main(handler, conn, cpu_limit):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    instrumentation.worker_observations = []
+    while True:
+        try:
+            request = conn.recv()
+        except (EOFError, OSError):
+            return
+        if cpu_limit:
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+            soft = int(usage.ru_utime + usage.ru_stime) + cpu_limit
+            resource.setrlimit(resource.RLIMIT_CPU, (soft if hard == resource.RLIM_INFINITY else min(soft, hard), hard))
+        try:
+            response = handler(request)
+        except Exception as err:
+            logger.error("Worker request failed.")
+            logger.error(err)
+            response = None
+        observations, instrumentation.worker_observations = instrumentation.worker_observations, []
+        conn.send((response, observations))
+
+
+# One worker process and the parent's end of its pipe. Workers come from
+# a forkserver rather than being forked from this process, whose other
+# threads may hold locks (logging, metrics) a forked child would inherit
+# held. Each one imports the handler's module afresh, so it starts from
+# the current config and targets file. A worker that dies, times out or
+# goes over its RSS limit is killed and started again.
+class Worker:
+
+    def __init__(self, name, handler, timeout, max_rss_bytes=None, cpu_limit=None, context=None):
+        self.name = name
+        self.handler = handler
+        self.timeout = timeout
+        self.max_rss_bytes = max_rss_bytes
+        self.cpu_limit = cpu_limit
+        self.context = context or multiprocessing.get_context('forkserver')
+        self.process = None
+        self.conn = None
+        self.restarts = 0
+        self._lock = Lock()
+
+    def start(self):
+        parent_conn, child_conn = self.context.Pipe()
+        self.process = self.context.Process(
+            target=worker_main,
+            args=(self.handler, child_conn, self.cpu_limit),
+            name=f"worker-{self.name}",
+            daemon=True
+        )
+        self.process.start()
+        child_conn.close()
+        self.conn = parent_conn
+        logger.info(f"Started {self.name} worker (pid {self.process.pid}).")
+
+    def stop(self):
+        if self.conn is not None:
+            self.conn.close()
+        if self.process is not None:
+            self.process.join(1)
+            if self.process.is_alive():
+                self.process.kill()
+                self.process.join()
+
+    def restart(self, reason):
+        logger.error(f"Restarting {self.name} worker: {reason}.")
+        if self.process is not None and self.process.is_alive():
+            self.process.kill()
+        self.stop()
+        self.restarts += 1
+        worker_restarts.labels(self.name).inc()
+        self.start()
+
+    # Sends one request and waits up to `timeout` seconds for the answer,
+    # observing the worker's phase timings here. Raises WorkerError if the
+    # worker dies or does not answer in time.
+    def call(self, request):
+        with self._lock:
+            if self.process is None:
+                self.start()
+            elif not self.process.is_alive():
+                self.restart(f"exited with code {self.process.exitcode}")
+            try:
+                self.conn.send(request)
+                if not self.conn.poll(self.timeout):
+                    self.restart(f"no answer within {self.timeout}s")
+                    raise WorkerError(f"{self.name} worker timed out")
+                response, observations = self.conn.recv()
+            except (EOFError, OSError) as err:
+                self.restart(f"exited with code {self.process.exitcode}")
+                raise WorkerError(f"{self.name} worker died") from err
+        for observation in observations:
+            instrumentation.observe_phase(*observation)
+        return response
+
+    def rss_bytes(self):
+        try:
+            with open(f"/proc/{self.process.pid}/statm") as statm:
+                return int(statm.read().split()[1]) * PAGE_SIZE
+        except (OSError, ValueError, IndexError, AttributeError):
+            return None
+
+    # Kills the worker if it is over its RSS limit. A request in flight
+    # then fails with WorkerError and the next call forks a new worker.
+    def check_memory(self):
+        rss = self.rss_bytes()
+        if rss is None:
+            return
+        worker_rss.labels(self.name).set(rss)
+        if self.max_rss_bytes and rss > self.max_rss_bytes:
+            logger.error(f"{self.name} worker is using {rss} bytes, over its {self.max_rss_bytes} byte limit.")
+            self.process.kill()
+
+
+class Supervisor:
+
+    def __init__(self, handlers, timeout=120, max_rss_bytes=None, cpu_limit=None):
+        self.workers = {
+            name: Worker(name, handler, timeout, max_rss_bytes, cpu_limit)
+            for name, handler in handlers.items()
+        }
+
+    def start(self):
+        for worker in self.workers.values():
+            worker.start()
+
+    def stop(self):
+        for worker in self.workers.values():
+            worker.stop()
+
+    def restart(self, name, reason):
+        worker = self.workers[name]
+        with worker._lock:
+            worker.restart(reason)
+
+    # Returns the worker's answer, or None if it failed
+    def call(self, name, request):
+        try:
+            return self.workers[name].call(request)
+        except WorkerError as err:
+            logger.error(err)
+            return None
+
+    def check_limits(self):
+        for worker in self.workers.values():
+            worker.check_memory()
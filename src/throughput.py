@@ -0,0 +1,156 @@
+import logging
+from threading import Lock
+from time import monotonic, perf_counter
+
+from requests import get as http_get
+
+logger = logging.getLogger('internet-speed')
+
+
+# Reads the receive/transmit byte counters from /proc/net/dev.
+# Returns {interface: (rx_bytes, tx_bytes)}; the loopback is skipped.
+def read_interface_counters(proc_path='/proc/net/dev', interfaces=None):
+    counters = {}
+    with open(proc_path) as proc_file:
+        lines = proc_file.readlines()[2:]
+    for line in lines:
+        interface, _, fields = line.partition(':')
+        interface = interface.strip()
+        if interface == 'lo' or (interfaces and interface not in interfaces):
+            continue
+        fields = fields.split()
+        counters[interface] = (int(fields[0]), int(fields[8]))
+    return counters
+
+
+# Turns successive counter reads into rates. A counter that goes backwards
+# (interface reset or 32-bit wrap) contributes nothing to that sample.
+# Returns (rx_mbps, tx_mbps), or None for the first sample.
+class InterfaceRateMeter:
+
+    def __init__(self, proc_path='/proc/net/dev', interfaces=None, clock=monotonic):
+        self.proc_path = proc_path
+        self.interfaces = interfaces
+        self.clock = clock
+        self._previous = None
+
+    def reset(self):
+        self._previous = None
+
+    def sample(self):
+        now = self.clock()
+        counters = read_interface_counters(self.proc_path, self.interfaces)
+        previous, self._previous = self._previous, (now, counters)
+        if previous is None or now <= previous[0]:
+            return None
+        elapsed = now - previous[0]
+        rx_bytes = tx_bytes = 0
+        for interface, (rx, tx) in counters.items():
+            last_rx, last_tx = previous[1].get(interface, (rx, tx))
+            rx_bytes += max(rx - last_rx, 0)
+            tx_bytes += max(tx - last_tx, 0)
+        return rx_bytes * 8 / elapsed / 1_000_000, tx_bytes * 8 / elapsed / 1_000_000
+
+
+# Downloads the first `size_bytes` of `url` with a Range request and
+# returns the throughput in Mbps, timed from the first byte of the body.
+# A server that ignores the Range header is cut off after `size_bytes`.
+def ranged_download(url, size_bytes, timeout=10):
+    received = 0
+    first_byte = None
+    try:
+        with http_get(url, headers={'Range': f"bytes=0-{size_bytes - 1}"}, stream=True, timeout=timeout) as response:
+            response.raise_for_status()
+            for chunk in response.iter_content(chunk_size=65536):
+                if first_byte is None:
+                    first_byte = perf_counter()
+                received += len(chunk)
+                if received >= size_bytes:
+                    break
+    except Exception as err:
+        logger.error(f"Throughput probe failed for {url}.")
+        logger.error(err)
+        return None
+    elapsed = perf_counter() - first_byte if first_byte is not None else 0
+    if elapsed <= 0:
+        return None
+    return received * 8 / elapsed / 1_000_000
+
+
+# Tracks link usage between full speedtests against the capacity the last
+# speedtest measured. Decides when the estimate has moved far enough
+# (`threshold`, a fraction) to be worth a full speedtest:
+#   - passive: sustained traffic above the measured capacity
+#   - probe: a ranged download `threshold` slower or faster than the first
+#     probe after the last speedtest (its baseline)
+# No more than one speedtest is asked for per `cooldown` seconds.
+class ThroughputEstimator:
+
+    def __init__(self, threshold=0.3, cooldown=600, clock=monotonic):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.clock = clock
+        self.capacity = {'download': None, 'upload': None}
+        self.throughput = {'download': None, 'upload': None}
+        self.probe_baseline = None
+        self.speedtest_running = False
+        self._last_speedtest = None
+        self._lock = Lock()
+
+    def speedtest_started(self):
+        with self._lock:
+            self.speedtest_running = True
+            self._last_speedtest = self.clock()
+
+    # Called with each speedtest result (Mbps; None if the test failed)
+    def set_capacity(self, download_mbps, upload_mbps):
+        with self._lock:
+            self.speedtest_running = False
+            self._last_speedtest = self.clock()
+            if download_mbps:
+                self.capacity['download'] = download_mbps
+            if upload_mbps:
+                self.capacity['upload'] = upload_mbps
+            self.probe_baseline = None
+
+    # Returns a reason string if a speedtest should run now, else None
+    def observe_traffic(self, rx_mbps, tx_mbps):
+        with self._lock:
+            if self.speedtest_running:
+                return None
+            self.throughput['download'], self.throughput['upload'] = rx_mbps, tx_mbps
+            for direction, mbps in self.throughput.items():
+                capacity = self.capacity[direction]
+                if capacity and mbps > capacity * (1 + self.threshold):
+                    return self._trigger(f"{direction} traffic of {mbps:.1f} Mbps is above the measured {capacity:.1f} Mbps")
+            return None
+
+    def observe_probe(self, probe_mbps):
+        with self._lock:
+            if self.speedtest_running or probe_mbps is None:
+                return None
+            if self.probe_baseline is None:
+                self.probe_baseline = probe_mbps
+                return None
+            change = (probe_mbps - self.probe_baseline) / self.probe_baseline
+            if abs(change) > self.threshold:
+                return self._trigger(f"probe throughput moved {change:+.0%} from its {self.probe_baseline:.1f} Mbps baseline")
+            return None
+
+    def _trigger(self, reason):
+        now = self.clock()
+        if self._last_speedtest is not None and now - self._last_speedtest < self.cooldown:
+            return None
+        self._last_speedtest = now
+        return reason
+
+    # Returns {direction: (throughput, utilisation, headroom)} for every
+    # direction with both a capacity and a throughput sample
+    def estimate(self):
+        with self._lock:
+            estimates = {}
+            for direction, capacity in self.capacity.items():
+                mbps = self.throughput[direction]
+                if capacity and mbps is not None:
+                    estimates[direction] = (mbps, mbps / capacity, max(capacity - mbps, 0))
+            return estimates
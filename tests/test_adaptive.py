@@ -0,0 +1,67 @@
+import unittest
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from adaptive import AdaptiveProbeRate
+
+
+class TestAdaptiveProbeRate(unittest.TestCase):
+
+    def setUp(self):
+        self.rate = AdaptiveProbeRate(confirm_interval=15, max_interval=1200, healthy_window=3, confirm_probes=2)
+
+    def probe(self, reachable, now, base_interval=300):
+        return self.rate.record('a.com', reachable, base_interval, now=now)
+
+    def test_new_targets_are_due_immediately(self):
+        self.assertEqual(self.rate.due({'a.com': 300, 'b.com': 300}, now=0), ['a.com', 'b.com'])
+
+    def test_target_is_not_due_until_its_interval_passes(self):
+        self.probe(True, now=0)
+
+        self.assertEqual(self.rate.due({'a.com': 300}, now=100), [])
+        self.assertEqual(self.rate.due({'a.com': 300}, now=295), ['a.com'])
+
+    def test_backs_off_once_consistently_healthy(self):
+        intervals = [self.probe(True, now=0)[0] for _ in range(6)]
+
+        self.assertEqual(intervals, [300, 300, 600, 1200, 1200, 1200])
+
+    def test_failure_switches_to_confirmation_probes(self):
+        for _ in range(4):
+            self.probe(True, now=0)
+
+        self.assertEqual(self.probe(False, now=0), (15, 1))
+        self.assertEqual(self.probe(False, now=15), (15, 2))
+        self.assertEqual(self.rate.due({'a.com': 300}, now=30), ['a.com'])
+
+    def test_confirmed_outage_backs_off_to_the_base_interval(self):
+        intervals = [self.probe(False, now=0)[0] for _ in range(8)]
+
+        self.assertEqual(intervals, [15, 15, 30, 60, 120, 240, 300, 300])
+
+    def test_recovery_returns_to_base_interval_and_resets_failures(self):
+        self.probe(False, now=0)
+        self.probe(False, now=15)
+
+        self.assertEqual(self.probe(True, now=30), (300, 0))
+        # The failure is still in the window, so no back-off yet
+        self.assertEqual(self.probe(True, now=330), (300, 0))
+
+    def test_flapping_target_stays_on_base_interval(self):
+        for reachable in (True, True, False, True, True):
+            interval, _ = self.probe(reachable, now=0)
+
+        self.assertEqual(interval, 300)
+
+    def test_forget(self):
+        self.probe(True, now=0)
+        self.rate.forget('a.com')
+
+        self.assertEqual(self.rate.due({'a.com': 300}, now=1), ['a.com'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+import unittest
+from unittest.mock import patch
+from socket import create_connection
+from time import sleep, monotonic, time
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from prometheus_client import generate_latest
+from agent import SiteAgent
+from aggregator import Aggregator
+from site_messages import encode_hello, encode_reachability, encode_speedtest
+from test_site_messages import SPEEDTEST_RESULT
+
+
+def wait_for(condition, timeout=3):
+    deadline = monotonic() + timeout
+    while monotonic() < deadline:
+        if condition():
+            return True
+        sleep(0.01)
+    return False
+
+
+class TestAggregator(unittest.TestCase):
+
+    def setUp(self):
+        self.aggregator = Aggregator(('127.0.0.1', 0))
+        self.aggregator.start()
+        self.addCleanup(self.aggregator.stop)
+        self.port = self.aggregator.address[1]
+
+    def value(self, name, labels):
+        return self.aggregator.registry.get_sample_value(name, labels)
+
+    def start_agent(self, site, port=None):
+        agent = SiteAgent('127.0.0.1', port or self.port, site, timeout=2, max_backoff=0.1)
+        agent.start()
+        self.addCleanup(agent.stop, 2)
+        return agent
+
+    def test_merges_sites_with_a_site_label(self):
+        for site, response_time_ms in (('site-a', 10.0), ('site-b', 20.0)):
+            agent = self.start_agent(site)
+            agent.send_reachability('HTTP', {'bbc.co.uk': {'reachable': True, 'response_time_ms': response_time_ms}})
+        self.start_agent('site-b').send_speedtest(SPEEDTEST_RESULT)
+
+        self.assertTrue(wait_for(lambda: self.value('internet_download_speed', {'site': 'site-b', 'server_name': 'Test Server', 'server_location': 'Test Location'})))
+        self.assertTrue(wait_for(lambda: self.value('internet_response_time_ms', {'site': 'site-a', 'target': 'bbc.co.uk', 'protocol': 'HTTP'})))
+        self.assertEqual(self.value('internet_response_time_ms', {'site': 'site-b', 'target': 'bbc.co.uk', 'protocol': 'HTTP'}), 20.0)
+        self.assertEqual(self.value('internet_reachability', {'site': 'site-a', 'target': 'bbc.co.uk', 'protocol': 'HTTP', 'internet_reachability': 'available'}), 1)
+        self.assertEqual(self.value('internet_download_speed', {'site': 'site-b', 'server_name': 'Test Server', 'server_location': 'Test Location'}), 100.5)
+        self.assertIsNone(self.value('internet_packet_loss', {'site': 'site-b', 'server_name': 'Test Server', 'server_location': 'Test Location'}))
+        self.assertEqual(self.value('internet_speedtest_info_info', {'site': 'site-b', 'isp': 'Test ISP', 'external_ip': '1.2.3.4'}), 1)
+        self.assertIn(b'site="site-a"', generate_latest(self.aggregator.registry))
+
+    def test_agent_queues_until_the_aggregator_is_up(self):
+        self.aggregator.stop()
+        agent = SiteAgent('127.0.0.1', self.port, 'site-a', timeout=2, max_backoff=0.1)
+        self.addCleanup(agent.stop, 2)
+        agent.start()
+        agent.send_reachability('DNS', {'1.1.1.1': {'reachable': False, 'response_time_ms': None}})
+        sleep(0.2)
+        self.assertEqual(agent.pending(), 1)
+
+        self.aggregator = Aggregator(('127.0.0.1', self.port))
+        self.aggregator.start()
+        self.addCleanup(self.aggregator.stop)
+
+        self.assertTrue(wait_for(lambda: agent.pending() == 0))
+        self.assertTrue(wait_for(lambda: self.value('internet_reachability', {'site': 'site-a', 'target': '1.1.1.1', 'protocol': 'DNS', 'internet_reachability': 'unavailable'}) == 1))
+
+    def test_stale_results_expire(self):
+        now = [1000]
+        aggregator = Aggregator(('127.0.0.1', 0), max_age=60, clock=lambda: now[0])
+        aggregator.start()
+        self.addCleanup(aggregator.stop)
+        with create_connection(aggregator.address) as connection:
+            connection.sendall(encode_hello('site-a') + encode_reachability(1000, 'HTTP', 'a.com', {'reachable': True, 'response_time_ms': 5.0}))
+            self.assertTrue(wait_for(lambda: aggregator.registry.get_sample_value('internet_response_time_ms', {'site': 'site-a', 'target': 'a.com', 'protocol': 'HTTP'})))
+
+            now[0] += 61
+            self.assertIsNone(aggregator.registry.get_sample_value('internet_response_time_ms', {'site': 'site-a', 'target': 'a.com', 'protocol': 'HTTP'}))
+            self.assertEqual(aggregator.registry.get_sample_value('aggregator_site_connections', {'site': 'site-a'}), 1)
+
+    def test_replayed_results_use_the_measurement_time(self):
+        now = [1000]
+        aggregator = Aggregator(('127.0.0.1', 0), max_age=60, clock=lambda: now[0])
+        aggregator.start()
+        self.addCleanup(aggregator.stop)
+        labels = {'site': 'site-a', 'target': 'a.com', 'protocol': 'HTTP'}
+        with create_connection(aggregator.address) as connection:
+            connection.sendall(encode_hello('site-a') +
+                encode_reachability(990, 'HTTP', 'a.com', {'reachable': True, 'response_time_ms': 5.0}) +
+                encode_reachability(900, 'HTTP', 'a.com', {'reachable': True, 'response_time_ms': 7.0}) +
+                encode_reachability(800, 'HTTP', 'b.com', {'reachable': True, 'response_time_ms': 9.0}))
+            self.assertTrue(wait_for(lambda: aggregator.registry.get_sample_value('aggregator_site_last_seen_timestamp_seconds', {'site': 'site-a'})))
+            sleep(0.1)
+
+            self.assertEqual(aggregator.registry.get_sample_value('internet_response_time_ms', labels), 5.0)
+            self.assertIsNone(aggregator.registry.get_sample_value('internet_response_time_ms', {**labels, 'target': 'b.com'}))
+
+    def test_one_info_sample_per_site(self):
+        other_server = {**SPEEDTEST_RESULT, 'server': {'id': 2, 'name': 'Other Server', 'location': 'Elsewhere'}, 'external_ip': '5.6.7.8'}
+        with create_connection(('127.0.0.1', self.port)) as connection:
+            connection.sendall(encode_hello('site-a') + encode_speedtest(time() - 10, SPEEDTEST_RESULT) + encode_speedtest(time(), other_server))
+            self.assertTrue(wait_for(lambda: self.value('internet_download_speed', {'site': 'site-a', 'server_name': 'Other Server', 'server_location': 'Elsewhere'})))
+            self.assertTrue(wait_for(lambda: self.value('internet_download_speed', {'site': 'site-a', 'server_name': 'Test Server', 'server_location': 'Test Location'})))
+
+        exposition = generate_latest(self.aggregator.registry).decode()
+        self.assertEqual(exposition.count('internet_speedtest_info_info{'), 1)
+        self.assertEqual(self.value('internet_speedtest_info_info', {'site': 'site-a', 'isp': 'Test ISP', 'external_ip': '5.6.7.8'}), 1)
+
+    def test_connection_without_hello_is_dropped(self):
+        with create_connection(('127.0.0.1', self.port)) as connection:
+            connection.sendall(encode_reachability(0, 'HTTP', 'a.com', {'reachable': True, 'response_time_ms': 5.0}))
+            connection.settimeout(2)
+            self.assertEqual(connection.recv(1), b'')
+
+        self.assertIsNone(self.value('internet_response_time_ms', {'site': '', 'target': 'a.com', 'protocol': 'HTTP'}))
+
+
+class TestAgentPublishing(unittest.TestCase):
+
+    @patch('monitor.history', None)
+    @patch('monitor.adaptive_rates', None)
+    def test_publish_sends_results_to_the_agent(self):
+        import monitor
+        aggregator = Aggregator(('127.0.0.1', 0))
+        aggregator.start()
+        self.addCleanup(aggregator.stop)
+        agent = SiteAgent('127.0.0.1', aggregator.address[1], 'site-a')
+        agent.start()
+        self.addCleanup(agent.stop, 2)
+
+        with patch('monitor.site_agent', agent), patch('monitor.configured_targets', return_value=['a.com']):
+            monitor.publish_http_checks({'a.com': {'reachable': True, 'response_time_ms': 7.0}}, 10)
+
+        self.assertTrue(wait_for(lambda: aggregator.registry.get_sample_value('internet_response_time_ms', {'site': 'site-a', 'target': 'a.com', 'protocol': 'HTTP'}) == 7.0))
+
+
+if __name__ == '__main__':
+    unittest.main()
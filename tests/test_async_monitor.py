@@ -0,0 +1,287 @@
+import unittest
+from unittest.mock import patch, MagicMock, AsyncMock
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from json import dumps as json_dumps
+import asyncio
+import gzip
+import socket
+import threading
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+sys.path.insert(0, os.path.dirname(__file__))
+
+from prometheus_client import CollectorRegistry, Gauge
+from async_monitor import request_headers, gather_checks, check_dns_connect_async, query_resolver_async, \
+    run_speedtest_async, run_speedtest_streaming_async, speedtest_check_async, check_http_domain_async, \
+    start_metrics_server
+from exposition import CachedExposition
+from profiler import SamplingProfiler
+from test_dns_client import StubResolver
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        if self.path == '/redirect':
+            self.send_response(302)
+            self.send_header('Location', '/')
+        else:
+            self.send_response(204)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        body = b'x' * 100000
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        Handler.gets += 1
+        self.wfile.write(body)
+
+Handler.gets = 0
+
+
+class TestAsyncHttp(unittest.IsolatedAsyncioTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        cls.base_url = f"http://127.0.0.1:{cls.server.server_address[1]}"
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    async def test_reads_status_and_location(self):
+        status_code, location = await request_headers(self.base_url + '/redirect', 'HEAD', 3)
+
+        self.assertEqual(status_code, 302)
+        self.assertEqual(location, '/')
+
+    async def test_reads_the_body_when_asked(self):
+        status_code, _ = await request_headers(self.base_url + '/', 'GET', 3, read_body=True)
+
+        self.assertEqual(status_code, 200)
+        self.assertEqual(Handler.gets, 1)
+
+    async def test_probe_method_selects_the_request(self):
+        sent = []
+
+        async def fake_request(url, method, timeout, read_body=False):
+            sent.append((method, read_body))
+            return 200, None
+
+        with patch('async_monitor.request_headers', fake_request), patch('monitor.inventory', None):
+            for probe_method in ('get', 'stream', 'head'):
+                with patch('monitor.http_probe_method', probe_method):
+                    await check_http_domain_async('example.com')
+
+        self.assertEqual(sent, [('GET', True), ('GET', False), ('HEAD', False)])
+
+    async def test_gather_checks_bounds_concurrency(self):
+        in_flight = 0
+        peak = 0
+
+        async def check(target):
+            nonlocal in_flight, peak
+            in_flight += 1
+            peak = max(peak, in_flight)
+            await asyncio.sleep(0.01)
+            in_flight -= 1
+            return {'reachable': True, 'response_time_ms': 10}
+
+        results = await gather_checks(check, [f"t{i}" for i in range(20)], concurrency=5, deadline=5)
+
+        self.assertEqual(len(results), 20)
+        self.assertEqual(peak, 5)
+
+    async def test_gather_checks_deadline(self):
+        async def check(target):
+            await asyncio.sleep(0 if target == 'fast' else 10)
+            return {'reachable': True, 'response_time_ms': 1}
+
+        results = await gather_checks(check, ['fast', 'slow'], concurrency=2, deadline=0.1)
+
+        self.assertTrue(results['fast']['reachable'])
+        self.assertEqual(results['slow'], {'reachable': False, 'response_time_ms': None})
+
+
+class TestAsyncDns(unittest.IsolatedAsyncioTestCase):
+
+    async def test_connect_to_listening_port(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(4)
+
+        result = await check_dns_connect_async('127.0.0.1', port=listener.getsockname()[1])
+        listener.close()
+
+        self.assertTrue(result['reachable'])
+
+    async def test_connect_refused(self):
+        closed = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        closed.bind(('127.0.0.1', 0))
+        port = closed.getsockname()[1]
+        closed.close()
+
+        result = await check_dns_connect_async('127.0.0.1', port=port)
+
+        self.assertEqual(result, {'reachable': False, 'response_time_ms': None})
+
+    async def test_query_against_stub_resolver(self):
+        resolver = StubResolver()
+
+        results = await query_resolver_async('127.0.0.1', ['example.com', 'nxdomain.test', 'big.test', 'silent.test'], ['A'], port=resolver.port, timeout=0.5)
+        resolver.close()
+
+        rcodes = {result['name']: result['rcode'] for result in results}
+        self.assertEqual(rcodes, {'example.com': 'NOERROR', 'nxdomain.test': 'NXDOMAIN', 'big.test': 'NOERROR', 'silent.test': 'TIMEOUT'})
+        self.assertEqual(resolver.tcp_queries, 1)
+
+
+class TestAsyncSpeedtest(unittest.IsolatedAsyncioTestCase):
+
+    @patch('async_monitor.asyncio.create_subprocess_exec')
+    async def test_parses_output(self, mock_exec):
+        output = {
+            'download': {'bandwidth': 12500000, 'latency': {}},
+            'upload': {'bandwidth': 6250000, 'latency': {}},
+            'server': {'name': 'Test Server', 'location': 'Test Location'}
+        }
+        process = MagicMock()
+        process.communicate = AsyncMock(return_value=(json_dumps(output).encode(), b''))
+        process.returncode = 0
+        mock_exec.return_value = process
+
+        result = await run_speedtest_async()
+
+        self.assertEqual(result['download']['download_speed'], 100)
+        self.assertEqual(result['server']['name'], 'Test Server')
+
+    @patch('async_monitor.asyncio.create_subprocess_exec')
+    async def test_timeout(self, mock_exec):
+        async def hang():
+            await asyncio.sleep(10)
+
+        process = MagicMock()
+        process.communicate = hang
+        process.wait = AsyncMock()
+        mock_exec.return_value = process
+
+        result = await run_speedtest_async(timeout=0.05)
+
+        self.assertEqual(result, {})
+        process.kill.assert_called_once()
+
+
+    @patch('async_monitor.asyncio.create_subprocess_exec')
+    async def test_streams_jsonl_events(self, mock_exec):
+        events = [
+            {'type': 'testStart', 'isp': 'Test ISP', 'server': {'name': 'Test Server', 'location': 'Test Location'}},
+            {'type': 'download', 'download': {'bandwidth': 12500000, 'progress': 0.5}},
+            {'type': 'result', 'download': {'bandwidth': 12500000, 'latency': {}}, 'upload': {'bandwidth': 6250000, 'latency': {}},
+             'server': {'name': 'Test Server', 'location': 'Test Location'}}
+        ]
+
+        async def lines():
+            for event in events:
+                yield (json_dumps(event) + '\n').encode()
+
+        process = MagicMock()
+        process.stdout = lines()
+        process.wait = AsyncMock()
+        process.returncode = 0
+        mock_exec.return_value = process
+        phases = []
+
+        result = await run_speedtest_streaming_async(on_phase=phases.append)
+
+        self.assertIn('--format=jsonl', mock_exec.call_args[0])
+        self.assertEqual(result['download']['download_speed'], 100)
+        self.assertEqual(phases, ['download'])
+
+    @patch('async_monitor.asyncio.create_subprocess_exec')
+    async def test_kills_streaming_speedtest_when_reading_fails(self, mock_exec):
+        async def lines():
+            yield b'123\n'
+            yield (json_dumps({'type': 'download', 'download': {'bandwidth': 12500000, 'progress': 0.5}}) + '\n').encode()
+
+        process = MagicMock()
+        process.stdout = lines()
+        process.wait = AsyncMock()
+        process.returncode = None
+        mock_exec.return_value = process
+
+        with self.assertRaises(RuntimeError):
+            await run_speedtest_streaming_async(on_phase=MagicMock(side_effect=RuntimeError("boom")))
+
+        process.kill.assert_called_once()
+
+    @patch('monitor.throughput_estimator', None)
+    @patch('monitor.latency_under_load', None)
+    @patch('monitor.export_speedtest_results')
+    @patch('monitor.publish_speedtest_result')
+    @patch('monitor.next_speedtest_servers', return_value=[None])
+    async def test_triggered_speedtest_does_not_overlap_a_running_one(self, *_):
+        runs = []
+
+        async def slow_speedtest(server_ids=None):
+            runs.append(server_ids)
+            await asyncio.sleep(0.05)
+            return {}
+
+        with patch('async_monitor.run_speedtest_async', slow_speedtest):
+            await asyncio.gather(speedtest_check_async(), speedtest_check_async())
+            await speedtest_check_async()
+
+        self.assertEqual(len(runs), 2)
+
+
+class TestAsyncMetricsServer(unittest.IsolatedAsyncioTestCase):
+
+    async def scrape(self, port, request):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(request)
+        await writer.drain()
+        response = await reader.read()
+        writer.close()
+        return response
+
+    async def test_serves_metrics_from_the_event_loop(self):
+        registry = CollectorRegistry()
+        Gauge('loop_value', 'Loop value', registry=registry).set(3)
+        server = await start_metrics_server(CachedExposition(registry, max_age=0), port=0, host='127.0.0.1')
+        port = server.sockets[0].getsockname()[1]
+
+        plain = await self.scrape(port, b"GET /metrics HTTP/1.1\r\nHost: x\r\n\r\n")
+        gzipped = await self.scrape(port, b"GET /metrics HTTP/1.1\r\nAccept-Encoding: gzip\r\n\r\n")
+        missing = await self.scrape(port, b"GET /nope HTTP/1.1\r\n\r\n")
+        server.close()
+        await server.wait_closed()
+
+        self.assertIn(b'loop_value 3.0', plain)
+        self.assertIn(b'Content-Encoding: gzip', gzipped)
+        self.assertIn(b'loop_value 3.0', gzip.decompress(gzipped.split(b'\r\n\r\n', 1)[1]))
+        self.assertTrue(missing.startswith(b'HTTP/1.1 404'))
+
+    async def test_profile_rejects_bad_seconds(self):
+        server = await start_metrics_server(CachedExposition(CollectorRegistry(), max_age=0), port=0, host='127.0.0.1', profiler=SamplingProfiler())
+        port = server.sockets[0].getsockname()[1]
+
+        response = await self.scrape(port, b"GET /debug/profile?seconds=abc HTTP/1.1\r\n\r\n")
+        server.close()
+        await server.wait_closed()
+
+        self.assertTrue(response.startswith(b'HTTP/1.1 400'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,161 @@
+import unittest
+from unittest.mock import patch
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from prometheus_client import REGISTRY
+from bufferbloat import LatencyUnderLoad, bufferbloat_grade
+from test_ping import UdpEchoServer
+
+
+class FakeSampler:
+
+    def __init__(self, targets, **kwargs):
+        self.listeners = []
+        self.started = False
+        self.stopped = False
+
+    def start(self):
+        self.started = True
+
+    def stop(self, timeout=None):
+        self.stopped = True
+
+
+def make_latency(**kwargs):
+    return LatencyUnderLoad(['10.0.0.1'], idle_seconds=0, sampler_factory=FakeSampler, **kwargs)
+
+
+class TestBufferbloatGrade(unittest.TestCase):
+
+    def test_grades(self):
+        self.assertEqual(bufferbloat_grade(0), 'A+')
+        self.assertEqual(bufferbloat_grade(20), 'A')
+        self.assertEqual(bufferbloat_grade(45), 'B')
+        self.assertEqual(bufferbloat_grade(150), 'C')
+        self.assertEqual(bufferbloat_grade(300), 'D')
+        self.assertEqual(bufferbloat_grade(1000), 'F')
+
+
+class TestLatencyUnderLoad(unittest.TestCase):
+
+    def test_files_samples_under_the_current_phase(self):
+        latency = make_latency()
+
+        with latency.measuring():
+            for rtt in [10, 12, 11]:
+                latency.record('10.0.0.1', rtt)
+            latency.set_phase('download')
+            for rtt in [50, 70, None, 60]:
+                latency.record('10.0.0.1', rtt)
+            latency.set_phase('upload')
+            for rtt in [20, 25, 30]:
+                latency.record('10.0.0.1', rtt)
+
+        result = latency.result((0.5, 0.9))
+
+        self.assertEqual(set(result['phases']), {'idle', 'download', 'upload'})
+        self.assertEqual(result['phases']['idle']['rtt']['0.5'], 11)
+        self.assertEqual(result['phases']['download']['loss'], 0.25)
+        self.assertEqual(result['increase_ms'], {'download': 49, 'upload': 14})
+        self.assertEqual(result['grade'], 'B')
+
+    def test_keeps_targets_apart(self):
+        latency = make_latency()
+
+        with latency.measuring():
+            for _ in range(3):
+                latency.record('near', 10)
+                latency.record('far', 100)
+            latency.set_phase('download')
+            for _ in range(3):
+                latency.record('near', 30)
+                latency.record('far', 110)
+                latency.record('mid', 50)
+
+        result = latency.result()
+
+        self.assertEqual(result['phases']['idle']['jitter'], 0)
+        self.assertEqual(result['phases']['download']['sent'], 9)
+        self.assertEqual(result['phases']['download']['rtt']['0.5'], 50)
+        # 'mid' has no idle baseline; near rose by 20 and far by 10
+        self.assertEqual(result['increase_ms'], {'download': 15})
+
+    def test_stops_sampler_and_listening(self):
+        latency = make_latency()
+
+        with latency.measuring():
+            sampler = latency._sampler
+            self.assertTrue(sampler.started)
+            self.assertEqual(sampler.listeners, [latency.record])
+
+        self.assertTrue(sampler.stopped)
+        self.assertEqual(sampler.listeners, [])
+
+    def test_each_measurement_starts_idle_and_empty(self):
+        latency = make_latency()
+        with latency.measuring():
+            latency.set_phase('upload')
+            latency.record('10.0.0.1', 40)
+
+        with latency.measuring():
+            latency.record('10.0.0.1', 10)
+
+        result = latency.result()
+        self.assertEqual(set(result['phases']), {'idle'})
+        self.assertIsNone(result['grade'])
+
+    def test_pings_a_udp_echo_server(self):
+        server = UdpEchoServer()
+        self.addCleanup(server.close)
+        latency = LatencyUnderLoad(['127.0.0.1'], rate=50, idle_seconds=0.3, timeout=0.5, mode='udp', udp_port=server.port)
+
+        with latency.measuring():
+            pass
+
+        result = latency.result()
+        self.assertGreater(result['phases']['idle']['sent'], 5)
+        self.assertEqual(result['phases']['idle']['loss'], 0)
+
+
+class TestMeasureSpeedtestUnderLoad(unittest.TestCase):
+
+    def fake_streaming_speedtest(self, latency):
+        def run(server_ids=None, on_phase=None):
+            latency.record('10.0.0.1', 10)
+            on_phase('download')
+            latency.record('10.0.0.1', 100)
+            on_phase('upload')
+            latency.record('10.0.0.1', 30)
+            return {'server': {'name': 'Test Server', 'location': 'Test Location'}}
+        return run
+
+    @patch('monitor.speedtest_mode', 'jsonl')
+    def test_adds_bufferbloat_to_the_result_and_publishes_it(self):
+        import monitor
+        latency = make_latency()
+
+        with patch('monitor.latency_under_load', latency), \
+                patch('monitor.run_speedtest_streaming', side_effect=self.fake_streaming_speedtest(latency)), \
+                patch('monitor.speedtest_results'):
+            internet_speed = monitor.measure_speedtest(None)
+            monitor.publish_speedtest_result(internet_speed, 1000)
+
+        self.assertEqual(internet_speed['bufferbloat']['grade'], 'C')
+        self.assertEqual(REGISTRY.get_sample_value('internet_bufferbloat_rtt_ms', {'phase': 'download', 'quantile': '0.5'}), 100)
+        self.assertEqual(REGISTRY.get_sample_value('internet_bufferbloat_latency_increase_ms', {'phase': 'upload'}), 20)
+        self.assertEqual(REGISTRY.get_sample_value('internet_bufferbloat_grade', {'internet_bufferbloat_grade': 'C'}), 1)
+
+    @patch('monitor.speedtest_mode', 'json')
+    @patch('monitor.run_speedtest', return_value={})
+    def test_failed_speedtest_has_no_bufferbloat(self, mock_run_speedtest):
+        import monitor
+
+        with patch('monitor.latency_under_load', make_latency()):
+            self.assertEqual(monitor.measure_speedtest(None), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+import unittest
+from unittest.mock import patch
+from threading import Thread, Event
+from time import sleep
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from prometheus_client import REGISTRY
+from coordination import LinkCoordinator
+
+
+class TestLinkCoordinator(unittest.TestCase):
+
+    def test_busy_only_inside_the_block(self):
+        coordinator = LinkCoordinator()
+
+        with coordinator.busy():
+            self.assertTrue(coordinator.is_busy())
+        self.assertFalse(coordinator.is_busy())
+
+    def test_busy_until_every_speedtest_finishes(self):
+        coordinator = LinkCoordinator()
+
+        with coordinator.busy():
+            with coordinator.busy():
+                pass
+            self.assertTrue(coordinator.is_busy())
+
+    def test_wait_until_idle(self):
+        coordinator = LinkCoordinator()
+        started, finish = Event(), Event()
+
+        def speedtest():
+            with coordinator.busy():
+                started.set()
+                finish.wait()
+
+        thread = Thread(target=speedtest)
+        thread.start()
+        started.wait()
+
+        self.assertFalse(coordinator.wait_until_idle(0.05))
+        finish.set()
+        self.assertTrue(coordinator.wait_until_idle(2))
+        thread.join()
+
+    def test_idle_link_returns_at_once(self):
+        self.assertTrue(LinkCoordinator().wait_until_idle(0))
+
+    def test_overlapped(self):
+        coordinator = LinkCoordinator()
+
+        mark = coordinator.mark()
+        self.assertFalse(coordinator.overlapped(mark))
+
+        with coordinator.busy():
+            self.assertTrue(coordinator.overlapped(mark))
+            busy_mark = coordinator.mark()
+        self.assertTrue(coordinator.overlapped(busy_mark))
+
+        # A speedtest that started and finished while probing
+        self.assertTrue(coordinator.overlapped(mark))
+        self.assertFalse(coordinator.overlapped(coordinator.mark()))
+
+
+class TestCoordinatedChecks(unittest.TestCase):
+
+    def run_http_check_during_speedtest(self, coordinator):
+        import monitor
+        started = Event()
+
+        def speedtest():
+            with coordinator.busy():
+                started.set()
+                sleep(0.2)
+
+        thread = Thread(target=speedtest)
+        thread.start()
+        started.wait()
+        with patch('monitor.link_coordinator', coordinator), \
+                patch('monitor.due_targets', return_value=['a.com']), \
+                patch('monitor.measure_http', side_effect=lambda domains: {'a.com': {'reachable': True, 'response_time_ms': 5.0, 'idle': not coordinator.is_busy()}}), \
+                patch('monitor.publish_http_checks') as mock_publish:
+            monitor.http_check()
+        thread.join()
+        return mock_publish.call_args[0][0]['a.com']
+
+    @patch('monitor.probe_during_speedtest', 'defer')
+    def test_defer_waits_for_the_speedtest(self):
+        before = REGISTRY.get_sample_value('probes_deferred_total', {'protocol': 'HTTP'}) or 0
+
+        check = self.run_http_check_during_speedtest(LinkCoordinator())
+
+        self.assertTrue(check['idle'])
+        self.assertNotIn('during_speedtest', check)
+        self.assertEqual(REGISTRY.get_sample_value('probes_deferred_total', {'protocol': 'HTTP'}) - before, 1)
+
+    @patch('monitor.probe_during_speedtest', 'defer')
+    @patch('monitor.probe_defer_max', 0.01)
+    def test_defer_gives_up_after_the_maximum(self):
+        check = self.run_http_check_during_speedtest(LinkCoordinator())
+
+        self.assertFalse(check['idle'])
+        self.assertTrue(check['during_speedtest'])
+
+    @patch('monitor.probe_during_speedtest', 'tag')
+    def test_tag_runs_and_marks_the_checks(self):
+        check = self.run_http_check_during_speedtest(LinkCoordinator())
+
+        self.assertFalse(check['idle'])
+        self.assertTrue(check['during_speedtest'])
+
+
+if __name__ == '__main__':
+    unittest.main()
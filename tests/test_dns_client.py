@@ -0,0 +1,231 @@
+import unittest
+from unittest.mock import patch
+from time import perf_counter
+import socket
+import struct
+import threading
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from dns_client import build_query, parse_response_header, query_resolvers, summarise_query_results, supported_query_types
+
+
+def read_question_name(query):
+    labels = []
+    offset = 12
+    while query[offset]:
+        length = query[offset]
+        labels.append(query[offset + 1:offset + 1 + length].decode())
+        offset += length + 1
+    return '.'.join(labels)
+
+
+def build_response(query, rcode=0, truncated=False):
+    flags = 0x8180 | rcode | (0x0200 if truncated else 0)
+    return query[:2] + struct.pack('!H', flags) + query[4:]
+
+
+# Answers over UDP and TCP on the same port:
+#   nxdomain.test  -> NXDOMAIN
+#   big.test       -> truncated over UDP, full answer over TCP
+#   silent.test    -> never answered
+#   anything else  -> NOERROR
+class StubResolver:
+
+    def __init__(self):
+        self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp.bind(('127.0.0.1', 0))
+        self.port = self.udp.getsockname()[1]
+        self.tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.tcp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.tcp.bind(('127.0.0.1', self.port))
+        self.tcp.listen(4)
+        self.udp_queries = 0
+        self.tcp_queries = 0
+        self.sources = set()
+        threading.Thread(target=self.serve_udp, daemon=True).start()
+        threading.Thread(target=self.serve_tcp, daemon=True).start()
+
+    def answer(self, query, over_tcp):
+        name = read_question_name(query)
+        if name == 'silent.test':
+            return None
+        if name == 'nxdomain.test':
+            return build_response(query, rcode=3)
+        return build_response(query, truncated=(name == 'big.test' and not over_tcp))
+
+    def serve_udp(self):
+        while True:
+            try:
+                query, source = self.udp.recvfrom(512)
+            except OSError:
+                return
+            self.udp_queries += 1
+            self.sources.add(source)
+            response = self.answer(query, over_tcp=False)
+            if response is not None:
+                self.udp.sendto(response, source)
+
+    def serve_tcp(self):
+        while True:
+            try:
+                conn, _ = self.tcp.accept()
+            except OSError:
+                return
+            with conn:
+                length = struct.unpack('!H', conn.recv(2))[0]
+                query = conn.recv(length)
+                self.tcp_queries += 1
+                response = self.answer(query, over_tcp=True)
+                conn.sendall(struct.pack('!H', len(response)) + response)
+
+    def close(self):
+        self.udp.close()
+        self.tcp.close()
+
+
+class TestBuildQuery(unittest.TestCase):
+
+    def test_encodes_header_and_question(self):
+        query = build_query(0x1234, "example.com", "A")
+
+        self.assertEqual(query[:2], b'\x12\x34')
+        self.assertEqual(read_question_name(query), 'example.com')
+        self.assertEqual(query[-4:], b'\x00\x01\x00\x01')
+
+    def test_encodes_aaaa_type(self):
+        query = build_query(1, "example.com.", "AAAA")
+
+        self.assertEqual(query[-4:], b'\x00\x1c\x00\x01')
+
+
+    def test_supported_query_types(self):
+        self.assertEqual(supported_query_types(['a', 'mx', 'bogus', 'A']), ['A', 'MX'])
+
+
+class TestParseResponseHeader(unittest.TestCase):
+
+    def test_reads_rcode_and_truncation(self):
+        response = build_response(build_query(7, "example.com", "A"), rcode=3, truncated=True)
+
+        header = parse_response_header(response)
+
+        self.assertEqual(header['transaction_id'], 7)
+        self.assertTrue(header['is_response'])
+        self.assertTrue(header['truncated'])
+        self.assertEqual(header['rcode'], 'NXDOMAIN')
+
+
+class TestQueryResolvers(unittest.TestCase):
+
+    def setUp(self):
+        self.resolver = StubResolver()
+
+    def tearDown(self):
+        self.resolver.close()
+
+    def query(self, names, query_types=('A', 'AAAA'), timeout=2):
+        return query_resolvers(['127.0.0.1'], names, list(query_types), port=self.resolver.port, timeout=timeout)
+
+    def test_answers_every_name_and_type(self):
+        results = self.query(['example.com', 'example.org'])
+
+        answered = {(query['name'], query['type']) for query in results['127.0.0.1']}
+        self.assertEqual(answered, {
+            ('example.com', 'A'), ('example.com', 'AAAA'),
+            ('example.org', 'A'), ('example.org', 'AAAA')
+        })
+        for query in results['127.0.0.1']:
+            self.assertEqual(query['rcode'], 'NOERROR')
+            self.assertIsNotNone(query['response_time_ms'])
+
+    def test_reuses_one_socket_per_resolver(self):
+        self.query(['example.com', 'example.org'])
+
+        self.assertEqual(self.resolver.udp_queries, 4)
+        self.assertEqual(len(self.resolver.sources), 1)
+
+    def test_reports_rcode(self):
+        results = self.query(['nxdomain.test'], query_types=['A'])
+
+        self.assertEqual(results['127.0.0.1'][0]['rcode'], 'NXDOMAIN')
+
+    def test_falls_back_to_tcp_on_truncation(self):
+        results = self.query(['big.test'], query_types=['A'])
+
+        self.assertEqual(self.resolver.tcp_queries, 1)
+        self.assertEqual(results['127.0.0.1'][0]['rcode'], 'NOERROR')
+
+    def test_tcp_fallback_waits_for_the_udp_answers(self):
+        results = self.query(['big.test', 'example.com'], query_types=['A'])
+
+        rcodes = {query['name']: query['rcode'] for query in results['127.0.0.1']}
+        self.assertEqual(rcodes, {'big.test': 'NOERROR', 'example.com': 'NOERROR'})
+        self.assertEqual([query['name'] for query in results['127.0.0.1']], ['example.com', 'big.test'])
+
+    def test_failed_send_is_an_error_at_once(self):
+        class FailingSocket(socket.socket):
+            def send(self, data):
+                raise OSError('No buffer space available')
+
+        with patch('dns_client.socket', FailingSocket):
+            start = perf_counter()
+            results = self.query(['example.com'], query_types=['A'], timeout=2)
+
+        self.assertLess(perf_counter() - start, 1)
+        self.assertEqual(results['127.0.0.1'][0]['rcode'], 'ERROR')
+
+    def test_refused_resolver_closes_its_socket(self):
+        sockets = []
+
+        class TrackedSocket(socket.socket):
+            def __init__(self, *args, **kwargs):
+                super().__init__(*args, **kwargs)
+                sockets.append(self)
+
+        closed_port = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        closed_port.bind(('127.0.0.1', 0))
+        port = closed_port.getsockname()[1]
+        closed_port.close()
+
+        with patch('dns_client.socket', TrackedSocket):
+            results = query_resolvers(['127.0.0.1'], ['example.com'], ['A'], port=port, timeout=2)
+            self.assertEqual(results['127.0.0.1'][0]['rcode'], 'ERROR')
+            self.assertEqual([sock.fileno() for sock in sockets], [-1])
+
+    def test_unanswered_query_times_out(self):
+        results = self.query(['silent.test'], query_types=['A'], timeout=0.2)
+
+        self.assertEqual(results['127.0.0.1'][0]['rcode'], 'TIMEOUT')
+        self.assertIsNone(results['127.0.0.1'][0]['response_time_ms'])
+
+    def test_invalid_resolver_reports_error(self):
+        results = query_resolvers(['not an ip'], ['example.com'], ['A'], timeout=0.2)
+
+        self.assertEqual(results['not an ip'][0]['rcode'], 'ERROR')
+
+
+class TestSummariseQueryResults(unittest.TestCase):
+
+    def test_reachable_with_mean_response_time(self):
+        results = {'1.1.1.1': [
+            {'name': 'a', 'type': 'A', 'rcode': 'NOERROR', 'response_time_ms': 10},
+            {'name': 'a', 'type': 'AAAA', 'rcode': 'NXDOMAIN', 'response_time_ms': 20}
+        ]}
+
+        summary = summarise_query_results(results)
+
+        self.assertEqual(summary['1.1.1.1'], {'reachable': True, 'response_time_ms': 15})
+
+    def test_unreachable_when_nothing_answered(self):
+        results = {'1.1.1.1': [{'name': 'a', 'type': 'A', 'rcode': 'TIMEOUT', 'response_time_ms': None}]}
+
+        summary = summarise_query_results(results)
+
+        self.assertEqual(summary['1.1.1.1'], {'reachable': False, 'response_time_ms': None})
+
+
+if __name__ == '__main__':
+    unittest.main()
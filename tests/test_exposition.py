@@ -0,0 +1,131 @@
+import unittest
+from unittest.mock import patch
+from urllib.request import urlopen, Request
+from urllib.error import HTTPError
+import gzip
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from prometheus_client import CollectorRegistry, Gauge
+import exposition
+from exposition import CachedExposition, start_cached_http_server
+from profiler import SamplingProfiler
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestCachedExposition(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = CollectorRegistry()
+        self.gauge = Gauge('test_value', 'Test value', registry=self.registry)
+        self.clock = FakeClock()
+        self.exposition = CachedExposition(self.registry, max_age=15, clock=self.clock)
+
+    def test_first_scrape_builds_exposition(self):
+        self.gauge.set(5)
+
+        body, is_gzipped = self.exposition.body(accept_gzip=False)
+
+        self.assertFalse(is_gzipped)
+        self.assertIn(b'test_value 5.0', body)
+
+    def test_scrapes_reuse_cached_body_until_refresh(self):
+        self.exposition.refresh()
+        self.gauge.set(7)
+
+        with patch('exposition.generate_latest', wraps=exposition.generate_latest) as mock_generate:
+            body, _ = self.exposition.body(accept_gzip=False)
+            self.exposition.body(accept_gzip=False)
+            mock_generate.assert_not_called()
+
+        self.assertIn(b'test_value 0.0', body)
+        self.exposition.refresh()
+        self.assertIn(b'test_value 7.0', self.exposition.body(accept_gzip=False)[0])
+
+    def test_gzip_body_is_precompressed(self):
+        self.gauge.set(3)
+        self.exposition.refresh()
+
+        body, is_gzipped = self.exposition.body(accept_gzip=True)
+
+        self.assertTrue(is_gzipped)
+        self.assertIn(b'test_value 3.0', gzip.decompress(body))
+
+    def test_rebuilds_when_older_than_max_age(self):
+        self.exposition.refresh()
+        self.gauge.set(9)
+        self.clock.now += 16
+
+        body, _ = self.exposition.body(accept_gzip=False)
+
+        self.assertIn(b'test_value 9.0', body)
+
+
+class TestCachedHttpServer(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.registry = CollectorRegistry()
+        Gauge('served_value', 'Served value', registry=cls.registry).set(42)
+        cls.server = start_cached_http_server(0, CachedExposition(cls.registry), addr='127.0.0.1', profiler=SamplingProfiler(interval=0.005))
+        cls.url = f"http://127.0.0.1:{cls.server.server_address[1]}"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def test_serves_plain_text(self):
+        with urlopen(self.url + '/metrics') as response:
+            self.assertIsNone(response.headers.get('Content-Encoding'))
+            self.assertIn(b'served_value 42.0', response.read())
+
+    def test_serves_gzip_when_accepted(self):
+        request = Request(self.url + '/metrics', headers={'Accept-Encoding': 'gzip'})
+
+        with urlopen(request) as response:
+            self.assertEqual(response.headers.get('Content-Encoding'), 'gzip')
+            self.assertIn(b'served_value 42.0', gzip.decompress(response.read()))
+
+    def test_unknown_path_is_404(self):
+        with self.assertRaises(HTTPError) as context:
+            urlopen(self.url + '/other')
+
+        self.assertEqual(context.exception.code, 404)
+
+    def test_profile_endpoint(self):
+        with urlopen(self.url + '/debug/profile?seconds=0.05') as response:
+            body = response.read().decode('utf-8')
+
+        self.assertEqual(response.headers.get('Content-Type'), 'text/plain; charset=utf-8')
+        self.assertIn('metrics-server;', body)
+
+    def test_profile_endpoint_rejects_bad_seconds(self):
+        with self.assertRaises(HTTPError) as context:
+            urlopen(self.url + '/debug/profile?seconds=abc')
+
+        self.assertEqual(context.exception.code, 400)
+
+    def test_no_profile_endpoint_without_profiler(self):
+        server = start_cached_http_server(0, CachedExposition(self.registry), addr='127.0.0.1')
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        with self.assertRaises(HTTPError) as context:
+            urlopen(f"http://127.0.0.1:{server.server_address[1]}/debug/profile")
+
+        self.assertEqual(context.exception.code, 404)
+
+
+if __name__ == '__main__':
+    unittest.main()
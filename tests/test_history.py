@@ -0,0 +1,112 @@
+import unittest
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from history import HistoryStore, HOUR, DAY
+
+
+class FakeClock:
+
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class TestHistoryStore(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.directory.name, 'history.db')
+        self.clock = FakeClock(100 * DAY)
+        self.store = HistoryStore(self.db_path, batch_size=1000, raw_retention=2 * DAY, hourly_retention=10 * DAY, daily_retention=100 * DAY, clock=self.clock)
+
+    def tearDown(self):
+        self.store.close()
+        self.directory.cleanup()
+
+    def test_records_and_queries_raw_samples(self):
+        self.store.record('HTTP', 'bbc.co.uk', {'reachable': 1, 'response_time_ms': 120.5}, timestamp=100)
+        self.store.record('HTTP', 'bbc.co.uk', {'reachable': 0, 'response_time_ms': None}, timestamp=400)
+
+        self.assertEqual(self.store.query('HTTP', 'bbc.co.uk', 'response_time_ms', 0, 1000), [(100, 120.5)])
+        self.assertEqual(self.store.query('HTTP', 'bbc.co.uk', 'reachable', 0, 1000), [(100, 1.0), (400, 0.0)])
+
+    def test_unknown_series_is_empty(self):
+        self.assertEqual(self.store.query('HTTP', 'missing', 'reachable', 0, 1000), [])
+
+    def test_buffers_until_batch_size(self):
+        store = HistoryStore(self.db_path, batch_size=3)
+        store.record('DNS', '1.1.1.1', {'reachable': 1}, timestamp=1)
+        store.record('DNS', '1.1.1.1', {'reachable': 1}, timestamp=2)
+
+        rows = store.connection.execute("SELECT COUNT(*) FROM samples").fetchone()[0]
+        store.record('DNS', '1.1.1.1', {'reachable': 1}, timestamp=3)
+        flushed = store.connection.execute("SELECT COUNT(*) FROM samples").fetchone()[0]
+        store.close()
+
+        self.assertEqual(rows, 0)
+        self.assertEqual(flushed, 3)
+
+    def test_persists_across_reopen(self):
+        self.store.record('DNS', '1.1.1.1', {'response_time_ms': 10}, timestamp=50)
+        self.store.close()
+
+        self.store = HistoryStore(self.db_path)
+
+        self.assertEqual(self.store.query('DNS', '1.1.1.1', 'response_time_ms', 0, 100), [(50, 10.0)])
+
+    def test_rolls_up_complete_hours_and_days(self):
+        day_start = 98 * DAY
+        for hour in range(24):
+            self.store.record('DNS', '1.1.1.1', {'response_time_ms': 10}, timestamp=day_start + hour * HOUR)
+            self.store.record('DNS', '1.1.1.1', {'response_time_ms': 30}, timestamp=day_start + hour * HOUR + 60)
+
+        self.store.maintain()
+
+        hourly = self.store.query('DNS', '1.1.1.1', 'response_time_ms', day_start, day_start + DAY, resolution='1h')
+        daily = self.store.query('DNS', '1.1.1.1', 'response_time_ms', day_start, day_start + DAY, resolution='1d')
+        self.assertEqual(len(hourly), 24)
+        self.assertEqual(hourly[0], (day_start, 2, 20.0, 10.0, 30.0))
+        self.assertEqual(daily, [(day_start, 48, 20.0, 10.0, 30.0)])
+
+    def test_incomplete_hour_is_not_rolled_up(self):
+        self.clock.now += HOUR / 2
+        self.store.record('DNS', '1.1.1.1', {'response_time_ms': 10}, timestamp=self.clock.now - 60)
+
+        self.store.maintain()
+
+        self.assertEqual(self.store.query('DNS', '1.1.1.1', 'response_time_ms', 0, self.clock.now, resolution='1h'), [])
+
+    def test_maintain_applies_retention(self):
+        self.store.record('DNS', '1.1.1.1', {'response_time_ms': 10}, timestamp=self.clock.now - 3 * DAY)
+        self.store.record('DNS', '1.1.1.1', {'response_time_ms': 20}, timestamp=self.clock.now - DAY)
+
+        self.store.maintain()
+
+        raw = self.store.query('DNS', '1.1.1.1', 'response_time_ms', 0, self.clock.now)
+        hourly = self.store.query('DNS', '1.1.1.1', 'response_time_ms', 0, self.clock.now, resolution='1h')
+        self.assertEqual(raw, [(self.clock.now - DAY, 20.0)])
+        self.assertEqual(len(hourly), 2)
+
+    def test_records_reachability_and_speedtest_results(self):
+        self.store.record_reachability('HTTP', {'a.com': {'reachable': True, 'response_time_ms': 5}}, timestamp=10)
+        self.store.record_speedtest({
+            'server': {'name': 'Server', 'location': 'London'},
+            'download': {'download_speed': 100},
+            'upload': {'upload_speed': 50},
+            'ping': {'latency': 10, 'jitter': 1},
+            'packet_loss': None
+        }, timestamp=10)
+
+        self.assertEqual(self.store.query('HTTP', 'a.com', 'reachable', 0, 20), [(10, 1.0)])
+        self.assertEqual(self.store.query('speedtest', 'Server', 'download_speed', 0, 20), [(10, 100.0)])
+        self.assertEqual(self.store.query('speedtest', 'Server', 'packet_loss', 0, 20), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
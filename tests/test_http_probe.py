@@ -0,0 +1,182 @@
+import unittest
+from unittest.mock import patch, MagicMock
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from http_probe import HttpProbe, TimedHTTPSConnection
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    connections = set()
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        Handler.connections.add(self.client_address)
+
+    def respond(self, send_body):
+        if self.path == '/redirect':
+            self.send_response(301)
+            self.send_header('Location', '/')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if self.path == '/no-head' and self.command == 'HEAD':
+            self.send_response(405)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = b'x' * 1_000_000
+        self.send_response(404 if self.path == '/missing' else 200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if send_body:
+            try:
+                self.wfile.write(body)
+            except OSError:
+                pass
+
+    def do_HEAD(self):
+        self.respond(send_body=False)
+
+    def do_GET(self):
+        self.respond(send_body=True)
+
+
+# Streamed GETs hang up mid-body, which the server would otherwise print
+class QuietHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        pass
+
+
+class TestHttpProbe(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = QuietHTTPServer(('127.0.0.1', 0), Handler)
+        cls.base_url = f"http://127.0.0.1:{cls.server.server_address[1]}"
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        Handler.connections.clear()
+
+    def test_head_probe_reports_status_and_phases(self):
+        probe = HttpProbe(method='HEAD')
+
+        result = probe.probe(self.base_url + '/')
+        probe.close()
+
+        self.assertEqual(result['status_code'], 200)
+        self.assertIsNotNone(result['phases']['dns'])
+        self.assertIsNotNone(result['phases']['connect'])
+        self.assertIsNone(result['phases']['tls'])
+        self.assertIsNotNone(result['phases']['ttfb'])
+        self.assertGreater(result['response_time_ms'], 0)
+
+    def test_head_probe_reuses_pooled_connection(self):
+        probe = HttpProbe(method='HEAD')
+
+        probe.probe(self.base_url + '/')
+        result = probe.probe(self.base_url + '/')
+        probe.close()
+
+        self.assertEqual(len(Handler.connections), 1)
+        self.assertIsNone(result['phases']['connect'])
+        self.assertIsNotNone(result['phases']['ttfb'])
+
+    def test_idle_connection_past_max_age_is_not_reused(self):
+        now = [0]
+        probe = HttpProbe(method='HEAD', max_idle_age=30, clock=lambda: now[0])
+
+        probe.probe(self.base_url + '/')
+        now[0] += 31
+        result = probe.probe(self.base_url + '/')
+        probe.close()
+
+        self.assertEqual(len(Handler.connections), 2)
+        self.assertIsNotNone(result['phases']['connect'])
+
+    def test_idle_pool_is_capped(self):
+        probe = HttpProbe(method='HEAD', max_idle_per_host=2, max_idle=3)
+        key = ('http', '127.0.0.1', self.server.server_address[1])
+        connections = [MagicMock() for _ in range(4)]
+
+        for connection in connections:
+            probe._checkin(key, connection)
+        probe._checkin(('http', 'other', 80), MagicMock())
+        probe._checkin(('http', 'third', 80), MagicMock())
+
+        self.assertEqual(probe.idle_connections(), 3)
+        connections[2].close.assert_called_once()
+        connections[3].close.assert_called_once()
+        self.assertNotIn(('http', 'third', 80), probe._idle)
+
+    def test_streamed_get_closes_after_headers(self):
+        probe = HttpProbe(method='GET')
+
+        result = probe.probe(self.base_url + '/')
+
+        self.assertEqual(result['status_code'], 200)
+        self.assertEqual(probe._idle, {})
+
+    def test_follows_redirects(self):
+        probe = HttpProbe(method='HEAD')
+
+        result = probe.probe(self.base_url + '/redirect')
+        probe.close()
+
+        self.assertEqual(result['status_code'], 200)
+
+    def test_falls_back_to_get_when_head_not_allowed(self):
+        probe = HttpProbe(method='HEAD')
+
+        result = probe.probe(self.base_url + '/no-head')
+        probe.close()
+
+        self.assertEqual(result['status_code'], 200)
+
+    def test_reports_error_status(self):
+        probe = HttpProbe(method='HEAD')
+
+        result = probe.probe(self.base_url + '/missing')
+        probe.close()
+
+        self.assertEqual(result['status_code'], 404)
+
+    @patch('http_probe.socket')
+    def test_failed_tls_handshake_closes_the_socket(self, mock_socket):
+        connection = TimedHTTPSConnection('127.0.0.1', self.server.server_address[1], timeout=1)
+        connection._context = MagicMock()
+        connection._context.wrap_socket.side_effect = OSError('handshake failed')
+
+        with self.assertRaises(OSError):
+            connection.connect()
+
+        mock_socket.return_value.close.assert_called_once()
+
+    def test_connection_refused_raises(self):
+        probe = HttpProbe(method='HEAD', timeout=1)
+        closed = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        port = closed.server_address[1]
+        closed.server_close()
+
+        with self.assertRaises(OSError):
+            probe.probe(f"http://127.0.0.1:{port}/")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,168 @@
+import unittest
+import tempfile
+import json
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from inventory import Target, TargetInventory, InventoryError, parse_target
+
+
+class TestParseTarget(unittest.TestCase):
+
+    def test_http_defaults(self):
+        target = parse_target({'host': 'example.com'})
+
+        self.assertEqual(target.name, 'example.com')
+        self.assertEqual(target.protocol, 'HTTP')
+        self.assertEqual(target.port, 443)
+        self.assertEqual(target.expected_status, (200, 299))
+        self.assertIsNone(target.interval)
+        self.assertEqual(target.tags, ())
+        self.assertEqual(target.url, 'https://example.com/')
+
+    def test_dns_defaults(self):
+        target = parse_target({'protocol': 'dns', 'host': '1.1.1.1'})
+
+        self.assertEqual(target.name, '1.1.1.1')
+        self.assertEqual(target.port, 53)
+
+    def test_name_includes_non_default_port_and_path(self):
+        target = parse_target({'host': 'example.com', 'port': 8443, 'path': 'health'})
+
+        self.assertEqual(target.name, 'example.com:8443/health')
+        self.assertEqual(target.url, 'https://example.com:8443/health')
+
+    def test_plain_http_on_port_80(self):
+        target = parse_target({'host': 'example.com', 'port': 80})
+
+        self.assertEqual(target.name, 'example.com')
+        self.assertEqual(target.url, 'http://example.com/')
+
+    def test_expected_status_range_and_tags(self):
+        target = parse_target({'name': 'api', 'host': 'example.com', 'expected_status': '200-399', 'tags': 'prod;eu', 'interval': '60'})
+
+        self.assertEqual(target.name, 'api')
+        self.assertTrue(target.accepts(301))
+        self.assertFalse(target.accepts(404))
+        self.assertEqual(target.tags, ('eu', 'prod'))
+        self.assertEqual(target.interval, 60.0)
+
+    def test_single_expected_status(self):
+        target = parse_target({'host': 'example.com', 'expected_status': 401})
+
+        self.assertTrue(target.accepts(401))
+        self.assertFalse(target.accepts(200))
+
+    def test_invalid_entries(self):
+        for entry in ({}, {'host': 'a.com', 'protocol': 'ftp'}, {'host': 'a.com', 'port': 'x'}, {'host': 'a.com', 'port': 70000}):
+            with self.assertRaises(InventoryError):
+                parse_target(entry)
+
+
+class TestTargetInventory(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, file_name, content, mtime=None):
+        file_path = os.path.join(self.directory.name, file_name)
+        with open(file_path, 'w') as targets_file:
+            targets_file.write(content)
+        if mtime is not None:
+            os.utime(file_path, (mtime, mtime))
+        return file_path
+
+    def test_loads_json(self):
+        file_path = self.write('targets.json', json.dumps({'targets': [
+            {'host': 'example.com'},
+            {'protocol': 'DNS', 'host': '1.1.1.1', 'name': 'cloudflare'}
+        ]}))
+        inventory = TargetInventory(file_path)
+
+        added, removed, changed = inventory.poll()
+
+        self.assertEqual(len(added), 2)
+        self.assertEqual((removed, changed), ([], []))
+        self.assertEqual(inventory.names('HTTP'), ['example.com'])
+        self.assertEqual(inventory.names('DNS'), ['cloudflare'])
+        self.assertEqual(inventory.get('DNS', 'cloudflare').host, '1.1.1.1')
+
+    def test_loads_yaml(self):
+        file_path = self.write('targets.yaml', "- host: example.com\n  expected_status: 200-399\n- protocol: DNS\n  host: 8.8.8.8\n")
+        inventory = TargetInventory(file_path)
+
+        inventory.poll()
+
+        self.assertEqual(inventory.get('HTTP', 'example.com').expected_status, (200, 399))
+        self.assertEqual(inventory.names('DNS'), ['8.8.8.8'])
+
+    def test_loads_csv(self):
+        file_path = self.write('targets.csv', "protocol,host,port,path,tags\nHTTP,example.com,,/status,a;b\nDNS,9.9.9.9,5353,,\n")
+        inventory = TargetInventory(file_path)
+
+        inventory.poll()
+
+        self.assertEqual(inventory.get('HTTP', 'example.com/status').tags, ('a', 'b'))
+        self.assertEqual(inventory.get('DNS', '9.9.9.9:5353').port, 5353)
+
+    def test_skips_invalid_entries(self):
+        file_path = self.write('targets.json', json.dumps([{'host': 'good.com'}, {'protocol': 'ftp', 'host': 'bad.com'}]))
+        inventory = TargetInventory(file_path)
+
+        inventory.poll()
+
+        self.assertEqual(inventory.names('HTTP'), ['good.com'])
+
+    def test_unchanged_file_is_not_reparsed(self):
+        file_path = self.write('targets.json', json.dumps([{'host': 'a.com'}]))
+        inventory = TargetInventory(file_path)
+
+        inventory.poll()
+
+        self.assertIsNone(inventory.poll())
+
+    def test_reload_applies_only_the_difference(self):
+        file_path = self.write('targets.json', json.dumps([{'host': 'a.com'}, {'host': 'b.com'}]), mtime=1000)
+        inventory = TargetInventory(file_path)
+        inventory.poll()
+
+        self.write('targets.json', json.dumps([{'host': 'b.com', 'interval': 60}, {'host': 'c.com'}]), mtime=2000)
+        added, removed, changed = inventory.poll()
+
+        self.assertEqual([target.name for target in added], ['c.com'])
+        self.assertEqual([target.name for target in removed], ['a.com'])
+        self.assertEqual([target.name for target in changed], ['b.com'])
+        self.assertEqual(inventory.names('HTTP'), ['b.com', 'c.com'])
+        self.assertEqual(inventory.get('HTTP', 'b.com').interval, 60)
+
+    def test_broken_file_keeps_current_targets(self):
+        file_path = self.write('targets.json', json.dumps([{'host': 'a.com'}]), mtime=1000)
+        inventory = TargetInventory(file_path)
+        inventory.poll()
+
+        self.write('targets.json', '[{"host": ', mtime=2000)
+
+        self.assertIsNone(inventory.poll())
+        self.assertEqual(inventory.names('HTTP'), ['a.com'])
+
+    def test_missing_file(self):
+        inventory = TargetInventory(os.path.join(self.directory.name, 'missing.json'))
+
+        self.assertIsNone(inventory.poll())
+        self.assertEqual(inventory.names('HTTP'), [])
+
+    def test_target_is_immutable(self):
+        target = parse_target({'host': 'a.com'})
+
+        self.assertIsInstance(target, Target)
+        with self.assertRaises(AttributeError):
+            target.port = 80
+
+
+if __name__ == '__main__':
+    unittest.main()
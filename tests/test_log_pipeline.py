@@ -0,0 +1,118 @@
+import unittest
+import logging
+import json
+import sys
+import os
+from threading import current_thread, main_thread
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from log_pipeline import JsonLinesFormatter, SuccessSampler, attach_handler
+
+
+class ListHandler(logging.Handler):
+
+    def __init__(self):
+        super().__init__()
+        self.lines = []
+        self.threads = []
+
+    def emit(self, record):
+        self.lines.append(self.format(record))
+        self.threads.append(current_thread())
+
+
+def make_logger(name):
+    logger = logging.getLogger(f"test-log-pipeline.{name}")
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    return logger
+
+
+class TestJsonLinesFormatter(unittest.TestCase):
+
+    def test_merges_fields(self):
+        record = logging.LogRecord('x', logging.INFO, __file__, 1, "%s probe of %s", ('HTTP', 'a.com'), None)
+        record.fields = {'target': 'a.com', 'reachable': True, 'response_time_ms': 12.5}
+
+        entry = json.loads(JsonLinesFormatter().format(record))
+
+        self.assertEqual(entry['message'], 'HTTP probe of a.com')
+        self.assertEqual(entry['level'], 'INFO')
+        self.assertEqual(entry['target'], 'a.com')
+        self.assertTrue(entry['reachable'])
+        self.assertEqual(entry['response_time_ms'], 12.5)
+        self.assertIn('time', entry)
+
+    def test_plain_record(self):
+        record = logging.LogRecord('x', logging.ERROR, __file__, 1, "failed", None, None)
+
+        self.assertEqual(json.loads(JsonLinesFormatter().format(record))['message'], 'failed')
+
+
+class TestSuccessSampler(unittest.TestCase):
+
+    def test_keeps_one_in_rate_per_key(self):
+        logger = make_logger('sampler')
+        handler = ListHandler()
+        handler.addFilter(SuccessSampler(3))
+        logger.addHandler(handler)
+
+        for _ in range(6):
+            logger.info("ok a", extra={'sample_key': 'a'})
+            logger.info("ok b", extra={'sample_key': 'b'})
+        logger.info("failed")
+
+        self.assertEqual(handler.lines, ['ok a', 'ok b', 'ok a', 'ok b', 'failed'])
+
+    def test_rate_of_one_keeps_everything(self):
+        record = logging.LogRecord('x', logging.INFO, __file__, 1, "ok", None, None)
+        record.sample_key = 'a'
+        sampler = SuccessSampler(1)
+
+        self.assertTrue(all(sampler.filter(record) for _ in range(5)))
+
+
+class TestAttachHandler(unittest.TestCase):
+
+    def test_queued_records_are_written_by_the_listener(self):
+        logger = make_logger('queued')
+        handler = ListHandler()
+        listener = attach_handler(logger, handler, queued=True)
+
+        logger.info("probe of %s", 'a.com', extra={'fields': {'target': 'a.com'}})
+        logger.debug("skipped %s", 'lazily')
+        listener.stop()
+
+        self.assertEqual(handler.lines, ['probe of a.com'])
+        self.assertIsNot(handler.threads[0], main_thread())
+
+    def test_queued_records_are_formatted_by_the_listener(self):
+        logger = make_logger('deferred')
+        handler = ListHandler()
+        formatted_on = []
+
+        class Target:
+            def __str__(self):
+                formatted_on.append(current_thread())
+                return 'a.com'
+
+        listener = attach_handler(logger, handler, queued=True)
+        logger.info("probe of %s", Target())
+        listener.stop()
+
+        self.assertEqual(handler.lines, ['probe of a.com'])
+        self.assertEqual(formatted_on, handler.threads)
+
+    def test_direct(self):
+        logger = make_logger('direct')
+        handler = ListHandler()
+
+        self.assertIsNone(attach_handler(logger, handler))
+        logger.info("hello")
+
+        self.assertEqual(handler.lines, ['hello'])
+
+
+if __name__ == '__main__':
+    unittest.main()
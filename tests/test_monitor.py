@@ -3,12 +3,26 @@ from unittest.mock import patch, MagicMock
 from subprocess import TimeoutExpired
 from json import dumps as json_dumps
 from requests import Timeout
+from threading import Event
+from time import perf_counter, sleep, monotonic
+import socket
+import tempfile
+import shutil
+import subprocess
+import json
 import sys
 import os
 
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
 
-from monitor import convert_bps_to_Mbps, run_speedtest, run_http_reachability_checks, run_dns_reachability_checks
+from monitor import convert_bps_to_Mbps, split_targets, run_speedtest, run_speedtest_streaming, run_http_reachability_checks, run_dns_reachability_checks, \
+    run_dns_reachability_checks_parallel, run_dns_checks, next_speedtest_servers, speedtest_check, due_targets, target_address, \
+    http_check, restore_speedtest_state, log_probe_result_lines, reload_targets, speedtest_args, export_speedtest_results
+import monitor
+from speedtest_cache import SpeedtestResultCache
+from adaptive import AdaptiveProbeRate
+from inventory import TargetInventory, parse_target
+from prometheus_client import REGISTRY
 
 
 class TestConvertBpsToMbps(unittest.TestCase):
@@ -34,6 +48,18 @@ class TestConvertBpsToMbps(unittest.TestCase):
         self.assertEqual(result, 0.5)
 
 
+class TestSplitTargets(unittest.TestCase):
+
+    def test_splits_comma_separated_string(self):
+        self.assertEqual(split_targets(" a.com, b.com ,c.com"), ['a.com', 'b.com', 'c.com'])
+
+    def test_drops_empty_and_duplicate_entries(self):
+        self.assertEqual(split_targets("a.com,,a.com, "), ['a.com'])
+
+    def test_accepts_list(self):
+        self.assertEqual(split_targets([' a.com', 'b.com']), ['a.com', 'b.com'])
+
+
 class TestRunSpeedtest(unittest.TestCase):
 
     @patch('monitor.run')
@@ -72,6 +98,14 @@ class TestRunSpeedtest(unittest.TestCase):
         self.assertEqual(result['server']['name'], 'Test Server')
         self.assertEqual(result['server']['location'], 'Test Location')
 
+    @patch('monitor.run')
+    def test_passes_server_ids(self, mock_run):
+        mock_run.return_value = MagicMock(stdout=b'{}')
+
+        run_speedtest(server_ids='40628')
+
+        self.assertIn('--server-id=40628', mock_run.call_args[0][0])
+
     @patch('monitor.run')
     def test_speedtest_timeout(self, mock_run):
         mock_run.side_effect = TimeoutExpired(cmd='speedtest', timeout=60)
@@ -120,6 +154,186 @@ class TestRunSpeedtest(unittest.TestCase):
         self.assertIsNone(result['download']['latency']['iqm'])
 
 
+class TestRunSpeedtestStreaming(unittest.TestCase):
+
+    def mock_process(self, events, returncode=0):
+        process = MagicMock()
+        process.stdout.__iter__.return_value = [json_dumps(event) + '\n' if isinstance(event, dict) else event for event in events]
+        process.returncode = returncode
+        return process
+
+    def result_event(self):
+        return {
+            'type': 'result',
+            'timestamp': '2024-01-01T12:00:00Z',
+            'ping': {'jitter': 1.5, 'latency': 10.2},
+            'download': {'bandwidth': 12500000, 'latency': {'iqm': 15.0, 'jitter': 2.0}},
+            'upload': {'bandwidth': 6250000, 'latency': {'iqm': 20.0, 'jitter': 3.0}},
+            'packetLoss': 0.5,
+            'isp': 'Test ISP',
+            'interface': {'externalIp': '1.2.3.4'},
+            'server': {'name': 'Test Server', 'location': 'Test Location'}
+        }
+
+    @patch('monitor.collect_speedtest_progress')
+    @patch('monitor.Popen')
+    def test_updates_live_gauges_and_returns_result(self, mock_popen, mock_progress):
+        mock_popen.return_value = self.mock_process([
+            {'type': 'testStart', 'server': {'name': 'Test Server', 'location': 'Test Location'}},
+            {'type': 'ping', 'ping': {'jitter': 1.0, 'latency': 10.0, 'progress': 1.0}},
+            {'type': 'download', 'download': {'bandwidth': 1250000, 'progress': 0.5}},
+            {'type': 'upload', 'upload': {'bandwidth': 625000, 'progress': 0.25}},
+            self.result_event()
+        ])
+
+        result = run_speedtest_streaming()
+
+        mock_progress.assert_any_call('download', 0.5, 10)
+        mock_progress.assert_any_call('upload', 0.25, 5)
+        self.assertEqual(result['download']['download_speed'], 100)
+        self.assertEqual(result['upload']['upload_speed'], 50)
+        self.assertEqual(result['server']['name'], 'Test Server')
+        self.assertEqual(result['external_ip'], '1.2.3.4')
+
+    @patch('monitor.collect_speedtest_progress')
+    @patch('monitor.Popen')
+    def test_requests_jsonl_progress_output(self, mock_popen, mock_progress):
+        mock_popen.return_value = self.mock_process([self.result_event()])
+
+        run_speedtest_streaming()
+
+        run_args = mock_popen.call_args[0][0]
+        self.assertIn('--format=jsonl', run_args)
+        self.assertIn('--progress=yes', run_args)
+
+    @patch('monitor.collect_speedtest_progress')
+    @patch('monitor.Popen')
+    def test_skips_non_json_lines(self, mock_popen, mock_progress):
+        mock_popen.return_value = self.mock_process(['[error] something\n', self.result_event()])
+
+        result = run_speedtest_streaming()
+
+        self.assertEqual(result['isp'], 'Test ISP')
+
+    @patch('monitor.collect_speedtest_progress')
+    @patch('monitor.Popen')
+    def test_no_result_event(self, mock_popen, mock_progress):
+        mock_popen.return_value = self.mock_process([
+            {'type': 'download', 'download': {'bandwidth': 1250000, 'progress': 0.5}}
+        ])
+
+        result = run_speedtest_streaming()
+
+        self.assertEqual(result, {})
+
+    @patch('monitor.collect_speedtest_progress')
+    @patch('monitor.Popen')
+    def test_non_zero_exit(self, mock_popen, mock_progress):
+        mock_popen.return_value = self.mock_process([self.result_event()], returncode=1)
+
+        result = run_speedtest_streaming()
+
+        self.assertEqual(result, {})
+
+    @patch('monitor.collect_speedtest_progress')
+    @patch('monitor.Popen')
+    def test_skips_json_lines_that_are_not_events(self, mock_popen, mock_progress):
+        mock_popen.return_value = self.mock_process(['123\n', '"text"\n', self.result_event()])
+
+        result = run_speedtest_streaming()
+
+        self.assertEqual(result['isp'], 'Test ISP')
+
+    @patch('monitor.collect_speedtest_progress')
+    @patch('monitor.Popen')
+    def test_kills_speedtest_when_reading_fails(self, mock_popen, mock_progress):
+        process = self.mock_process([{'type': 'download', 'download': {'bandwidth': 1250000, 'progress': 0.5}}])
+        process.poll.return_value = None
+        mock_popen.return_value = process
+
+        with self.assertRaises(RuntimeError):
+            run_speedtest_streaming(on_phase=MagicMock(side_effect=RuntimeError("boom")))
+
+        process.kill.assert_called_once()
+        process.wait.assert_called_once()
+
+    @patch('monitor.Popen')
+    def test_spawn_failure(self, mock_popen):
+        mock_popen.side_effect = FileNotFoundError("speedtest")
+
+        result = run_speedtest_streaming()
+
+        self.assertEqual(result, {})
+
+
+class TestNextSpeedtestServers(unittest.TestCase):
+
+    @patch('monitor.speedtest_server_ids', '1,2,3')
+    @patch('monitor.speedtest_server_mode', 'any')
+    def test_any_passes_every_server_to_one_test(self):
+        self.assertEqual(next_speedtest_servers(), ['1,2,3'])
+
+    @patch('monitor.speedtest_server_ids', '1,2,3')
+    @patch('monitor.speedtest_server_mode', 'each')
+    def test_each_tests_every_server(self):
+        self.assertEqual(next_speedtest_servers(), ['1', '2', '3'])
+
+    @patch('monitor.speedtest_server_ids', '1,2,3')
+    @patch('monitor.speedtest_server_mode', 'round-robin')
+    @patch('monitor.speedtest_round_robin', 0)
+    def test_round_robin_moves_to_next_server_each_cycle(self):
+        cycles = [next_speedtest_servers() for _ in range(4)]
+
+        self.assertEqual(cycles, [['1'], ['2'], ['3'], ['1']])
+
+    @patch('monitor.speedtest_server_ids', '')
+    @patch('monitor.speedtest_round_robin', 0)
+    def test_no_server_ids_lets_the_cli_choose(self):
+        for mode in ('any', 'each', 'round-robin'):
+            with patch('monitor.speedtest_server_mode', mode):
+                self.assertEqual(next_speedtest_servers(), [None])
+        self.assertFalse(any(arg.startswith('--server-id') for arg in speedtest_args(server_ids=None)))
+
+
+class TestSpeedtestCheck(unittest.TestCase):
+
+    @patch('monitor.collect_speedtest_age')
+    @patch('monitor.collect_speedtest_metrics')
+    @patch('monitor.speedtest_results')
+    @patch('monitor.run_speedtest')
+    @patch('monitor.speedtest_server_ids', '1,2')
+    @patch('monitor.speedtest_server_mode', 'each')
+    def test_exports_every_cached_server(self, mock_run_speedtest, mock_results, mock_collect, mock_age):
+        cached = [(0, {'server': {'name': 'A'}}), (900, {'server': {'name': 'B'}})]
+        mock_results.fresh.return_value = cached
+
+        speedtest_check()
+
+        self.assertEqual(mock_run_speedtest.call_count, 2)
+        mock_run_speedtest.assert_any_call(server_ids='1')
+        mock_run_speedtest.assert_any_call(server_ids='2')
+        self.assertEqual(mock_results.add.call_count, 2)
+        self.assertEqual(mock_collect.call_count, 2)
+        mock_age.assert_any_call({'server': {'name': 'B'}}, 900)
+
+    @patch('monitor.speedtest_results', SpeedtestResultCache(max_age=600, clock=lambda: 0))
+    def test_removes_the_series_of_expired_servers(self):
+        from prometheus_client import REGISTRY
+        labels = {'server_name': 'Gone', 'server_location': 'Nowhere'}
+        result = {'server': {'id': 9, 'name': 'Gone', 'location': 'Nowhere'}, 'download': {'download_speed': 10, 'latency': {'iqm': None, 'jitter': None}},
+                  'upload': {'upload_speed': None, 'latency': {'iqm': None, 'jitter': None}}, 'ping': {'jitter': None, 'latency': None},
+                  'packet_loss': None, 'isp': None, 'external_ip': None}
+        monitor.speedtest_results.add(result)
+        export_speedtest_results()
+        self.assertEqual(REGISTRY.get_sample_value('internet_download_speed', labels), 10)
+
+        monitor.speedtest_results.clock = lambda: 601
+        export_speedtest_results()
+
+        self.assertIsNone(REGISTRY.get_sample_value('internet_download_speed', labels))
+        self.assertIsNone(REGISTRY.get_sample_value('internet_speedtest_result_age_seconds', labels))
+
+
 class TestRunHttpReachabilityChecks(unittest.TestCase):
 
     @patch('monitor.http_get')
@@ -222,6 +436,75 @@ class TestRunHttpReachabilityChecks(unittest.TestCase):
         self.assertTrue(result['success.com']['reachable'])
         self.assertFalse(result['failure.com']['reachable'])
 
+    @patch('monitor.http_probe_method', 'head')
+    @patch('monitor.http_probe')
+    def test_pooled_probe_keeps_phase_timings(self, mock_probe):
+        phases = {'dns': 1.0, 'connect': 2.0, 'tls': 3.0, 'ttfb': 4.0}
+        mock_probe.probe.return_value = {'status_code': 204, 'response_time_ms': 10.0, 'phases': phases}
+
+        result = run_http_reachability_checks("example.com")
+
+        mock_probe.probe.assert_called_once_with("https://example.com")
+        self.assertTrue(result['example.com']['reachable'])
+        self.assertEqual(result['example.com']['response_time_ms'], 10.0)
+        self.assertEqual(result['example.com']['phases'], phases)
+
+    @patch('monitor.http_probe_method', 'head')
+    @patch('monitor.http_probe')
+    def test_pooled_probe_failure(self, mock_probe):
+        mock_probe.probe.side_effect = ConnectionRefusedError()
+
+        result = run_http_reachability_checks("example.com")
+
+        self.assertEqual(result['example.com'], {'reachable': False, 'response_time_ms': None})
+
+    @patch('monitor.http_get')
+    def test_domains_are_probed_concurrently(self, mock_get):
+        def side_effect(url, **kwargs):
+            sleep(0.2)
+            mock_response = MagicMock()
+            mock_response.status_code = 200
+            return mock_response
+
+        mock_get.side_effect = side_effect
+
+        start = perf_counter()
+        result = run_http_reachability_checks("a.com,b.com,c.com,d.com", concurrency=4)
+        elapsed = perf_counter() - start
+
+        self.assertEqual(len(result), 4)
+        self.assertLess(elapsed, 0.6)
+
+    @patch('monitor.http_get')
+    def test_sequential_when_concurrency_is_one(self, mock_get):
+        mock_response = MagicMock()
+        mock_response.status_code = 200
+        mock_get.return_value = mock_response
+
+        result = run_http_reachability_checks("a.com,b.com", concurrency=1)
+
+        self.assertEqual(list(result), ['a.com', 'b.com'])
+
+    @patch('monitor.http_get')
+    def test_deadline_marks_slow_domains_unreachable(self, mock_get):
+        release = Event()
+
+        def side_effect(url, **kwargs):
+            if 'slow.com' in url:
+                release.wait(2)
+            mock_response = MagicMock()
+            mock_response.status_code = 200
+            return mock_response
+
+        mock_get.side_effect = side_effect
+
+        result = run_http_reachability_checks("fast.com,slow.com", concurrency=2, deadline=0.2)
+        release.set()
+
+        self.assertTrue(result['fast.com']['reachable'])
+        self.assertFalse(result['slow.com']['reachable'])
+        self.assertIsNone(result['slow.com']['response_time_ms'])
+
 
 class TestRunDnsReachabilityChecks(unittest.TestCase):
 
@@ -302,5 +585,308 @@ class TestRunDnsReachabilityChecks(unittest.TestCase):
         mock_connection.assert_called_once_with(('8.8.8.8', 53), timeout=3)
 
 
+class TestRunDnsReachabilityChecksParallel(unittest.TestCase):
+
+    def setUp(self):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(16)
+        self.port = self.listener.getsockname()[1]
+
+    def tearDown(self):
+        self.listener.close()
+
+    def test_listening_resolver_is_reachable(self):
+        result = run_dns_reachability_checks_parallel("127.0.0.1", port=self.port)
+
+        self.assertTrue(result['127.0.0.1']['reachable'])
+        self.assertIsNotNone(result['127.0.0.1']['response_time_ms'])
+
+    def test_refused_connection_is_unreachable(self):
+        closed = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        closed.bind(('127.0.0.1', 0))
+        port = closed.getsockname()[1]
+        closed.close()
+
+        result = run_dns_reachability_checks_parallel("127.0.0.1", port=port)
+
+        self.assertFalse(result['127.0.0.1']['reachable'])
+        self.assertIsNone(result['127.0.0.1']['response_time_ms'])
+
+    def test_invalid_address_is_unreachable(self):
+        result = run_dns_reachability_checks_parallel("not an ip", port=self.port)
+
+        self.assertFalse(result['not an ip']['reachable'])
+
+    def test_keeps_result_shape_for_every_target(self):
+        result = run_dns_reachability_checks_parallel(" 127.0.0.1 , 127.0.0.2 ", port=self.port)
+
+        self.assertEqual(set(result), {'127.0.0.1', '127.0.0.2'})
+        for check in result.values():
+            self.assertEqual(set(check), {'reachable', 'response_time_ms'})
+
+
+class TestRunDnsChecks(unittest.TestCase):
+
+    @patch('monitor.dns_check_mode', 'parallel')
+    @patch('monitor.run_dns_reachability_checks_parallel')
+    def test_parallel_mode(self, mock_parallel):
+        run_dns_checks("8.8.8.8")
+
+        mock_parallel.assert_called_once_with("8.8.8.8")
+
+    @patch('monitor.dns_check_mode', 'sequential')
+    @patch('monitor.run_dns_reachability_checks')
+    def test_sequential_mode(self, mock_sequential):
+        run_dns_checks("8.8.8.8")
+
+        mock_sequential.assert_called_once_with("8.8.8.8")
+
+
+class TestTargetsFile(unittest.TestCase):
+
+    def setUp(self):
+        self.inventory = TargetInventory('unused.json')
+        for entry in ({'host': 'example.com', 'port': 8443, 'path': '/health', 'expected_status': '200-399'},
+                      {'host': 'slow.com', 'interval': 60},
+                      {'protocol': 'DNS', 'name': 'local', 'host': '127.0.0.1', 'port': 5353}):
+            target = parse_target(entry)
+            self.inventory.targets[(target.protocol, target.name)] = target
+        self.inventory._names = {'HTTP': ['example.com:8443/health', 'slow.com'], 'DNS': ['local']}
+        patcher = patch('monitor.inventory', self.inventory)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        last_probed = patch('monitor.last_probed', {})
+        last_probed.start()
+        self.addCleanup(last_probed.stop)
+
+    @patch('monitor.http_get')
+    def test_uses_target_url_and_expected_status(self, mock_get):
+        mock_response = MagicMock()
+        mock_response.status_code = 302
+        mock_get.return_value = mock_response
+
+        result = run_http_reachability_checks(['example.com:8443/health'])
+
+        mock_get.assert_called_once_with('https://example.com:8443/health', timeout=3)
+        self.assertTrue(result['example.com:8443/health']['reachable'])
+
+    def test_per_target_interval(self):
+        self.assertEqual(due_targets('HTTP', now=100), ['example.com:8443/health', 'slow.com'])
+        self.assertEqual(due_targets('HTTP', now=130), ['example.com:8443/health'])
+        self.assertEqual(due_targets('HTTP', now=160), ['example.com:8443/health', 'slow.com'])
+
+    def test_dns_target_address(self):
+        self.assertEqual(target_address('DNS', 'local', 53), ('127.0.0.1', 5353))
+        self.assertEqual(target_address('DNS', '8.8.8.8', 53), ('8.8.8.8', 53))
+
+    @patch('monitor.create_connection')
+    def test_dns_check_connects_to_target_port(self, mock_connection):
+        result = run_dns_reachability_checks(['local'])
+
+        mock_connection.assert_called_once_with(('127.0.0.1', 5353), timeout=3)
+        self.assertTrue(result['local']['reachable'])
+
+
+    @patch('monitor.supervisor', None)
+    @patch('monitor.adaptive_rates', None)
+    def test_reload_exports_target_tags(self):
+        tagged = parse_target({'name': 'api', 'host': 'api.example.com', 'tags': ['prod', 'eu']})
+        labels = {'target': 'api', 'protocol': 'HTTP'}
+        self.inventory._names['HTTP'].append('api')
+        with patch.object(self.inventory, 'poll', return_value=([tagged], [], [])):
+            reload_targets()
+        self.assertEqual(REGISTRY.get_sample_value('internet_target_info', {**labels, 'tags': 'eu,prod'}), 1)
+
+        self.inventory._names['HTTP'].remove('api')
+        with patch.object(self.inventory, 'poll', return_value=([], [tagged], [])):
+            reload_targets()
+        self.assertIsNone(REGISTRY.get_sample_value('internet_target_info', {**labels, 'tags': 'eu,prod'}))
+
+class TestAdaptiveProbing(unittest.TestCase):
+
+    def setUp(self):
+        rates = {'HTTP': AdaptiveProbeRate(confirm_interval=15), 'DNS': AdaptiveProbeRate(confirm_interval=15)}
+        for target, value in (('monitor.adaptive_rates', rates), ('monitor.env_targets', {'HTTP': ['up.com', 'down.com'], 'DNS': []}),
+                              ('monitor.inventory', None), ('monitor.history', None)):
+            patcher = patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    @patch('monitor.collect_reachability_metrics')
+    @patch('monitor.http_get')
+    def test_failing_target_is_probed_again_before_healthy_one(self, mock_get, mock_collect):
+        def side_effect(url, **kwargs):
+            if 'down.com' in url:
+                raise ConnectionError()
+            mock_response = MagicMock()
+            mock_response.status_code = 200
+            return mock_response
+
+        mock_get.side_effect = side_effect
+
+        http_check()
+        due = due_targets('HTTP', now=monotonic() + 15)
+
+        self.assertEqual(due, ['down.com'])
+
+    @patch('monitor.collect_reachability_metrics')
+    @patch('monitor.http_get')
+    def test_nothing_due_skips_the_cycle(self, mock_get, mock_collect):
+        mock_get.return_value.status_code = 200
+
+        http_check()
+        http_check()
+
+        self.assertEqual(mock_get.call_count, 2)
+
+
+class TestRestoreSpeedtestState(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.state_file = os.path.join(self.directory.name, 'state.json')
+        self.clock = MagicMock(return_value=10_000.0)
+        self.results = SpeedtestResultCache(max_age=3600, clock=self.clock)
+        for target, value in (('monitor.speedtest_results', self.results), ('monitor.speedtest_state_file', self.state_file),
+                              ('monitor.speedtest_interval', 900)):
+            patcher = patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    @patch('monitor.collect_speedtest_metrics')
+    def test_waits_out_the_interval_and_reexports(self, mock_collect):
+        result = {'server': {'id': 1, 'name': 'A', 'location': 'London'}, 'download': {}}
+        self.results.add(result)
+        self.results.save(self.state_file, last_run=10_000.0)
+        self.results._results.clear()
+        self.clock.return_value = 10_300.0
+
+        delay = restore_speedtest_state()
+
+        self.assertEqual(delay, 600)
+        mock_collect.assert_called_once_with(result)
+
+    def test_no_state_runs_immediately(self):
+        self.assertEqual(restore_speedtest_state(), 0)
+
+    def test_overdue_runs_immediately(self):
+        self.results.save(self.state_file, last_run=1_000.0)
+
+        self.assertEqual(restore_speedtest_state(), 0)
+
+
+    @patch('monitor.history', None)
+    @patch('monitor.throughput_estimator', None)
+    @patch('monitor.latency_under_load', None)
+    @patch('monitor.next_speedtest_servers', return_value=[None])
+    def test_start_of_a_speedtest_is_saved_before_it_finishes(self, _):
+        saved = []
+
+        def crash_mid_test(name, func, argument):
+            saved.append(SpeedtestResultCache(3600).load(self.state_file))
+            raise RuntimeError('killed')
+
+        with patch('monitor.measure', crash_mid_test), self.assertRaises(RuntimeError):
+            speedtest_check()
+
+        self.assertEqual(saved, [10_000.0])
+        self.clock.return_value = 10_100.0
+        self.assertEqual(restore_speedtest_state(), 800)
+
+class TestLogProbeResultLines(unittest.TestCase):
+
+    def test_structured_fields_and_sample_key(self):
+        with self.assertLogs('internet-speed', level='INFO') as logs:
+            log_probe_result_lines('HTTP', {
+                'up.com': {'reachable': True, 'response_time_ms': 12.0},
+                'down.com': {'reachable': False, 'response_time_ms': None}
+            })
+
+        up, down = logs.records
+        self.assertEqual(up.getMessage(), 'HTTP probe of up.com: available in 12.0 ms')
+        self.assertEqual(up.fields['target'], 'up.com')
+        self.assertEqual(up.sample_key, ('HTTP', 'up.com'))
+        self.assertFalse(down.fields['reachable'])
+        self.assertIsNone(down.sample_key)
+
+
+class TestInstrumentation(unittest.TestCase):
+
+    @patch('monitor.http_get')
+    def test_http_probes_are_timed(self, mock_get):
+        from prometheus_client import REGISTRY
+        mock_get.return_value.status_code = 200
+        before = REGISTRY.get_sample_value('check_phase_duration_seconds_count', {'check': 'http', 'phase': 'probe'}) or 0
+
+        run_http_reachability_checks("a.com,b.com")
+
+        after = REGISTRY.get_sample_value('check_phase_duration_seconds_count', {'check': 'http', 'phase': 'probe'})
+        self.assertEqual(after - before, 2)
+        self.assertEqual(REGISTRY.get_sample_value('probes_in_flight', {'protocol': 'HTTP'}), 0)
+
+    def test_thread_count_gauge(self):
+        from prometheus_client import REGISTRY
+
+        self.assertGreaterEqual(REGISTRY.get_sample_value('process_threads'), 1)
+
+
+# Imports a copy of src/ next to a .env file (and any other `files`) in a
+# fresh interpreter, the way the service loads its settings, and returns
+# `expression` evaluated after importing monitor.
+def settings_from_dotenv(dotenv, expression, files={}):
+    with tempfile.TemporaryDirectory() as directory:
+        shutil.copytree(os.path.join(os.path.dirname(__file__), '..', 'src'), os.path.join(directory, 'src'),
+                        ignore=shutil.ignore_patterns('__pycache__'))
+        with open(os.path.join(directory, '.env'), 'w') as f:
+            f.write(dotenv + f"\nLOGS_FILE_PATH={os.path.join(directory, 'monitor.log')}\n")
+        for name, content in files.items():
+            with open(os.path.join(directory, name), 'w') as f:
+                f.write(content)
+        with open(os.path.join(directory, 'settings.py'), 'w') as f:
+            f.write("import json, sys\n"
+                    "sys.path.insert(0, 'src')\n"
+                    "import monitor, prometheus\n"
+                    "from prometheus_client import REGISTRY\n"
+                    f"print(json.dumps({expression}))\n")
+        env = {key: value for key, value in os.environ.items() if key != 'LOGS_FILE_PATH'}
+        output = subprocess.run([sys.executable, 'settings.py'], cwd=directory, env=env,
+                                capture_output=True, text=True, timeout=60, check=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+class TestDotenvSettings(unittest.TestCase):
+
+    def test_response_time_settings(self):
+        settings = settings_from_dotenv(
+            "RESPONSE_TIME_QUANTILES=0.5,0.99\nRESPONSE_TIME_BUCKETS=1,2,3\nRESPONSE_TIME_QUANTILE_WINDOW=60",
+            "[prometheus.response_time_quantiles, prometheus.response_time_buckets, prometheus.response_time_quantile_window]"
+        )
+
+        self.assertEqual(settings, [[0.5, 0.99], [1, 2, 3], 60])
+
+    def test_probe_during_speedtest_tag(self):
+        settings = settings_from_dotenv(
+            "PROBE_DURING_SPEEDTEST=tag",
+            "[monitor.probe_during_speedtest, prometheus.tag_during_speedtest, prometheus.response_time._labelnames]"
+        )
+
+        self.assertEqual(settings, ['tag', True, ['target', 'protocol', 'during_speedtest']])
+
+    def test_startup_targets_export_tags(self):
+        targets = json.dumps([{'name': 'api', 'host': 'api.example.com', 'tags': ['prod', 'eu']}])
+
+        value = settings_from_dotenv(
+            "TARGETS_FILE=targets.json",
+            "REGISTRY.get_sample_value('internet_target_info', {'target': 'api', 'protocol': 'HTTP', 'tags': 'eu,prod'})",
+            files={'targets.json': targets}
+        )
+
+        self.assertEqual(value, 1)
+
+
 if __name__ == '__main__':
     unittest.main()
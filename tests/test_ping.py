@@ -0,0 +1,173 @@
+import unittest
+from unittest.mock import patch
+from socket import socket, AF_INET, SOCK_DGRAM, IPPROTO_ICMP
+from threading import Thread
+from time import sleep
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from prometheus_client import REGISTRY
+from ping import PingWindow, PingSampler, open_ping_socket, build_echo_request, parse_echo_reply, icmp_checksum
+
+
+def icmp_permitted():
+    try:
+        socket(AF_INET, SOCK_DGRAM, IPPROTO_ICMP).close()
+        return True
+    except OSError:
+        return False
+
+
+# Echoes every datagram back, optionally dropping some by sequence number
+class UdpEchoServer:
+
+    def __init__(self, drop=lambda data: False):
+        self.sock = socket(AF_INET, SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.port = self.sock.getsockname()[1]
+        self.drop = drop
+        self.thread = Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def serve(self):
+        while True:
+            try:
+                data, address = self.sock.recvfrom(2048)
+            except OSError:
+                return
+            if not self.drop(data):
+                self.sock.sendto(data, address)
+
+    def close(self):
+        self.sock.close()
+
+
+class TestPingWindow(unittest.TestCase):
+
+    def test_summary(self):
+        window = PingWindow(10)
+        for rtt in [10, 12, None, 11, 15]:
+            window.add(rtt)
+
+        summary = window.summary((0.5, 1.0))
+
+        self.assertEqual(summary['sent'], 5)
+        self.assertAlmostEqual(summary['loss'], 0.2)
+        self.assertAlmostEqual(summary['jitter'], (2 + 1 + 4) / 3)
+        self.assertEqual(summary['rtt'], {0.5: 11, 1.0: 15})
+
+    def test_keeps_only_the_window(self):
+        window = PingWindow(3)
+        for rtt in [None, None, 5, 6, 7]:
+            window.add(rtt)
+
+        summary = window.summary()
+
+        self.assertEqual(summary['sent'], 3)
+        self.assertEqual(summary['loss'], 0)
+
+    def test_all_lost(self):
+        window = PingWindow(3)
+        window.add(None)
+
+        summary = window.summary()
+
+        self.assertEqual(summary['loss'], 1)
+        self.assertIsNone(summary['jitter'])
+        self.assertEqual(summary['rtt'], {})
+
+    def test_empty(self):
+        self.assertIsNone(PingWindow(3).summary())
+
+
+class TestEchoPackets(unittest.TestCase):
+
+    def test_request_checksum_verifies(self):
+        packet = build_echo_request(AF_INET, 513)
+
+        self.assertEqual(packet[0], 8)
+        self.assertEqual(icmp_checksum(packet), 0)
+
+    def test_parses_reply_sequence(self):
+        reply = bytes([0]) + build_echo_request(AF_INET, 513)[1:]
+
+        self.assertEqual(parse_echo_reply(AF_INET, reply), 513)
+        self.assertIsNone(parse_echo_reply(AF_INET, build_echo_request(AF_INET, 513)))
+        self.assertIsNone(parse_echo_reply(AF_INET, b'\x00'))
+
+
+class TestOpenPingSocket(unittest.TestCase):
+
+    def test_auto_falls_back_to_udp(self):
+        with patch('ping.socket', side_effect=[PermissionError("not permitted"), socket(AF_INET, SOCK_DGRAM)]):
+            sock, kind, _ = open_ping_socket('127.0.0.1', 'auto', 7)
+        sock.close()
+
+        self.assertEqual(kind, 'udp')
+
+    def test_icmp_mode_does_not_fall_back(self):
+        with patch('ping.socket', side_effect=PermissionError("not permitted")):
+            with self.assertRaises(PermissionError):
+                open_ping_socket('127.0.0.1', 'icmp')
+
+
+class TestPingSampler(unittest.TestCase):
+
+    def run_sampler(self, sampler, seconds=1):
+        sampler.start()
+        sleep(seconds)
+        sampler.stop(2)
+
+    def test_udp_echo(self):
+        server = UdpEchoServer()
+        self.addCleanup(server.close)
+        sampler = PingSampler(['127.0.0.1'], rate=20, window=10, timeout=0.5, mode='udp', udp_port=server.port)
+        results = []
+        sampler.listeners.append(lambda target, rtt: results.append((target, rtt)))
+
+        self.run_sampler(sampler)
+        summary = sampler.summaries()['127.0.0.1']
+
+        self.assertGreaterEqual(summary['sent'], 10)
+        self.assertEqual(summary['loss'], 0)
+        self.assertLess(summary['rtt'][0.5], 100)
+        self.assertTrue(all(target == '127.0.0.1' and rtt is not None for target, rtt in results))
+
+    def test_unanswered_pings_are_lost(self):
+        server = UdpEchoServer(drop=lambda data: data[1] % 2 == 0)
+        self.addCleanup(server.close)
+        sampler = PingSampler(['127.0.0.1'], rate=20, window=10, timeout=0.2, mode='udp', udp_port=server.port)
+
+        self.run_sampler(sampler)
+        summary = sampler.summaries()['127.0.0.1']
+
+        self.assertGreater(summary['loss'], 0.3)
+        self.assertLess(summary['loss'], 0.7)
+
+    @unittest.skipUnless(icmp_permitted(), "ICMP datagram sockets are not permitted (net.ipv4.ping_group_range)")
+    def test_icmp_loopback(self):
+        sampler = PingSampler(['127.0.0.1'], rate=20, window=10, timeout=0.5, mode='icmp')
+
+        self.run_sampler(sampler)
+        summary = sampler.summaries()['127.0.0.1']
+
+        self.assertEqual(summary['loss'], 0)
+
+    def test_publishes_metrics(self):
+        import monitor
+        sampler = PingSampler(['10.0.0.1'])
+        for rtt in [20, 30, None, 25]:
+            sampler.record('10.0.0.1', rtt)
+
+        with patch('monitor.ping_sampler', sampler):
+            monitor.ping_check()
+
+        self.assertEqual(REGISTRY.get_sample_value('internet_ping_sample_loss_ratio', {'target': '10.0.0.1'}), 0.25)
+        self.assertEqual(REGISTRY.get_sample_value('internet_ping_sample_rtt_ms', {'target': '10.0.0.1', 'quantile': '0.5'}), 25)
+        self.assertEqual(REGISTRY.get_sample_value('internet_ping_sample_jitter_ms', {'target': '10.0.0.1'}), 7.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+import unittest
+from threading import Thread, Event
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from profiler import SamplingProfiler, ProfilerBusy, fold_stack
+
+
+def busy_loop(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+class TestSamplingProfiler(unittest.TestCase):
+
+    def test_folded_stacks_of_other_threads(self):
+        stop = Event()
+        worker = Thread(target=busy_loop, args=(stop,), name='busy')
+        worker.start()
+        try:
+            profile = SamplingProfiler(interval=0.005).profile(0.2)
+        finally:
+            stop.set()
+            worker.join()
+
+        lines = profile.splitlines()
+        busy = [line for line in lines if line.startswith('busy;')]
+        self.assertTrue(busy)
+        stack, count = busy[0].rsplit(' ', 1)
+        self.assertIn('test_profiler.py:busy_loop', stack)
+        self.assertGreater(int(count), 0)
+
+    def test_one_profile_at_a_time(self):
+        profiler = SamplingProfiler(interval=0.005)
+        profiler._lock.acquire()
+        self.addCleanup(profiler._lock.release)
+
+        with self.assertRaises(ProfilerBusy):
+            profiler.profile(0.01)
+
+    def test_duration_is_capped(self):
+        profiler = SamplingProfiler(interval=0.005, max_seconds=0.05)
+
+        profiler.profile(3600)
+
+    def test_fold_stack_is_root_first(self):
+        frame = sys._getframe()
+
+        folded = fold_stack('main', frame)
+
+        self.assertTrue(folded.startswith('main;'))
+        self.assertTrue(folded.endswith('test_profiler.py:test_fold_stack_is_root_first'))
+
+
+if __name__ == '__main__':
+    unittest.main()
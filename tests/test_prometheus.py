@@ -1,11 +1,13 @@
 import unittest
+from threading import Thread
 from unittest.mock import patch, MagicMock
 import sys
 import os
 
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
 
-from prometheus import collect_speedtest_metrics, collect_reachability_metrics
+from prometheus import collect_speedtest_metrics, collect_reachability_metrics, collect_dns_query_metrics, \
+    collect_http_phase_metrics, collect_speedtest_progress, sync_reachability_targets
 
 
 class TestCollectSpeedtestMetrics(unittest.TestCase):
@@ -183,16 +185,42 @@ class TestCollectSpeedtestMetrics(unittest.TestCase):
         self.mock_info.info.assert_not_called()
 
 
+class TestCollectSpeedtestProgress(unittest.TestCase):
+
+    @patch('prometheus.speedtest_live_bandwidth')
+    @patch('prometheus.speedtest_progress')
+    def test_sets_progress_and_bandwidth(self, mock_progress, mock_bandwidth):
+        collect_speedtest_progress('download', 0.5, 120.0)
+
+        mock_progress.labels.assert_called_with('download')
+        mock_progress.labels().set.assert_called_with(0.5)
+        mock_bandwidth.labels().set.assert_called_with(120.0)
+
+    @patch('prometheus.speedtest_live_bandwidth')
+    @patch('prometheus.speedtest_progress')
+    def test_skips_missing_values(self, mock_progress, mock_bandwidth):
+        collect_speedtest_progress('ping', None, None)
+
+        mock_progress.labels.assert_not_called()
+        mock_bandwidth.labels.assert_not_called()
+
+
 class TestCollectReachabilityMetrics(unittest.TestCase):
 
     def setUp(self):
         self.patches = []
 
         self.mock_response_time = MagicMock()
+        self.mock_response_time_histogram = MagicMock()
+        self.mock_response_time_quantile = MagicMock()
         self.mock_reachability = MagicMock()
 
         patches_config = [
             ('prometheus.response_time', self.mock_response_time),
+            ('prometheus.response_time_histogram', self.mock_response_time_histogram),
+            ('prometheus.response_time_quantile', self.mock_response_time_quantile),
+            ('prometheus.response_time_sketches', {}),
+            ('prometheus.label_children', {}),
             ('prometheus.reachability', self.mock_reachability),
         ]
 
@@ -247,6 +275,98 @@ class TestCollectReachabilityMetrics(unittest.TestCase):
 
         self.assertEqual(self.mock_reachability.labels.call_count, 3)
 
+    def test_observes_response_time_histogram(self):
+        checks = {
+            'example.com': {'reachable': True, 'response_time_ms': 150.5},
+            'test.com': {'reachable': False, 'response_time_ms': None}
+        }
+
+        collect_reachability_metrics('HTTP', checks)
+
+        self.mock_response_time_histogram.labels.assert_called_once_with('example.com', 'HTTP')
+        self.mock_response_time_histogram.labels().observe.assert_called_once_with(150.5)
+
+    @patch('prometheus.response_time_quantiles', [])
+    def test_quantiles_disabled_by_default(self):
+        collect_reachability_metrics('HTTP', {'example.com': {'reachable': True, 'response_time_ms': 10}})
+
+        self.mock_response_time_quantile.labels.assert_not_called()
+
+    @patch('prometheus.response_time_quantiles', [0.5, 0.99])
+    def test_exports_streaming_quantiles(self):
+        for response_time_ms in (10, 20, 30, 40, 1000):
+            collect_reachability_metrics('HTTP', {'example.com': {'reachable': True, 'response_time_ms': response_time_ms}})
+
+        self.mock_response_time_quantile.labels.assert_any_call('example.com', 'HTTP', '0.5')
+        self.mock_response_time_quantile.labels.assert_called_with('example.com', 'HTTP', '0.99')
+        p99 = self.mock_response_time_quantile.labels().set.call_args[0][0]
+        self.assertAlmostEqual(p99, 1000, delta=20)
+
+    @patch('prometheus.tag_during_speedtest', True)
+    @patch('prometheus.response_time_quantiles', [0.5])
+    def test_tags_probes_made_during_a_speedtest(self):
+        collect_reachability_metrics('HTTP', {
+            'example.com': {'reachable': True, 'response_time_ms': 10},
+            'test.com': {'reachable': True, 'response_time_ms': 500, 'during_speedtest': True}
+        })
+
+        self.mock_response_time.labels.assert_any_call('example.com', 'HTTP', 'false')
+        self.mock_response_time.labels.assert_any_call('test.com', 'HTTP', 'true')
+        self.mock_response_time_histogram.labels.assert_any_call('test.com', 'HTTP', 'true')
+        self.mock_response_time_quantile.labels.assert_any_call('test.com', 'HTTP', 'true', '0.5')
+
+    def test_reuses_bound_children_across_cycles(self):
+        checks = {'example.com': {'reachable': True, 'response_time_ms': 100}}
+
+        for _ in range(3):
+            collect_reachability_metrics('HTTP', checks)
+
+        self.assertEqual(self.mock_response_time.labels.call_count, 1)
+        self.assertEqual(self.mock_reachability.labels.call_count, 1)
+        self.assertEqual(self.mock_response_time.labels().set.call_count, 3)
+
+    def test_sync_removes_dropped_targets(self):
+        collect_reachability_metrics('HTTP', {
+            'keep.com': {'reachable': True, 'response_time_ms': 100},
+            'drop.com': {'reachable': True, 'response_time_ms': 100}
+        })
+        collect_reachability_metrics('DNS', {'drop.com': {'reachable': True, 'response_time_ms': 100}})
+
+        sync_reachability_targets('HTTP', ['keep.com'])
+
+        self.mock_response_time.remove.assert_called_once_with('drop.com', 'HTTP')
+        self.mock_response_time_histogram.remove.assert_called_once_with('drop.com', 'HTTP')
+        self.mock_reachability.remove.assert_called_once_with('drop.com', 'HTTP')
+
+    def test_dropped_target_is_rebound_when_readded(self):
+        checks = {'example.com': {'reachable': True, 'response_time_ms': 100}}
+        collect_reachability_metrics('HTTP', checks)
+        sync_reachability_targets('HTTP', [])
+
+        collect_reachability_metrics('HTTP', checks)
+
+        self.assertEqual(self.mock_reachability.labels.call_count, 2)
+
+    def test_sync_while_other_threads_collect(self):
+        errors = []
+
+        def collect(protocol):
+            try:
+                for i in range(300):
+                    collect_reachability_metrics(protocol, {f"{protocol}-{i}.com": {'reachable': True, 'response_time_ms': 1}})
+            except RuntimeError as err:
+                errors.append(err)
+
+        threads = [Thread(target=collect, args=(protocol,)) for protocol in ('HTTP', 'DNS')]
+        for thread in threads:
+            thread.start()
+        for _ in range(300):
+            sync_reachability_targets('HTTP', [])
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+
     def test_handles_empty_checks(self):
         collect_reachability_metrics('HTTP', {})
 
@@ -254,5 +374,80 @@ class TestCollectReachabilityMetrics(unittest.TestCase):
         self.mock_reachability.labels.assert_not_called()
 
 
+class TestCollectHttpPhaseMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.mock_http_phase_duration = MagicMock()
+        self.patch = patch('prometheus.http_phase_duration', self.mock_http_phase_duration)
+        self.patch.start()
+
+    def tearDown(self):
+        self.patch.stop()
+
+    def test_observes_each_timed_phase(self):
+        checks = {
+            'example.com': {
+                'reachable': True,
+                'response_time_ms': 40,
+                'phases': {'dns': 1.0, 'connect': 2.0, 'tls': None, 'ttfb': 4.0}
+            }
+        }
+
+        collect_http_phase_metrics(checks)
+
+        self.assertEqual(self.mock_http_phase_duration.labels.call_count, 3)
+        self.mock_http_phase_duration.labels.assert_called_with('example.com', 'ttfb')
+        self.mock_http_phase_duration.labels().observe.assert_called_with(4.0)
+
+    def test_ignores_checks_without_phases(self):
+        collect_http_phase_metrics({'example.com': {'reachable': False, 'response_time_ms': None}})
+
+        self.mock_http_phase_duration.labels.assert_not_called()
+
+
+class TestCollectDnsQueryMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.patches = []
+
+        self.mock_dns_query_time = MagicMock()
+        self.mock_dns_query_status = MagicMock()
+
+        patches_config = [
+            ('prometheus.dns_query_time', self.mock_dns_query_time),
+            ('prometheus.dns_query_status', self.mock_dns_query_status),
+        ]
+
+        for target, mock_obj in patches_config:
+            p = patch(target, mock_obj)
+            p.start()
+            self.patches.append(p)
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+
+    def test_collects_time_and_status(self):
+        results = {
+            '1.1.1.1': [{'name': 'google.com', 'type': 'A', 'rcode': 'NOERROR', 'response_time_ms': 12.5}]
+        }
+
+        collect_dns_query_metrics(results)
+
+        self.mock_dns_query_time.labels.assert_called_with('1.1.1.1', 'google.com', 'A')
+        self.mock_dns_query_time.labels().set.assert_called_with(12.5)
+        self.mock_dns_query_status.labels().state.assert_called_with('NOERROR')
+
+    def test_skips_time_for_timed_out_query(self):
+        results = {
+            '1.1.1.1': [{'name': 'google.com', 'type': 'AAAA', 'rcode': 'TIMEOUT', 'response_time_ms': None}]
+        }
+
+        collect_dns_query_metrics(results)
+
+        self.mock_dns_query_time.labels().set.assert_not_called()
+        self.mock_dns_query_status.labels().state.assert_called_with('TIMEOUT')
+
+
 if __name__ == '__main__':
     unittest.main()
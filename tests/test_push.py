@@ -0,0 +1,177 @@
+import unittest
+from unittest.mock import patch
+from http.server import BaseHTTPRequestHandler
+from tempfile import TemporaryDirectory
+import threading
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from prometheus_client import CollectorRegistry, Gauge
+from push import Pusher, Spool, registry_series
+from test_http_probe import QuietHTTPServer
+from test_remote_write import snappy_decompress, decode_write_request
+
+
+# Stores every accepted request; answers with `status` while it is set
+class ReceiverHandler(BaseHTTPRequestHandler):
+    requests = []
+    status = 200
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if ReceiverHandler.status == 200:
+            ReceiverHandler.requests.append((self.command, self.path, dict(self.headers), body))
+        self.send_response(ReceiverHandler.status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    do_PUT = do_POST
+
+    def log_message(self, *args):
+        pass
+
+
+class TestRegistrySeries(unittest.TestCase):
+
+    def test_stamps_every_sample(self):
+        registry = CollectorRegistry()
+        Gauge('speed', 'Speed', ['server'], registry=registry).labels('A').set(5)
+
+        series = registry_series(registry, 1000, {'job': 'j'})
+
+        self.assertEqual(series, [({'job': 'j', 'server': 'A', '__name__': 'speed'}, [(5.0, 1000)])])
+
+
+class TestSpool(unittest.TestCase):
+
+    def test_memory_spool_is_fifo(self):
+        spool = Spool()
+        spool.append(b'one')
+        spool.append(b'two')
+
+        self.assertEqual([batch for _, batch in spool.batches()], [b'one', b'two'])
+
+    def test_drops_oldest_beyond_max_bytes(self):
+        spool = Spool(max_bytes=10)
+        for batch in (b'aaaa', b'bbbb', b'cccc'):
+            spool.append(batch)
+
+        self.assertEqual([batch for _, batch in spool.batches()], [b'bbbb', b'cccc'])
+
+    def test_disk_spool_survives_a_restart(self):
+        with TemporaryDirectory() as directory:
+            spool = Spool(directory)
+            spool.append(b'one')
+            spool.append(b'two')
+            spool.remove(spool.sequences()[0])
+
+            restored = Spool(directory)
+            restored.append(b'three')
+
+            self.assertEqual([batch for _, batch in restored.batches()], [b'two', b'three'])
+            self.assertEqual(restored.size(), 8)
+
+
+class TestPusher(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = QuietHTTPServer(('127.0.0.1', 0), ReceiverHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.base_url = f"http://127.0.0.1:{cls.server.server_address[1]}"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        ReceiverHandler.requests.clear()
+        ReceiverHandler.status = 200
+        self.registry = CollectorRegistry()
+        self.speed = Gauge('internet_download_speed', 'Download speed', registry=self.registry)
+        self.now = 1700000000
+
+    def make_pusher(self, push_format='remote_write', spool=None):
+        return Pusher(
+            f"{self.base_url}/api/v1/write", push_format, spool=spool, registry=self.registry,
+            instance='site-a', timeout=2, clock=lambda: self.now
+        )
+
+    def received_samples(self):
+        samples = []
+        for _, _, _, body in ReceiverHandler.requests:
+            for labels, values in decode_write_request(snappy_decompress(body)):
+                samples += [(labels['__name__'], value, timestamp) for value, timestamp in values]
+        return samples
+
+    @patch('remote_write.snappy', None)
+    def test_remote_write(self):
+        self.speed.set(100)
+
+        self.assertEqual(self.make_pusher().push(), 1)
+
+        _, path, headers, body = ReceiverHandler.requests[0]
+        self.assertEqual(path, '/api/v1/write')
+        self.assertEqual(headers['Content-Encoding'], 'snappy')
+        self.assertEqual(headers['X-Prometheus-Remote-Write-Version'], '0.1.0')
+        labels, samples = decode_write_request(snappy_decompress(body))[0]
+        self.assertEqual(labels, {'__name__': 'internet_download_speed', 'instance': 'site-a', 'job': 'internet-speed'})
+        self.assertEqual(samples, [(100.0, 1700000000000)])
+
+    @patch('remote_write.snappy', None)
+    def test_spools_while_offline_and_backfills_in_order(self):
+        with TemporaryDirectory() as directory:
+            pusher = self.make_pusher(spool=Spool(directory))
+            ReceiverHandler.status = 503
+            for speed in (10, 20, 30):
+                self.speed.set(speed)
+                self.assertEqual(pusher.push(), 0)
+                self.now += 60
+            self.assertEqual(len(os.listdir(directory)), 3)
+
+            ReceiverHandler.status = 200
+            self.speed.set(40)
+            self.assertEqual(pusher.push(), 4)
+
+            self.assertEqual(self.received_samples(), [
+                ('internet_download_speed', 10.0, 1700000000000),
+                ('internet_download_speed', 20.0, 1700000060000),
+                ('internet_download_speed', 30.0, 1700000120000),
+                ('internet_download_speed', 40.0, 1700000180000)
+            ])
+            self.assertEqual(os.listdir(directory), [])
+
+    def test_unreachable_receiver_keeps_the_batch(self):
+        pusher = Pusher('http://127.0.0.1:1/api/v1/write', spool=Spool(), registry=self.registry, timeout=1)
+
+        self.assertEqual(pusher.push(), 0)
+        self.assertEqual(len(pusher.spool), 1)
+
+    def test_rejected_batch_is_dropped(self):
+        pusher = self.make_pusher()
+        ReceiverHandler.status = 400
+
+        self.assertEqual(pusher.push(), 0)
+        self.assertEqual(len(pusher.spool), 0)
+
+    def test_pushgateway_sends_only_the_newest_batch(self):
+        pusher = Pusher(self.base_url, 'pushgateway', spool=Spool(), registry=self.registry, instance='site a', timeout=2)
+        ReceiverHandler.status = 503
+        self.speed.set(1)
+        pusher.push()
+
+        ReceiverHandler.status = 200
+        self.speed.set(2)
+        self.assertEqual(pusher.push(), 1)
+
+        method, path, _, body = ReceiverHandler.requests[0]
+        self.assertEqual((method, path), ('PUT', '/metrics/job/internet-speed/instance/site%20a'))
+        self.assertIn(b'internet_download_speed 2.0', body)
+        self.assertEqual(len(ReceiverHandler.requests), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
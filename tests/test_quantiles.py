@@ -0,0 +1,67 @@
+import unittest
+import random
+from math import ceil
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from quantiles import SlidingWindowQuantiles
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestSlidingWindowQuantiles(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.sketch = SlidingWindowQuantiles(window_seconds=60, sub_windows=6, relative_accuracy=0.01, clock=self.clock)
+
+    def test_empty_sketch(self):
+        self.assertIsNone(self.sketch.quantile(0.5))
+
+    def test_quantiles_within_relative_accuracy(self):
+        values = [random.uniform(1, 1000) for _ in range(5000)]
+        for value in values:
+            self.sketch.observe(value)
+        values.sort()
+
+        for q in (0.5, 0.95, 0.99):
+            expected = values[ceil(q * len(values)) - 1]
+            self.assertAlmostEqual(self.sketch.quantile(q), expected, delta=expected * 0.02)
+
+    def test_handles_zero(self):
+        self.sketch.observe(0)
+        self.sketch.observe(0)
+        self.sketch.observe(10)
+
+        self.assertEqual(self.sketch.quantile(0.5), 0.0)
+
+    def test_old_values_leave_the_window(self):
+        for _ in range(100):
+            self.sketch.observe(1000)
+        self.clock.now += 61
+        self.sketch.observe(10)
+
+        self.assertEqual(self.sketch.count(), 1)
+        self.assertAlmostEqual(self.sketch.quantile(0.99), 10, delta=0.2)
+
+    def test_memory_is_bounded(self):
+        sketch = SlidingWindowQuantiles(max_buckets=50, clock=self.clock)
+        for value in range(1, 100_000, 7):
+            sketch.observe(value)
+
+        for _, buckets in sketch._slices:
+            self.assertLessEqual(len(buckets), 50)
+        self.assertAlmostEqual(sketch.quantile(0.99), 99_000, delta=99_000 * 0.02)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+import unittest
+from unittest.mock import patch
+from struct import unpack
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from remote_write import encode_varint, encode_write_request, snappy_literal_compress, snappy_compress
+
+
+def decode_varint(data, position):
+    value = shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, position
+
+# Decodes snappy literals and copies, enough to check what is sent
+def snappy_decompress(data):
+    length, position = decode_varint(data, 0)
+    output = bytearray()
+    while position < len(data):
+        tag = data[position]
+        position += 1
+        kind = tag & 3
+        if kind == 0:
+            literal_length = tag >> 2
+            if literal_length >= 60:
+                extra = literal_length - 59
+                literal_length = int.from_bytes(data[position:position + extra], 'little')
+                position += extra
+            literal_length += 1
+            output += data[position:position + literal_length]
+            position += literal_length
+            continue
+        if kind == 1:
+            copy_length = ((tag >> 2) & 7) + 4
+            offset = (tag >> 5) << 8 | data[position]
+            position += 1
+        else:
+            copy_length = (tag >> 2) + 1
+            size = 2 if kind == 2 else 4
+            offset = int.from_bytes(data[position:position + size], 'little')
+            position += size
+        for _ in range(copy_length):
+            output.append(output[-offset])
+    assert len(output) == length
+    return bytes(output)
+
+def decode_fields(data):
+    position = 0
+    while position < len(data):
+        key, position = decode_varint(data, position)
+        number, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, position = decode_varint(data, position)
+        elif wire_type == 1:
+            value = data[position:position + 8]
+            position += 8
+        else:
+            length, position = decode_varint(data, position)
+            value = data[position:position + length]
+            position += length
+        yield number, value
+
+# Returns [(labels, [(value, timestamp_ms)])] from an uncompressed WriteRequest
+def decode_write_request(data):
+    series = []
+    for _, timeseries in decode_fields(data):
+        labels, samples = {}, []
+        for number, value in decode_fields(timeseries):
+            fields = dict(decode_fields(value))
+            if number == 1:
+                labels[fields[1].decode('utf-8')] = fields[2].decode('utf-8')
+            else:
+                samples.append((unpack('<d', fields[1])[0], fields[2]))
+        series.append((labels, samples))
+    return series
+
+
+class TestEncoding(unittest.TestCase):
+
+    def test_varint(self):
+        self.assertEqual(encode_varint(1), b'\x01')
+        self.assertEqual(encode_varint(300), b'\xac\x02')
+        self.assertEqual(len(encode_varint(-1)), 10)
+
+    def test_write_request_round_trip(self):
+        series = [
+            ({'__name__': 'internet_download_speed', 'server_name': 'A', 'job': 'internet-speed'}, [(123.5, 1700000000000)]),
+            ({'__name__': 'up'}, [(1.0, 1700000000000), (0.0, 1700000015000)])
+        ]
+
+        decoded = decode_write_request(encode_write_request(series))
+
+        self.assertEqual(decoded, series)
+
+    def test_labels_are_sorted(self):
+        data = encode_write_request([({'b': '2', '__name__': 'x', 'a': '1'}, [])])
+
+        timeseries = next(decode_fields(data))[1]
+        names = [dict(decode_fields(label))[1] for _, label in decode_fields(timeseries)]
+        self.assertEqual(names, [b'__name__', b'a', b'b'])
+
+
+class TestSnappy(unittest.TestCase):
+
+    def test_literal_compression_round_trips(self):
+        for data in (b'', b'x', b'a' * 59, b'b' * 60, b'c' * 300, bytes(range(256)) * 600):
+            self.assertEqual(snappy_decompress(snappy_literal_compress(data)), data)
+
+    def test_falls_back_without_python_snappy(self):
+        with patch('remote_write.snappy', None):
+            self.assertEqual(snappy_compress(b'hello'), snappy_literal_compress(b'hello'))
+
+
+if __name__ == '__main__':
+    unittest.main()
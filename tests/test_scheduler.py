@@ -0,0 +1,146 @@
+import unittest
+from threading import Event
+from time import sleep, monotonic
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from prometheus_client import REGISTRY
+from scheduler import Scheduler
+
+
+class TestScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = Scheduler()
+
+    def tearDown(self):
+        self.scheduler.stop(timeout=2)
+
+    def test_runs_each_check_on_its_interval(self):
+        runs = []
+        self.scheduler.add('fast', lambda: runs.append(monotonic()), 0.05)
+
+        self.scheduler.start()
+        sleep(0.28)
+        self.scheduler.stop(timeout=1)
+
+        self.assertGreaterEqual(len(runs), 4)
+        self.assertLessEqual(len(runs), 7)
+
+    def test_period_does_not_drift_with_check_duration(self):
+        runs = []
+
+        def check():
+            runs.append(monotonic())
+            sleep(0.03)
+
+        self.scheduler.add('slowish', check, 0.1)
+
+        self.scheduler.start()
+        sleep(0.45)
+        self.scheduler.stop(timeout=1)
+
+        # Sequential runs would drift by 0.03s per run; grid runs do not
+        self.assertGreaterEqual(len(runs), 4)
+        self.assertAlmostEqual(runs[-1] - runs[0], 0.1 * (len(runs) - 1), delta=0.04)
+
+    def test_hung_check_does_not_block_other_checks(self):
+        release = Event()
+        runs = []
+        self.scheduler.add('hung', lambda: release.wait(2), 0.05)
+        self.scheduler.add('probe', lambda: runs.append(1), 0.05)
+
+        self.scheduler.start()
+        sleep(0.25)
+        release.set()
+
+        self.assertGreaterEqual(len(runs), 3)
+
+    def test_overruns_are_counted_and_skipped(self):
+        runs = []
+
+        def check():
+            runs.append(1)
+            sleep(0.12)
+
+        self.scheduler.add('overrun', check, 0.05)
+
+        self.scheduler.start()
+        sleep(0.3)
+        self.scheduler.stop(timeout=1)
+
+        overruns = REGISTRY.get_sample_value('schedule_overruns_total', {'check': 'overrun'})
+        self.assertGreaterEqual(overruns, 2)
+        self.assertLessEqual(len(runs), 3)
+
+    def test_exports_schedule_lag(self):
+        self.scheduler.add('lag', lambda: None, 0.05)
+
+        self.scheduler.start()
+        sleep(0.1)
+
+        lag = REGISTRY.get_sample_value('schedule_lag_seconds', {'check': 'lag'})
+        self.assertIsNotNone(lag)
+        self.assertGreaterEqual(lag, 0)
+
+    def test_failing_check_keeps_running(self):
+        runs = []
+
+        def check():
+            runs.append(1)
+            raise RuntimeError("boom")
+
+        self.scheduler.add('failing', check, 0.05)
+
+        self.scheduler.start()
+        sleep(0.18)
+
+        self.assertGreaterEqual(len(runs), 2)
+
+    def test_after_run_hook(self):
+        hooks = []
+        scheduler = Scheduler(after_run=lambda: hooks.append(1))
+        scheduler.add('hooked', lambda: None, 0.05)
+
+        scheduler.start()
+        sleep(0.12)
+        scheduler.stop(timeout=1)
+
+        self.assertGreaterEqual(len(hooks), 2)
+
+    def test_initial_delay(self):
+        runs = []
+        self.scheduler.add('delayed', lambda: runs.append(1), 0.05, initial_delay=0.3)
+
+        self.scheduler.start()
+        sleep(0.1)
+
+        self.assertEqual(runs, [])
+
+    def test_trigger_runs_check_immediately(self):
+        runs = []
+        self.scheduler.add('triggered', lambda: runs.append(monotonic()), 60, initial_delay=60)
+
+        self.scheduler.start()
+        sleep(0.05)
+        triggered = monotonic()
+        self.scheduler.trigger('triggered')
+        sleep(0.1)
+
+        self.assertEqual(len(runs), 1)
+        self.assertLess(runs[0] - triggered, 0.05)
+
+    def test_stop_wakes_waiting_checks(self):
+        self.scheduler.add('idle', lambda: None, 60, initial_delay=60)
+        self.scheduler.start()
+
+        start = monotonic()
+        self.scheduler.stop(timeout=1)
+
+        self.assertLess(monotonic() - start, 0.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import unittest
+from io import BytesIO
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from site_messages import encode_hello, encode_reachability, encode_speedtest, decode, read_frame, MessageError, \
+    HELLO, REACHABILITY, SPEEDTEST
+
+SPEEDTEST_RESULT = {
+    'ping': {'jitter': 1.5, 'latency': 10.0},
+    'download': {'download_speed': 100.5, 'latency': {'iqm': 15.0, 'jitter': None}},
+    'upload': {'upload_speed': 50.25, 'latency': {'iqm': 20.0, 'jitter': 3.0}},
+    'packet_loss': None,
+    'isp': 'Test ISP',
+    'external_ip': '1.2.3.4',
+    'server': {'id': 1, 'name': 'Test Server', 'location': 'Test Location'}
+}
+
+
+def read_all(data):
+    reader = BytesIO(data)
+    messages = []
+    while (payload := read_frame(reader)) is not None:
+        messages.append(decode(payload))
+    return messages
+
+
+class TestSiteMessages(unittest.TestCase):
+
+    def test_round_trip(self):
+        data = encode_hello('site-a') + \
+            encode_reachability(1700000000.5, 'HTTP', 'bbc.co.uk', {'reachable': True, 'response_time_ms': 42.0}) + \
+            encode_reachability(1700000001, 'DNS', '1.1.1.1', {'reachable': False, 'response_time_ms': None}) + \
+            encode_speedtest(1700000002, SPEEDTEST_RESULT)
+
+        hello, up, down, speedtest = read_all(data)
+
+        self.assertEqual(hello, (HELLO, {'site': 'site-a'}))
+        self.assertEqual(up, (REACHABILITY, {'timestamp': 1700000000.5, 'protocol': 'HTTP', 'target': 'bbc.co.uk', 'reachable': True, 'response_time_ms': 42.0}))
+        self.assertFalse(down[1]['reachable'])
+        self.assertIsNone(down[1]['response_time_ms'])
+        self.assertEqual(speedtest[0], SPEEDTEST)
+        self.assertEqual(speedtest[1]['server_name'], 'Test Server')
+        self.assertEqual(speedtest[1]['download_speed'], 100.5)
+        self.assertIsNone(speedtest[1]['download_latency_jitter'])
+        self.assertIsNone(speedtest[1]['packet_loss'])
+        self.assertEqual(speedtest[1]['external_ip'], '1.2.3.4')
+
+    def test_compact(self):
+        self.assertLess(len(encode_reachability(0, 'HTTP', 'bbc.co.uk', {'reachable': True, 'response_time_ms': 1.0})), 40)
+
+    def test_truncated_frame_is_end_of_stream(self):
+        self.assertEqual(read_all(encode_hello('site-a')[:-1]), [])
+
+    def test_rejects_malformed_messages(self):
+        with self.assertRaises(MessageError):
+            decode(bytes([9]))
+        with self.assertRaises(MessageError):
+            decode(encode_speedtest(0, SPEEDTEST_RESULT)[4:-8])
+        with self.assertRaises(MessageError):
+            read_frame(BytesIO(b'\xff\xff\xff\xff'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+import unittest
+import tempfile
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from speedtest_cache import SpeedtestResultCache
+
+
+def result_for(name, download_speed=100):
+    return {
+        'server': {'id': 1, 'name': name, 'location': 'London'},
+        'download': {'download_speed': download_speed}
+    }
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestSpeedtestResultCache(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = SpeedtestResultCache(max_age=600, clock=self.clock)
+
+    def test_keeps_latest_result_per_server(self):
+        self.cache.add(result_for('A', 100))
+        self.cache.add(result_for('B', 200))
+        self.cache.add(result_for('A', 150))
+
+        results = {result['server']['name']: result for _, result in self.cache.fresh()}
+
+        self.assertEqual(len(results), 2)
+        self.assertEqual(results['A']['download']['download_speed'], 150)
+
+    def test_reports_age(self):
+        self.cache.add(result_for('A'))
+        self.clock.now += 120
+
+        [(age, _)] = self.cache.fresh()
+
+        self.assertEqual(age, 120)
+
+    def test_drops_stale_results(self):
+        self.cache.add(result_for('A'))
+        self.clock.now += 300
+        self.cache.add(result_for('B'))
+        self.clock.now += 400
+
+        names = [result['server']['name'] for _, result in self.cache.fresh()]
+
+        self.assertEqual(names, ['B'])
+
+    def test_expire_returns_the_dropped_servers(self):
+        self.cache.add(result_for('A'))
+        self.clock.now += 700
+        self.cache.add(result_for('B'))
+
+        self.assertEqual(self.cache.expire(), [('A', 'London')])
+        self.assertEqual(self.cache.expire(), [])
+        self.assertEqual([result['server']['name'] for _, result in self.cache.fresh()], ['B'])
+
+    def test_ignores_failed_results(self):
+        self.cache.add({})
+        self.cache.add({'server': {'name': None, 'location': None}})
+
+        self.assertEqual(self.cache.fresh(), [])
+
+
+class TestSpeedtestState(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.state_file = os.path.join(self.directory.name, 'speedtest-state.json')
+        self.clock = FakeClock()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_round_trip(self):
+        cache = SpeedtestResultCache(max_age=600, clock=self.clock)
+        cache.add(result_for('A', 100))
+        cache.save(self.state_file, last_run=1000.0)
+        self.clock.now += 60
+
+        restored = SpeedtestResultCache(max_age=600, clock=self.clock)
+        last_run = restored.load(self.state_file)
+
+        self.assertEqual(last_run, 1000.0)
+        [(age, result)] = restored.fresh()
+        self.assertEqual(age, 60)
+        self.assertEqual(result['download']['download_speed'], 100)
+
+    def test_save_replaces_file_without_leftovers(self):
+        cache = SpeedtestResultCache(max_age=600, clock=self.clock)
+        cache.save(self.state_file, last_run=1.0)
+        cache.save(self.state_file, last_run=2.0)
+
+        self.assertEqual(os.listdir(self.directory.name), ['speedtest-state.json'])
+        self.assertEqual(SpeedtestResultCache(600).load(self.state_file), 2.0)
+
+    def test_missing_file(self):
+        cache = SpeedtestResultCache(max_age=600, clock=self.clock)
+
+        self.assertIsNone(cache.load(self.state_file))
+        self.assertEqual(cache.fresh(), [])
+
+    def test_corrupt_file_is_ignored(self):
+        with open(self.state_file, 'w') as state_file:
+            state_file.write('{"last_run": 1')
+        cache = SpeedtestResultCache(max_age=600, clock=self.clock)
+
+        self.assertIsNone(cache.load(self.state_file))
+        self.assertEqual(cache.fresh(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
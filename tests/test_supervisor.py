@@ -0,0 +1,168 @@
+import unittest
+from unittest.mock import patch
+from threading import Lock, Thread, Event
+from time import sleep, monotonic
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from prometheus_client import REGISTRY
+from supervisor import Supervisor, Worker, WorkerError
+from instrumentation import timed
+
+# Held by a thread of the test process in test_parent_locks_are_not_inherited
+held_lock = Lock()
+
+
+def handle(request):
+    if request == 'hang':
+        sleep(10)
+    if request == 'crash':
+        os._exit(3)
+    if request == 'raise':
+        raise ValueError("bad request")
+    if request == 'spin':
+        deadline = monotonic() + 10
+        while monotonic() < deadline:
+            pass
+    if request == 'pid':
+        return os.getpid()
+    return {'echo': request}
+
+
+def hang(request):
+    sleep(10)
+
+
+def timed_handle(request):
+    with timed('worker-test', 'work'):
+        return request
+
+
+def take_held_lock(request):
+    if held_lock.acquire(timeout=2):
+        held_lock.release()
+        return 'acquired'
+    return 'deadlocked'
+
+
+class TestWorker(unittest.TestCase):
+
+    def setUp(self):
+        self.worker = Worker('test', handle, timeout=1)
+
+    def tearDown(self):
+        self.worker.stop()
+
+    def test_answers_in_a_separate_process(self):
+        self.assertEqual(self.worker.call([1, 2]), {'echo': [1, 2]})
+        self.assertNotEqual(self.worker.call('pid'), os.getpid())
+
+    def test_reuses_the_process(self):
+        self.assertEqual(self.worker.call('pid'), self.worker.call('pid'))
+
+    def test_handler_exception_returns_none(self):
+        self.assertIsNone(self.worker.call('raise'))
+        self.assertEqual(self.worker.restarts, 0)
+
+    def test_hung_worker_is_restarted(self):
+        first_pid = self.worker.call('pid')
+
+        with self.assertRaises(WorkerError):
+            self.worker.call('hang')
+
+        self.assertEqual(self.worker.restarts, 1)
+        self.assertNotEqual(self.worker.call('pid'), first_pid)
+        self.assertGreaterEqual(REGISTRY.get_sample_value('worker_restarts_total', {'worker': 'test'}), 1)
+
+    def test_crashed_worker_is_restarted(self):
+        with self.assertRaises(WorkerError):
+            self.worker.call('crash')
+
+        self.assertEqual(self.worker.call('ok'), {'echo': 'ok'})
+
+    def test_cpu_limit_kills_runaway_request(self):
+        worker = Worker('cpu', handle, timeout=5, cpu_limit=1)
+        self.addCleanup(worker.stop)
+
+        start = monotonic()
+        with self.assertRaises(WorkerError):
+            worker.call('spin')
+
+        self.assertLess(monotonic() - start, 4)
+        self.assertEqual(worker.call('ok'), {'echo': 'ok'})
+
+    def test_rss_limit_kills_worker(self):
+        worker = Worker('rss', handle, timeout=5, max_rss_bytes=48 * 1024 * 1024)
+        self.addCleanup(worker.stop)
+        worker.call('ok')
+
+        with patch.object(worker, 'rss_bytes', return_value=64 * 1024 * 1024):
+            worker.check_memory()
+        sleep(0.1)
+
+        self.assertFalse(worker.process.is_alive())
+        self.assertEqual(worker.call('ok'), {'echo': 'ok'})
+
+    def test_sends_phase_timings_back(self):
+        worker = Worker('timed', timed_handle, timeout=5)
+        self.addCleanup(worker.stop)
+        labels = {'check': 'worker-test', 'phase': 'work'}
+        before = REGISTRY.get_sample_value('check_phase_duration_seconds_count', labels) or 0
+
+        self.assertEqual(worker.call('x'), 'x')
+
+        self.assertEqual(REGISTRY.get_sample_value('check_phase_duration_seconds_count', labels), before + 1)
+
+    def test_parent_locks_are_not_inherited(self):
+        release = Event()
+
+        def hold():
+            with held_lock:
+                release.wait(5)
+
+        holder = Thread(target=hold)
+        holder.start()
+        self.addCleanup(holder.join)
+        self.addCleanup(release.set)
+        worker = Worker('lock', take_held_lock, timeout=5)
+        self.addCleanup(worker.stop)
+
+        self.assertEqual(worker.call(None), 'acquired')
+
+    def test_reads_rss(self):
+        self.worker.call('ok')
+
+        self.assertGreater(self.worker.rss_bytes(), 0)
+
+
+class TestSupervisor(unittest.TestCase):
+
+    def test_failed_call_returns_none(self):
+        supervisor = Supervisor({'http': handle, 'dns': handle}, timeout=0.5)
+        supervisor.start()
+        self.addCleanup(supervisor.stop)
+
+        self.assertEqual(supervisor.call('dns', 'x'), {'echo': 'x'})
+        self.assertIsNone(supervisor.call('http', 'hang'))
+        self.assertEqual(supervisor.call('http', 'y'), {'echo': 'y'})
+
+
+class TestSupervisedChecks(unittest.TestCase):
+
+    @patch('monitor.publish_http_checks')
+    def test_worker_failure_marks_targets_unreachable(self, mock_publish):
+        import monitor
+        supervisor = Supervisor({'http': hang}, timeout=0.5)
+        self.addCleanup(supervisor.stop)
+
+        with patch('monitor.supervisor', supervisor), patch('monitor.due_targets', return_value=['a.com']):
+            monitor.http_check()
+
+        checks, _ = mock_publish.call_args[0]
+        self.assertEqual(checks, {'a.com': {'reachable': False, 'response_time_ms': None}})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,204 @@
+import unittest
+from unittest.mock import patch
+from http.server import BaseHTTPRequestHandler
+import tempfile
+import threading
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from throughput import read_interface_counters, InterfaceRateMeter, ranged_download, ThroughputEstimator
+from test_http_probe import QuietHTTPServer
+
+PROC_NET_DEV = """Inter-|   Receive                                                |  Transmit
+ face |bytes    packets errs drop fifo frame compressed multicast|bytes    packets errs drop fifo colls carrier compressed
+    lo: {lo} 10 0 0 0 0 0 0 {lo} 10 0 0 0 0 0 0
+  eth0: {rx} 100 0 0 0 0 0 0 {tx} 100 0 0 0 0 0 0
+ wlan0: 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0
+"""
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    ranges = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        body = b'x' * 4_000_000
+        requested = self.headers.get('Range')
+        RangeHandler.ranges.append(requested)
+        if requested and self.path != '/no-range':
+            end = int(requested.split('-')[1])
+            body = body[:end + 1]
+            self.send_response(206)
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except OSError:
+            pass
+
+
+class TestInterfaceCounters(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.proc_path = os.path.join(self.directory.name, 'dev')
+        self.clock = FakeClock()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write_counters(self, rx, tx, lo=0):
+        with open(self.proc_path, 'w') as proc_file:
+            proc_file.write(PROC_NET_DEV.format(rx=rx, tx=tx, lo=lo))
+
+    def test_reads_counters_without_loopback(self):
+        self.write_counters(1234, 5678, lo=999)
+
+        counters = read_interface_counters(self.proc_path)
+
+        self.assertEqual(counters, {'eth0': (1234, 5678), 'wlan0': (0, 0)})
+
+    def test_filters_interfaces(self):
+        self.write_counters(1, 2)
+
+        self.assertEqual(list(read_interface_counters(self.proc_path, ['eth0'])), ['eth0'])
+
+    def test_rates_between_samples(self):
+        meter = InterfaceRateMeter(self.proc_path, clock=self.clock)
+        self.write_counters(0, 0)
+        self.assertIsNone(meter.sample())
+
+        self.write_counters(12_500_000, 1_250_000, lo=10**9)
+        self.clock.now += 10
+
+        rx_mbps, tx_mbps = meter.sample()
+        self.assertAlmostEqual(rx_mbps, 10)
+        self.assertAlmostEqual(tx_mbps, 1)
+
+    def test_counter_reset_is_not_negative(self):
+        meter = InterfaceRateMeter(self.proc_path, clock=self.clock)
+        self.write_counters(10**9, 10**9)
+        meter.sample()
+
+        self.write_counters(100, 100)
+        self.clock.now += 5
+
+        self.assertEqual(meter.sample(), (0, 0))
+
+
+class TestRangedDownload(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = QuietHTTPServer(('127.0.0.1', 0), RangeHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.base_url = f"http://127.0.0.1:{cls.server.server_address[1]}"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def test_downloads_only_the_requested_range(self):
+        RangeHandler.ranges.clear()
+
+        mbps = ranged_download(self.base_url + '/file', 500_000)
+
+        self.assertEqual(RangeHandler.ranges, ['bytes=0-499999'])
+        self.assertGreater(mbps, 0)
+
+    def test_server_ignoring_range_is_cut_off(self):
+        mbps = ranged_download(self.base_url + '/no-range', 100_000)
+
+        self.assertGreater(mbps, 0)
+
+    def test_unreachable_url(self):
+        self.assertIsNone(ranged_download('http://127.0.0.1:9/file', 1000, timeout=0.5))
+
+
+class TestThroughputEstimator(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.estimator = ThroughputEstimator(threshold=0.3, cooldown=600, clock=self.clock)
+        self.estimator.set_capacity(100, 20)
+        self.clock.now += 700
+
+    def test_utilisation_and_headroom(self):
+        self.estimator.observe_traffic(25, 5)
+
+        self.assertEqual(self.estimator.estimate(), {'download': (25, 0.25, 75), 'upload': (5, 0.25, 15)})
+
+    def test_no_estimate_before_first_speedtest(self):
+        estimator = ThroughputEstimator(clock=self.clock)
+        estimator.observe_traffic(25, 5)
+
+        self.assertEqual(estimator.estimate(), {})
+
+    def test_traffic_above_capacity_triggers_speedtest(self):
+        self.assertIsNone(self.estimator.observe_traffic(120, 5))
+        self.assertIsNotNone(self.estimator.observe_traffic(140, 5))
+
+    def test_probe_change_triggers_speedtest(self):
+        self.assertIsNone(self.estimator.observe_probe(40))
+        self.assertIsNone(self.estimator.observe_probe(45))
+        self.assertIsNotNone(self.estimator.observe_probe(20))
+
+    def test_cooldown(self):
+        self.assertIsNotNone(self.estimator.observe_traffic(200, 5))
+        self.clock.now += 60
+
+        self.assertIsNone(self.estimator.observe_traffic(200, 5))
+
+    def test_ignores_traffic_while_speedtest_runs(self):
+        self.estimator.speedtest_started()
+        self.clock.now += 700
+
+        self.assertIsNone(self.estimator.observe_traffic(500, 50))
+        self.assertIsNone(self.estimator.observe_probe(10))
+
+    def test_new_speedtest_resets_probe_baseline(self):
+        self.estimator.observe_probe(40)
+        self.estimator.set_capacity(50, 10)
+        self.clock.now += 700
+
+        self.assertIsNone(self.estimator.observe_probe(20))
+        self.assertIsNone(self.estimator.observe_probe(22))
+
+
+class TestThroughputCheck(unittest.TestCase):
+
+    @patch('monitor.speedtest_trigger')
+    @patch('monitor.interface_rate_meter')
+    def test_triggers_speedtest_past_threshold(self, mock_meter, mock_trigger):
+        import monitor
+        clock = FakeClock()
+        estimator = ThroughputEstimator(threshold=0.3, cooldown=600, clock=clock)
+        estimator.set_capacity(100, 20)
+        clock.now += 700
+        mock_meter.sample.return_value = (150, 5)
+
+        with patch('monitor.throughput_estimator', estimator):
+            monitor.throughput_check()
+
+        mock_trigger.assert_called_once_with()
+
+
+if __name__ == '__main__':
+    unittest.main()